@@ -0,0 +1,334 @@
+"""
+Structural checks of a plot, reported as diagnostics.
+
+- Transitions whose label is neither a node of the plot nor computed (eg.
+  ``lbl.repeat()``) lead nowhere, the editor does not show them.
+- Nodes which can not be reached from the start nodes, the targets of the ``GLOBAL``
+  transitions and the targets of the ``LOCAL`` transitions of flows which are reached.
+  The start nodes are the regular nodes named ``start`` or ``fallback`` (as in most dff
+  scripts, the labels given to the ``Actor`` are not part of the plot), or else the
+  first one, unless given.
+- Cycles the conversation can not leave: strongly connected components of the nodes
+  and their transitions, without transitions out of them and without ``GLOBAL`` or
+  ``LOCAL`` transitions.
+
+Like the graph, the checks are kept up to date from the deltas of the plot: the
+successors of a node are only computed again when the node, its transitions or their
+labels changed. The diagnostics are kept until the type, the successors or the labels
+of a node, or the flows, change: edits of conditions, responses or the other
+properties of a node do not change anything. Reachability and cycles are not
+maintained incrementally though, after such a structural change they are computed
+again over all the nodes and their successors, in O(nodes + transitions) (about 30 ms
+for 10k nodes).
+"""
+
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from plot_parser import Plot
+
+Diagnostic = Dict[str, Any]
+
+
+def _changed_ids(delta: dict, table: str) -> Iterable[str]:
+    changes = delta.get(table)
+    if changes:
+        yield from changes["added"]
+        yield from changes["changed"]
+        yield from changes["removed"]
+
+
+class Analyzer:
+    """Checks of a plot, updated from its deltas (see ``PlotStore.delta``)"""
+
+    def __init__(self, plot: Plot, start: Optional[List[str]] = None):
+        # Start nodes given by the parent process
+        self.start = start
+        self.reset(plot)
+
+    def reset(self, plot: Plot) -> None:
+        """Check another plot in full, eg. the same one parsed again"""
+        self.plot = plot
+        # Successors of each node through its own transitions, and the nodes (through
+        # their transitions) using each label
+        self.successors: Dict[str, List[str]] = {}
+        self.label_users: Dict[str, Set[str]] = {}
+        self.labels: Dict[str, List[str]] = {}
+        # Transitions leading nowhere, and the type of each node
+        self.dangling: Dict[str, List[str]] = {}
+        self.types: Dict[str, str] = {}
+        # Nodes of each flow in order, and the flow of each node
+        self.members: Dict[str, List[str]] = {}
+        self.flow_of: Dict[str, str] = {}
+        for flow, record in plot["flows"].items():
+            self._add_flow(flow, record)
+        self._results: Optional[List[Diagnostic]] = None
+        for objid in plot["nodes"]:
+            self._build(objid)
+
+    def update(self, delta: dict) -> None:
+        """Check again the nodes affected by a delta of the plot"""
+        dirty: Dict[str, None] = {}
+        if "flows" in delta:
+            dirty.update(dict.fromkeys(self._update_flows(delta["flows"])))
+            # Flows scope the LOCAL transitions
+            self._results = None
+        for objid in _changed_ids(delta, "nodes"):
+            dirty[objid] = None
+            # Labels may now be a node, or not anymore
+            dirty.update(dict.fromkeys(self.label_users.get(objid, ())))
+        for table in ("transitions", "linking"):
+            for objid in _changed_ids(delta, table):
+                dirty.update(dict.fromkeys(self.label_users.get(objid, ())))
+        for objid in dirty:
+            self._build(objid)
+
+    def diagnostics(self) -> List[Diagnostic]:
+        """Problems found in the plot, the same list until the successors change"""
+        if self._results is None:
+            self._results = self._dangling() + self._unreachable() + self._traps()
+        return self._results
+
+    def _add_flow(self, flow: str, record: Dict[str, Any]) -> None:
+        self.members[flow] = record["nodes"]
+        for node in record["nodes"]:
+            self.flow_of.setdefault(node, flow)
+
+    def _update_flows(self, changes: dict) -> List[str]:
+        """Update the flows, return the nodes of the changed ones"""
+        nodes: Dict[str, None] = {}
+        for flow in (*changes["changed"], *changes["removed"]):
+            for node in self.members.pop(flow, ()):
+                nodes[node] = None
+                if self.flow_of.get(node) == flow:
+                    del self.flow_of[node]
+        for flow, record in (*changes["added"].items(), *changes["changed"].items()):
+            nodes.update(dict.fromkeys(record["nodes"]))
+            self._add_flow(flow, record)
+        # Forward and backward labels of the other nodes of the flows lead elsewhere
+        return list(nodes)
+
+    def _regular(self, objid: str) -> bool:
+        node = self.plot["nodes"].get(objid)
+        return node is not None and node["type"] == "regular"
+
+    def _build(self, objid: str) -> None:
+        """Compute the successors of a node (again)"""
+        old_labels = self.labels.pop(objid, [])
+        for label in old_labels:
+            users = self.label_users[label]
+            users.discard(objid)
+            if not users:
+                del self.label_users[label]
+        old = (
+            self.types.pop(objid, None),
+            self.successors.pop(objid, None),
+            self.dangling.pop(objid, None),
+            old_labels,
+        )
+        node = self.plot["nodes"].get(objid)
+        successors: List[str] = []
+        if node is not None:
+            labels = [objid]
+            for trans_id in node.get("transitions", ()):
+                trans = self.plot["transitions"].get(trans_id)
+                labels.append(trans_id)
+                if trans is None:
+                    continue
+                label = trans["label"]
+                labels.append(label)
+                if label in self.plot["nodes"]:
+                    successors.append(label)
+                elif label in self.plot["linking"]:
+                    successors += self._computed(objid, label)
+                else:
+                    self.dangling.setdefault(objid, []).append(trans_id)
+            self.types[objid] = node["type"]
+            self.successors[objid] = successors
+            # Transitions of a node may share a label
+            self.labels[objid] = list(dict.fromkeys(labels))
+            for label in labels:
+                self.label_users.setdefault(label, set()).add(objid)
+        new = (
+            self.types.get(objid),
+            self.successors.get(objid),
+            self.dangling.get(objid),
+            self.labels.get(objid, []),
+        )
+        if new != old:
+            self._results = None
+
+    def _computed(self, objid: str, label: str) -> List[str]:
+        """Nodes a computed label (``lbl.forward()``...) may lead to"""
+        link = self.plot["linking"][label]
+        py_def = self.plot["py_defs"].get(link["object"])
+        function = py_def["name"].rsplit(".", 1)[-1] if py_def is not None else ""
+        if function == "repeat":
+            return [objid]
+        if function in ("forward", "backward") and objid in self.flow_of:
+            siblings = [
+                n for n in self.members[self.flow_of[objid]] if self._regular(n)
+            ]
+            if objid in siblings:
+                step = 1 if function == "forward" else -1
+                return [siblings[(siblings.index(objid) + step) % len(siblings)]]
+        # Start and fallback nodes are reached anyway, and the others are unknown
+        return []
+
+    def _starts(self) -> List[str]:
+        if self.start is not None:
+            return [objid for objid in self.start if objid in self.plot["nodes"]]
+        regular = [
+            objid
+            for objid, node in self.plot["nodes"].items()
+            if node["type"] == "regular"
+        ]
+        named = [
+            objid
+            for objid in regular
+            if self.plot["nodes"][objid].get("name") in ("start", "fallback")
+        ]
+        return named or regular[:1]
+
+    def _scoped(self, node_type: str) -> Dict[Optional[str], List[str]]:
+        """Global or local nodes, by flow"""
+        scoped: Dict[Optional[str], List[str]] = {}
+        for objid, node in self.plot["nodes"].items():
+            if node["type"] == node_type:
+                scoped.setdefault(self.flow_of.get(objid), []).append(objid)
+        return scoped
+
+    def _unreachable(self) -> List[Diagnostic]:
+        local = self._scoped("local")
+        stack = self._starts()
+        for scope in self._scoped("global").values():
+            for objid in scope:
+                stack += self.successors.get(objid, ())
+        reached: Set[str] = set()
+        flows: Set[Optional[str]] = set()
+        while stack:
+            objid = stack.pop()
+            if objid in reached:
+                continue
+            reached.add(objid)
+            stack += self.successors.get(objid, ())
+            flow = self.flow_of.get(objid)
+            if flow not in flows:
+                flows.add(flow)
+                for scope in local.get(flow, ()):
+                    stack += self.successors.get(scope, ())
+        return [
+            self._diagnostic(
+                objid,
+                "unreachable",
+                f"Node {self._name(objid)} can not be reached from the start node or "
+                "a GLOBAL transition",
+            )
+            for objid, node in self.plot["nodes"].items()
+            if node["type"] == "regular" and objid not in reached
+        ]
+
+    def _dangling(self) -> List[Diagnostic]:
+        return [
+            self._diagnostic(
+                trans_id,
+                "dangling-label",
+                f"Transition of node {self._name(node)} leads to "
+                f"{self.plot['transitions'][trans_id]['label']}, which is not a node "
+                "of the plot",
+                node,
+            )
+            for node, transitions in self.dangling.items()
+            for trans_id in transitions
+        ]
+
+    def _traps(self) -> List[Diagnostic]:
+        for scope in self._scoped("global").values():
+            if any(self.successors.get(objid) for objid in scope):
+                return []
+        local_flows = {
+            flow
+            for flow, scope in self._scoped("local").items()
+            if any(self.successors.get(objid) for objid in scope)
+        }
+        traps = []
+        for component in self._components():
+            members = set(component)
+            if len(component) == 1 and component[0] not in self.successors.get(
+                component[0], ()
+            ):
+                continue
+            if any(self.flow_of.get(objid) in local_flows for objid in component):
+                continue
+            if all(
+                succ in members
+                for objid in component
+                for succ in self.successors.get(objid, ())
+            ):
+                names = ", ".join(self._name(objid) for objid in component)
+                traps.append(
+                    self._diagnostic(
+                        component[0],
+                        "closed-cycle",
+                        f"The conversation can not leave the nodes {names}",
+                    )
+                )
+        return traps
+
+    def _components(self) -> List[List[str]]:
+        """Strongly connected components of the regular nodes (Tarjan's algorithm)"""
+        index: Dict[str, int] = {}
+        low: Dict[str, int] = {}
+        stack: List[str] = []
+        on_stack: Set[str] = set()
+        components = []
+        for root, node in self.plot["nodes"].items():
+            if root in index or node["type"] != "regular":
+                continue
+            # Iterative DFS, with the position in the successors of each node on it
+            work = [(root, 0)]
+            while work:
+                objid, i = work.pop()
+                if i == 0:
+                    index[objid] = low[objid] = len(index)
+                    stack.append(objid)
+                    on_stack.add(objid)
+                successors = self.successors.get(objid, [])
+                while i < len(successors):
+                    succ = successors[i]
+                    i += 1
+                    if succ not in index and self._regular(succ):
+                        work.append((objid, i))
+                        work.append((succ, 0))
+                        break
+                    if succ in on_stack:
+                        low[objid] = min(low[objid], index[succ])
+                else:
+                    if low[objid] == index[objid]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == objid:
+                                break
+                        components.append(component[::-1])
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[objid])
+        return components
+
+    def _name(self, objid: str) -> str:
+        node = self.plot["nodes"].get(objid, {})
+        return repr(node.get("name") or objid)
+
+    @staticmethod
+    def _diagnostic(
+        objid: str, code: str, message: str, node: Optional[str] = None
+    ) -> Diagnostic:
+        return {
+            "objid": objid,
+            "node": node or objid,
+            "severity": "warning",
+            "code": code,
+            "message": message,
+        }
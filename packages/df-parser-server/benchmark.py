@@ -0,0 +1,379 @@
+"""
+Benchmarks on synthetic scripts shaped like ``book_skill.py``.
+
+    python benchmark.py --sizes 10 100 1000 10000 50000 --depths 1 3 --out report.json
+
+For every script size (number of nodes) and nesting depth of the ``cnd.all`` /
+``cnd.any`` conditions, the server stages are timed in process: a cold ``parse_src``,
+a ``parse_src`` after a one line edit, ``put_obj`` (renaming a node), ``post_obj``
+(adding a node), the serialization of the plot with each encoding, the conversion of
+the plot to a graph and to its canonical form, the layout of the graph, both from
+scratch and updated after a transition was retargeted, and a ``parse_src`` of a
+document which was cooled down (see ``Document.cool``). With ``--editor``, the plots
+are also handed to ``editor/scripts/bench.mjs``, which times ``plotToGraph`` and
+``getLayout`` (this needs the editor dependencies installed).
+
+The report lists the best time of ``--repeat`` runs and the peak memory of every
+stage, plus a curve per stage and depth: the scaling exponent (slope of the log-log
+fit) and the largest size still under the interactive limit. Peak memory is that of
+the current process, parses done in the worker processes are not included.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import server
+from canonical import Canonicalizer
+from channel import ENCODINGS, FramedChannel
+from documents import DocumentStore
+from graph import build_graph
+from plot_parser import PlotParser
+
+# Stages slower than this (in seconds) are not interactive anymore
+INTERACTIVE = 0.1
+# Nodes per flow, ``book_skill.py`` has flows of 5 to 40 nodes
+FLOW_SIZE = 30
+
+EDITOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "editor")
+
+_HEADER = '''"""Synthetic skill generated by benchmark.py"""
+import logging
+
+import df_engine.conditions as cnd
+import df_engine.labels as lbl
+from df_engine.core.keywords import PROCESSING, TRANSITIONS, GLOBAL, RESPONSE
+from df_engine.core import Actor
+
+import common.dff.integration.condition as int_cnd
+import common.dff.integration.processing as int_prs
+import scenario.condition as loc_cnd
+import scenario.processing as loc_prs
+import scenario.response as loc_rsp
+from common.constants import CAN_CONTINUE_SCENARIO, MUST_CONTINUE
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIDENCE = 0.95
+
+'''
+
+_FOOTER = """
+
+actor = Actor(
+    flows,
+    start_label=("global_flow", "start"),
+    fallback_label=("global_flow", "fallback"),
+)
+"""
+
+_LEAVES = (
+    "loc_cnd.about_book",
+    "loc_cnd.asked_fav_book",
+    "int_cnd.is_yes_vars",
+    "int_cnd.is_no_vars",
+    'loc_cnd.check_flag("flag_{}")',
+    "loc_cnd.is_last_used_phrase(loc_rsp.ALL_QUESTIONS_ABOUT_BOOK)",
+    "cnd.neg(loc_cnd.book_in_request)",
+)
+
+
+def _condition(rng: random.Random, depth: int, indent: int) -> str:
+    """A condition with ``depth`` levels of ``cnd.all``/``cnd.any``, black formatted"""
+    if depth == 0:
+        return rng.choice(_LEAVES).format(rng.randrange(100))
+    pad = " " * indent
+    items = [_condition(rng, depth - 1, indent + 8) for _ in range(rng.randint(2, 3))]
+    body = "".join(f"{pad}        {item},\n" for item in items)
+    return (
+        f"{rng.choice(('cnd.all', 'cnd.any'))}(\n{pad}    [\n{body}{pad}    ]\n{pad})"
+    )
+
+
+def _label(rng: random.Random, i: int, nodes: int) -> str:
+    # Mostly forward edges inside the flow, like the branches of a real skill
+    if rng.random() < 0.7:
+        target = min(i + rng.randint(1, 3), nodes - 1)
+        if target // FLOW_SIZE == i // FLOW_SIZE:
+            return f'"node_{target}"'
+    target = rng.randrange(nodes)
+    return f'("flow_{target // FLOW_SIZE}", "node_{target}", {rng.choice((1, 1.5, 2))})'
+
+
+def _node(rng: random.Random, i: int, nodes: int, depth: int) -> str:
+    if i % 2:
+        response = f'"Response of node {i}, do you like reading?"'
+    else:
+        response = (
+            "loc_rsp.append_unused(\n"
+            f'                initial="Node {i}. ",\n'
+            "                phrases=loc_rsp.QUESTIONS_ABOUT_BOOKS,\n"
+            "            )"
+        )
+    lines = [f'        "node_{i}": {{', f"            RESPONSE: {response},"]
+    if i % 3 == 0:
+        lines += [
+            "            PROCESSING: {",
+            '                "set_confidence": '
+            "int_prs.set_confidence(DEFAULT_CONFIDENCE),",
+            f'                "set_flag": loc_prs.set_flag("node_{i}_visited"),',
+            "            },",
+        ]
+    lines.append("            TRANSITIONS: {")
+    for _ in range(rng.randint(1, 3)):
+        condition = _condition(rng, rng.randint(0, depth), 16)
+        lines.append(f"                {_label(rng, i, nodes)}: {condition},")
+    lines += ["            },", "        },"]
+    return "\n".join(lines)
+
+
+def generate(nodes: int, depth: int = 2, seed: int = 0) -> str:
+    """A dff script with ``nodes`` regular nodes (besides the global flow ones)"""
+    rng = random.Random(seed)
+    parts = [_HEADER, "flows = {", "    GLOBAL: {", "        TRANSITIONS: {"]
+    for _ in range(min(10, nodes)):
+        condition = _condition(rng, depth, 12)
+        parts.append(f"            {_label(rng, 0, nodes)}: {condition},")
+    parts += [
+        "        }",
+        "    },",
+        '    "global_flow": {',
+        '        "start": {RESPONSE: "", TRANSITIONS: {("flow_0", "node_0"): cnd.true()}},',
+        '        "fallback": {RESPONSE: "Let\'s talk about something else!"},',
+        "    },",
+    ]
+    for i in range(nodes):
+        if i % FLOW_SIZE == 0:
+            if i:
+                parts.append("    },")
+            parts.append(f'    "flow_{i // FLOW_SIZE}": {{')
+        parts.append(_node(rng, i, nodes, depth))
+    parts += ["    },", "}", _FOOTER]
+    return "\n".join(parts)
+
+
+def _measure(fn: Callable[[], Any], memory: bool) -> Dict[str, Any]:
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    result = {"seconds": seconds}
+    if memory:
+        result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+_loop = asyncio.new_event_loop()
+
+
+def _run(coro):
+    return _loop.run_until_complete(coro)
+
+
+def _stages(source: str, memory: bool) -> Dict[str, Dict[str, Any]]:
+    """Time every server stage once, on fresh state"""
+    # Empty caches, so that the first parse is really cold
+    server.parser = PlotParser()
+    server.documents = DocumentStore()
+    uri = "benchmark"
+    results = {}
+    results["parse_src"] = _measure(
+        lambda: _run(server.parse_src({"uri": uri, "source": source})), memory
+    )
+    doc = server.documents.get(uri)
+    plot = doc.store.plot
+
+    # A one line edit in the middle of the script
+    nodes = [objid for objid, n in plot["nodes"].items() if n["type"] == "regular"]
+    node = plot["nodes"][nodes[len(nodes) // 2]]
+    name = node["name"]
+    edited = source.replace(f"Response of node {name[5:]},", "Edited,", 1)
+    if edited == source:
+        edited = source.replace(f'initial="Node {name[5:]}. "', 'initial="Edited"', 1)
+    payload = {"uri": uri, "source": edited, "delta": True, "baseVersion": doc.version}
+    results["parse_src_edit"] = _measure(
+        lambda: _run(server.parse_src(payload)), memory
+    )
+
+    for encoding in ENCODINGS:
+        channel = FramedChannel(None, None, encoding)
+        reply = {"msgId": "benchmark", "payload": {"version": 1, "plot": plot}}
+        results[f"serialize_{encoding}"] = _measure(
+            lambda: channel.encode(reply), memory
+        )
+
+    results["graph"] = _measure(lambda: build_graph(plot), memory)
+    results["canonical"] = _measure(lambda: Canonicalizer(plot), memory)
+    results["layout"] = _measure(lambda: server.layout({"uri": uri}), memory)
+    _run(server.parse_src({"uri": uri, "source": _retarget(edited, name[5:])}))
+    since = {"uri": uri, "baseVersion": doc.layout_version}
+    results["layout_edit"] = _measure(lambda: server.layout(since), memory)
+
+    objid = nodes[len(nodes) // 3]
+    put = {"uri": uri, "objid": objid, "update": {"name": "renamed"}}
+    results["put_obj"] = _measure(lambda: _run(server.put_obj(put)), memory)
+    flow = next(iter(plot["flows"]))
+    post = {"uri": uri, "type": "node", "props": {"flow": flow}}
+    results["post_obj"] = _measure(lambda: _run(server.post_obj(post)), memory)
+
+    # The next parse of a document which was left alone for a while
+    server._cool(doc)
+    again = {"uri": uri, "source": edited, "delta": True, "baseVersion": doc.version}
+    results["parse_src_cooled"] = _measure(
+        lambda: _run(server.parse_src(again)), memory
+    )
+    return results
+
+
+def _retarget(source: str, node: str) -> str:
+    """Point the first transition of a node to the node itself"""
+    start = source.index(f'"node_{node}": {{')
+    start = source.index("TRANSITIONS: {", start) + len("TRANSITIONS: {")
+    start = source.index("\n", start) + 1
+    start += len(source[start:]) - len(source[start:].lstrip())
+    end = source.index(": ", start)
+    return f'{source[:start]}"node_{node}"{source[end:]}'
+
+
+def _editor_stages(plots: Dict[str, str], repeat: int) -> Dict[str, dict]:
+    """Run the editor benchmark on the plots (file name -> case), by case"""
+    out = subprocess.run(
+        ["node", "--expose-gc", os.path.join("scripts", "bench.mjs")]
+        + ["--repeat", str(repeat)]
+        + list(plots),
+        cwd=EDITOR_DIR,
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+    results: Dict[str, dict] = {}
+    for row in json.loads(out):
+        results.setdefault(plots[row["file"]], {})[row["stage"]] = row
+    return results
+
+
+def _curves(results: List[dict]) -> List[dict]:
+    curves: Dict[tuple, dict] = {}
+    for row in sorted(results, key=lambda row: row["nodes"]):
+        curve = curves.setdefault(
+            (row["stage"], row["depth"]),
+            {"stage": row["stage"], "depth": row["depth"], "nodes": [], "seconds": []},
+        )
+        curve["nodes"].append(row["nodes"])
+        curve["seconds"].append(row["seconds"])
+    for curve in curves.values():
+        points = [
+            (math.log(n), math.log(s))
+            for n, s in zip(curve["nodes"], curve["seconds"])
+            if s > 0
+        ]
+        curve["exponent"] = _slope(points)
+        interactive = [
+            n for n, s in zip(curve["nodes"], curve["seconds"]) if s <= INTERACTIVE
+        ]
+        curve["interactive_until"] = max(interactive, default=None)
+    return list(curves.values())
+
+
+def _slope(points) -> Optional[float]:
+    if len(points) < 2:
+        return None
+    mx = sum(x for x, _ in points) / len(points)
+    my = sum(y for _, y in points) / len(points)
+    var = sum((x - mx) ** 2 for x, _ in points)
+    if not var:
+        return None
+    return round(sum((x - mx) * (y - my) for x, y in points) / var, 3)
+
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    ap.add_argument("--depths", type=int, nargs="+", default=[1, 3])
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--editor", action="store_true", help="also time the editor")
+    ap.add_argument("--out", default="-", help="report file, - for stdout")
+    args = ap.parse_args(argv)
+
+    results = []
+    plots: Dict[str, tuple] = {}
+    tmp = tempfile.mkdtemp(prefix="df-benchmark-")
+    with ProcessPoolExecutor(server.WORKERS) as executor:
+        server.dispatcher.executor = executor
+        for nodes in args.sizes:
+            for depth in args.depths:
+                source = generate(nodes, depth, args.seed)
+                runs = [_stages(source, memory=False) for _ in range(args.repeat)]
+                peaks = _stages(source, memory=True)
+                for stage, peak in peaks.items():
+                    results.append(
+                        {
+                            "stage": stage,
+                            "nodes": nodes,
+                            "depth": depth,
+                            "chars": len(source),
+                            "seconds": min(run[stage]["seconds"] for run in runs),
+                            "peak_bytes": peak["peak_bytes"],
+                        }
+                    )
+                    print(
+                        f"{stage:>20} {nodes:>6} nodes, depth {depth}: "
+                        f"{results[-1]['seconds'] * 1000:10.2f} ms",
+                        file=sys.stderr,
+                    )
+                if args.editor:
+                    path = os.path.join(tmp, f"plot_{nodes}_{depth}.json")
+                    with open(path, "w") as f:
+                        json.dump(server.documents.get("benchmark").store.plot, f)
+                    plots[path] = (nodes, depth, len(source))
+
+    if args.editor:
+        for (nodes, depth, chars), stages in _editor_stages(plots, args.repeat).items():
+            for stage, row in stages.items():
+                results.append(
+                    {
+                        "stage": stage,
+                        "nodes": nodes,
+                        "depth": depth,
+                        "chars": chars,
+                        "seconds": row["seconds"],
+                        "peak_bytes": row["peak_bytes"],
+                    }
+                )
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "workers": server.WORKERS,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "interactive": INTERACTIVE,
+        },
+        "results": results,
+        "curves": _curves(results),
+    }
+    if args.out == "-":
+        json.dump(report, sys.stdout, indent=2)
+    else:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Canonical form of a plot, with identical linking objects merged.
+
+Scripts call the same conditions and responses over and over (``cnd.true()``,
+``int_cnd.is_yes_vars``...), and the parser gives every call its own linking object.
+Here linking objects calling the same object with the same arguments, once their own
+arguments are merged, become a single entry whose id is derived from its content, so
+that the same call gets the same id in every parse. The transitions, responses and
+processings refer to the entries instead, and the entries have no ``parent`` (they may
+have several). The linking objects each entry stands for are kept, they are where the
+entry is in the source.
+
+Like the graph, the canonical plot is kept up to date from the deltas of the plot: only
+the changed objects, and those using linking objects now merged differently, are
+converted again.
+"""
+
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+from plot_parser import TABLES, Plot, named_id
+from plot_store import linking_refs
+
+Record = Dict[str, Any]
+
+
+class Canonicalizer:
+    """Canonical plot of a plot, updated from its deltas (see ``PlotStore.delta``)"""
+
+    def __init__(self, plot: Plot):
+        self.tables: Dict[str, Dict[str, Record]] = {table: {} for table in TABLES}
+        # Objects changed since the last delta, with their record then
+        self.touched: Dict[str, Tuple[str, Optional[Record]]] = {}
+        self.reset(plot)
+
+    def reset(self, plot: Plot) -> None:
+        """Convert another plot in full, eg. the same one parsed again"""
+        self.plot = plot
+        for table, objects in self.tables.items():
+            for objid, record in objects.items():
+                self.touched.setdefault(objid, (table, record))
+        self.tables = {table: {} for table in TABLES}
+        # Entry of each linking object, and the linking objects of each entry
+        self.entry_of: Dict[str, str] = {}
+        self.members: Dict[str, Dict[str, None]] = {}
+        # Content of each entry, and the entry with each content
+        self.keys: Dict[str, str] = {}
+        self.entries: Dict[str, str] = {}
+        # Linking objects used by each object, and the objects (and their table) using
+        # each linking object
+        self.refs: Dict[str, List[str]] = {}
+        self.users: Dict[str, Dict[str, str]] = {}
+        others = {
+            objid: table
+            for table in TABLES
+            if table != "linking"
+            for objid in plot[table]
+        }
+        self._convert(dict.fromkeys(plot["linking"]), others)
+
+    def canonical_plot(self) -> Plot:
+        return dict(self.tables)
+
+    def update(self, delta: dict) -> None:
+        """Convert again the objects affected by a delta of the plot"""
+        links: Dict[str, None] = {}
+        others: Dict[str, str] = {}
+        for table, changes in delta.items():
+            for objid in (*changes["added"], *changes["changed"], *changes["removed"]):
+                if table == "linking":
+                    links[objid] = None
+                else:
+                    others[objid] = table
+        self._convert(links, others)
+
+    def delta(self) -> dict:
+        """Added, removed and changed objects of each table since the last delta"""
+        delta: Dict[str, Dict[str, Any]] = {}
+        for objid, (table, old) in self.touched.items():
+            record = self.tables[table].get(objid)
+            if record is old or (old is not None and record == old):
+                continue
+            changes = delta.setdefault(
+                table, {"added": {}, "removed": [], "changed": {}}
+            )
+            if record is None:
+                changes["removed"].append(objid)
+            elif old is None:
+                changes["added"][objid] = record
+            else:
+                changes["changed"][objid] = record
+        self.touched = {}
+        return delta
+
+    def locations(self, objid: str) -> List[str]:
+        """Linking objects of the plot merged into an entry"""
+        return list(self.members.get(objid, ()))
+
+    def _convert(self, links: Dict[str, None], others: Dict[str, str]) -> None:
+        while links:
+            self._link(links.popitem()[0], links, others)
+        for objid, table in others.items():
+            record = self.plot[table].get(objid)
+            if self._use(objid, table, record):
+                record = self._value(record)
+            self._set(table, objid, record)
+
+    def _link(self, objid: str, links: Dict[str, None], others: Dict[str, str]) -> None:
+        """Merge a linking object into its entry, after the linking objects it uses"""
+        record = self.plot["linking"].get(objid)
+        old = self.entry_of.pop(objid, None)
+        entry = None
+        if record is not None:
+            for ref in self._use(objid, "linking", record):
+                if ref in links:
+                    del links[ref]
+                    self._link(ref, links, others)
+            entry = self._entry(
+                {key: self._value(v) for key, v in record.items() if key != "parent"}
+            )
+            self.entry_of[objid] = entry
+            self.members[entry][objid] = None
+        else:
+            self._use(objid, "linking", None)
+        if old == entry:
+            return
+        if old is not None:
+            members = self.members[old]
+            del members[objid]
+            if not members:
+                del self.members[old]
+                del self.entries[self.keys.pop(old)]
+                self._set("linking", old, None)
+        for user, table in self.users.get(objid, {}).items():
+            if table == "linking":
+                links[user] = None
+            else:
+                others[user] = table
+
+    def _entry(self, record: Record) -> str:
+        """Id of the entry with the given content, created if needed"""
+        key = json.dumps(record)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = named_id("linking", key)
+            collisions = 0
+            while entry in self.keys:
+                collisions += 1
+                entry = named_id("linking", key, str(collisions))
+            self.entries[key] = entry
+            self.keys[entry] = key
+            self.members[entry] = {}
+            self._set("linking", entry, record)
+        return entry
+
+    def _value(self, value: Any) -> Any:
+        if isinstance(value, str):
+            return self.entry_of.get(value, value)
+        if isinstance(value, list):
+            return [self._value(item) for item in value]
+        if isinstance(value, dict):
+            return {key: self._value(item) for key, item in value.items()}
+        return value
+
+    def _use(self, objid: str, table: str, record: Optional[Record]) -> List[str]:
+        """Update the linking objects an object uses, and return them"""
+        for ref in self.refs.pop(objid, ()):
+            users = self.users[ref]
+            del users[objid]
+            if not users:
+                del self.users[ref]
+        refs = list(dict.fromkeys(linking_refs(record))) if record is not None else []
+        if refs:
+            self.refs[objid] = refs
+            for ref in refs:
+                self.users.setdefault(ref, {})[objid] = table
+        return refs
+
+    def _set(self, table: str, objid: str, record: Optional[Record]) -> None:
+        objects = self.tables[table]
+        old = objects.get(objid)
+        if old is record:
+            return
+        if objid not in self.touched:
+            self.touched[objid] = (table, old)
+        if record is None:
+            del objects[objid]
+        else:
+            objects[objid] = record
@@ -0,0 +1,136 @@
+"""
+Transports between the server and the parent process (or the clients of a socket).
+
+By default messages are newline-delimited JSON. With a ``handshake`` message the
+parent can switch to length-prefixed frames: a 4 byte big-endian length followed by
+the message, encoded with JSON or (if installed) MessagePack.
+
+Replies are buffered and written out together once the event loop is idle, so a
+burst of replies costs a single write.
+"""
+
+import asyncio
+import json
+import struct
+from typing import BinaryIO, List, Optional, Union
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ENCODINGS = ("json", "msgpack") if msgpack is not None else ("json",)
+
+_HEADER = struct.Struct(">I")
+
+
+def _dump_json(msg: dict) -> bytes:
+    return json.dumps(msg, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class StreamOut:
+    """Output of a channel to a socket, written out by the event loop"""
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+
+    def write(self, data: bytes) -> None:
+        # Replies to the messages of a client which disconnected are dropped
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def flush(self) -> None:
+        pass
+
+
+class Channel:
+    """Newline-delimited JSON, the fallback when no handshake was made"""
+
+    framing = "lines"
+    encoding = "json"
+
+    def __init__(self, reader: asyncio.StreamReader, out: Union[BinaryIO, StreamOut]):
+        self.reader = reader
+        self.out = out
+        self.pending: List[bytes] = []
+
+    async def receive(self) -> Optional[dict]:
+        """Next message, ``None`` once the input is closed"""
+        data = await self.read()
+        return self.decode(data) if data is not None else None
+
+    async def read(self) -> Optional[bytes]:
+        """The next message, still encoded"""
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return None
+            if line.strip():
+                return line
+
+    def decode(self, data: bytes) -> dict:
+        return json.loads(data)
+
+    def encode(self, msg: dict) -> bytes:
+        return _dump_json(msg) + b"\n"
+
+    def send(self, msg: dict) -> int:
+        """Queue a message to be written, return its encoded size"""
+        if not self.pending:
+            asyncio.get_running_loop().call_soon(self.flush)
+        data = self.encode(msg)
+        self.pending.append(data)
+        return len(data)
+
+    def flush(self) -> None:
+        if self.pending:
+            self.out.write(b"".join(self.pending))
+            self.out.flush()
+            self.pending.clear()
+
+    def upgrade(self, framing: str, encoding: str) -> "Channel":
+        """
+        The channel to use after a handshake. Unsupported options fall back to the
+        line-delimited JSON.
+        """
+        if framing != "length":
+            return self
+        if encoding not in ENCODINGS:
+            encoding = "json"
+        return FramedChannel(self.reader, self.out, encoding)
+
+
+class FramedChannel(Channel):
+    framing = "length"
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        out: Union[BinaryIO, StreamOut],
+        encoding: str,
+    ):
+        super().__init__(reader, out)
+        self.encoding = encoding
+        if encoding == "msgpack":
+            self.dump = msgpack.Packer(use_bin_type=True).pack
+            self.load = lambda data: msgpack.unpackb(data, raw=False)
+        else:
+            self.dump = _dump_json
+            self.load = json.loads
+
+    async def read(self) -> Optional[bytes]:
+        try:
+            header = await self.reader.readexactly(_HEADER.size)
+            (length,) = _HEADER.unpack(header)
+            return await self.reader.readexactly(length)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            return None
+
+    def decode(self, data: bytes) -> dict:
+        return self.load(data)
+
+    def encode(self, msg: dict) -> bytes:
+        body = self.dump(msg)
+        return _HEADER.pack(len(body)) + body
@@ -0,0 +1,121 @@
+"""
+Compact form of a plot, kept for the documents nobody is working on.
+
+In the ``Plot`` format every record is a dict, and the same ids are repeated as strings
+in several tables (a linking id in ``transitions.condition``, ``linking.parent`` and
+``linking.args``...). Here every string and number of the plot is stored once and
+referred to by an integer handle, and each table is three flat arrays: the handle of
+the id of every record, where every record starts, and the records themselves encoded
+as handles one after the other. There is no Python object per record, so a plot takes
+a fraction of the memory, and it is converted back to the ``Plot`` format only when it
+is sent or the document is worked on again.
+"""
+
+from array import array
+from typing import Any, Dict, Iterator, List, Tuple
+
+from plot_parser import TABLES, Plot
+
+# Every item of the encoded records is a handle (or a length) shifted left by two, with
+# the kind of value in the low bits
+_SCALAR = 0
+_LIST = 1
+_DICT = 2
+_KIND = 3
+
+
+class _Interner:
+    """Integer handles of strings and numbers, each value is stored once"""
+
+    def __init__(self):
+        # Numbers are keyed by type too, so that eg. ``1`` and ``1.0`` stay apart
+        self.handles: Dict[Any, int] = {}
+
+    @property
+    def values(self) -> List[Any]:
+        return [key if key.__class__ is str else key[1] for key in self.handles]
+
+    def handle(self, value: Any) -> int:
+        handles = self.handles
+        key = value if value.__class__ is str else (value.__class__, value)
+        return handles.setdefault(key, len(handles))
+
+    def encode(self, value: Any, out: List[int]) -> None:
+        if value.__class__ is str:
+            handles = self.handles
+            out.append(handles.setdefault(value, len(handles)) << 2)
+        elif isinstance(value, dict):
+            out.append(len(value) << 2 | _DICT)
+            for key, item in value.items():
+                out.append(self.handle(key) << 2)
+                self.encode(item, out)
+        elif isinstance(value, list):
+            out.append(len(value) << 2 | _LIST)
+            for item in value:
+                self.encode(item, out)
+        else:
+            out.append(self.handle(value) << 2)
+
+
+def _decode(data: array, pos: int, values: List[Any]) -> Tuple[Any, int]:
+    """The value encoded at ``pos``, and the position after it"""
+    item = data[pos]
+    pos += 1
+    kind = item & _KIND
+    if kind == _SCALAR:
+        return values[item >> 2], pos
+    if kind == _LIST:
+        items = []
+        for _ in range(item >> 2):
+            value, pos = _decode(data, pos, values)
+            items.append(value)
+        return items, pos
+    record = {}
+    for _ in range(item >> 2):
+        key = values[data[pos] >> 2]
+        record[key], pos = _decode(data, pos + 1, values)
+    return record, pos
+
+
+class _Table:
+    __slots__ = ("ids", "starts", "data")
+
+    def __init__(self, ids: List[int], starts: List[int], data: List[int]):
+        self.ids = array("I", ids)
+        self.starts = array("I", starts)
+        self.data = array("I", data)
+
+
+class CompactPlot:
+    """A plot stored as interned values and flat arrays, see the module docstring"""
+
+    def __init__(self, values: List[Any], tables: Dict[str, _Table]):
+        self.values = values
+        self.tables = tables
+
+    @classmethod
+    def from_plot(cls, plot: Plot) -> "CompactPlot":
+        interner = _Interner()
+        tables = {}
+        for name in TABLES:
+            ids: List[int] = []
+            starts: List[int] = []
+            data: List[int] = []
+            for objid, record in plot.get(name, {}).items():
+                ids.append(interner.handle(objid))
+                starts.append(len(data))
+                interner.encode(record, data)
+            tables[name] = _Table(ids, starts, data)
+        return cls(interner.values, tables)
+
+    def records(self, table: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Id and record of every object of a table, in the order of the plot"""
+        values = self.values
+        columns = self.tables[table]
+        data = columns.data
+        for handle, start in zip(columns.ids, columns.starts):
+            yield values[handle], _decode(data, start, values)[0]
+
+    def to_plot(self) -> Plot:
+        """The plot in the format sent to the parent process"""
+        return {table: dict(self.records(table)) for table in TABLES}
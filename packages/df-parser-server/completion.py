@@ -0,0 +1,348 @@
+"""
+Suggestions for the autocompletion of the editor (``AutocompArgs`` and
+``SuggestionData`` in ``editor/src/types.ts``).
+
+The terms of a plot are the names of the functions called by conditions and
+processings (and by responses), the names of flows and regular nodes, and the response
+strings. Each kind of term has its own trie, keyed by the lowercase term from each of
+its word starts (so ``book`` finds ``loc_cnd.about_book``), and every trie node keeps
+the terms below it used the most, computed again only when a term below it changed.
+A trigram index finds the terms which do not start with the input but are close to
+it (eg. with a typo), when there are not enough of the others.
+
+Like the graph, the terms are kept up to date from the deltas of the plot: the terms
+of an object (eg. a transition) are only collected again when it, or the linking
+objects and py_defs it uses, changed. Results are cached until the terms change.
+"""
+
+import heapq
+import math
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from plot_parser import Plot
+
+KINDS = ("condition", "processing", "response", "flow", "node")
+# Candidates kept by each trie node, more than that are searched for when asked for
+TOP = 32
+# Characters from each word start of a term which are indexed, longer inputs are
+# matched against the terms found for their start
+KEY_LENGTH = 16
+MAX_WORDS = 8
+# Characters of a term whose trigrams are indexed
+FUZZY_LENGTH = 32
+# Trigrams a term must share with the input, as a fraction of those of the input
+MIN_SIMILARITY = 0.6
+CACHE_SIZE = 1024
+
+# Scores go from -inf to 0: prefixes of the term, then of one of its words, then the
+# terms close to the input, each by the fraction of the term given and how often it
+# is used
+_PREFIX = 0.0
+_WORD = -1.0
+_FUZZY = -2.0
+
+_WORD_START = re.compile(r"(?:^|(?<=[\W_])|(?<=[a-z])(?=[A-Z]))\w", re.UNICODE)
+# Objects whose terms are collected, the others are only used by them
+_OWNERS = ("flows", "nodes", "responses", "transitions", "processings")
+
+Term = Tuple[str, str]
+Owner = Tuple[str, str]
+
+
+def _changed_ids(delta: dict, table: str) -> Iterator[str]:
+    changes = delta.get(table)
+    if changes:
+        yield from changes["added"]
+        yield from changes["changed"]
+        yield from changes["removed"]
+
+
+def _keys(text: str) -> List[str]:
+    """Keys of a term in its trie: the term from each word start, lowercase"""
+    starts = [m.start() for m in _WORD_START.finditer(text)][:MAX_WORDS]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    return list(dict.fromkeys(text[i : i + KEY_LENGTH].lower() for i in starts))
+
+
+def _trigrams(text: str) -> Set[str]:
+    text = text[:FUZZY_LENGTH].lower()
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class _TrieNode:
+    __slots__ = ("children", "terms", "best")
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        self.terms: Set[Term] = set()
+        # Terms below used the most, None until asked for again
+        self.best: Optional[List[Term]] = None
+
+
+class CompletionIndex:
+    """Terms of a plot, updated from its deltas (see ``PlotStore.delta``)"""
+
+    def __init__(self, plot: Plot):
+        self.reset(plot)
+
+    def reset(self, plot: Plot) -> None:
+        """Index another plot in full, eg. the same one parsed again"""
+        self.plot = plot
+        self.tries = {kind: _TrieNode() for kind in KINDS}
+        self.trigrams: Dict[str, Set[Term]] = {}
+        # Objects using each term, and the terms and the linking objects and py_defs
+        # used by each object
+        self.uses: Dict[Term, int] = {}
+        self.terms: Dict[Owner, List[Term]] = {}
+        self.deps: Dict[Owner, Set[str]] = {}
+        self.dependents: Dict[str, Set[Owner]] = {}
+        self._cache: Dict[tuple, List[dict]] = {}
+        # Kinds whose tries were searched, the candidates of their nodes are kept
+        self._ranked: Set[str] = set()
+        for table in _OWNERS:
+            for objid in plot[table]:
+                self._build((table, objid))
+        # Rank the candidates now rather than on the first (short) input
+        for kind, trie in self.tries.items():
+            self._best(trie)
+            self._ranked.add(kind)
+
+    def update(self, delta: dict) -> None:
+        """Collect again the terms of the objects affected by a delta of the plot"""
+        dirty: Dict[Owner, None] = {}
+        for table in _OWNERS:
+            dirty.update(
+                dict.fromkeys((table, objid) for objid in _changed_ids(delta, table))
+            )
+        for table in ("linking", "py_defs"):
+            for objid in _changed_ids(delta, table):
+                dirty.update(dict.fromkeys(self.dependents.get(objid, ())))
+        for owner in dirty:
+            self._build(owner)
+
+    def complete(
+        self, text: str, kinds: Optional[Iterable[str]] = None, limit: int = 10
+    ) -> List[Dict[str, Any]]:
+        """The ``limit`` best suggestions for an input, of some kinds of terms"""
+        kinds = tuple(KINDS if kinds is None else (k for k in KINDS if k in kinds))
+        key = (text, kinds, limit)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+        query = text.lower()
+        short = len(query) <= KEY_LENGTH
+        scored: Dict[Term, float] = {}
+        for kind in kinds:
+            node = self._find(self.tries[kind], query[:KEY_LENGTH])
+            if node is None:
+                continue
+            self._ranked.add(kind)
+            if short and limit <= TOP:
+                candidates: Iterable[Term] = self._best(node)
+            else:
+                candidates = self._below(node)
+            for term in candidates:
+                if short or query in term[1].lower():
+                    scored[term] = self._score(term, query)
+        if len(scored) < limit and len(query) >= 3:
+            scored.update(self._fuzzy(query, kinds, scored, limit))
+        best = heapq.nlargest(limit, scored.items(), key=lambda item: item[1])
+        results = [
+            {"type": kind, "value": value, "score": round(score, 4)}
+            for (kind, value), score in best
+        ]
+        if len(self._cache) >= CACHE_SIZE:
+            self._cache.clear()
+        self._cache[key] = results
+        return results
+
+    def _score(self, term: Term, query: str) -> float:
+        value = term[1]
+        base = _PREFIX if value.lower().startswith(query) else _WORD
+        # Between -0.75 and 0
+        given = min(len(query), len(value)) / max(len(value), 1)
+        return base - 0.5 * (1 - given) - 0.25 / self.uses[term]
+
+    def _fuzzy(
+        self, query: str, kinds: Tuple[str, ...], found: Dict[Term, float], limit: int
+    ) -> Dict[Term, float]:
+        postings = sorted(
+            (self.trigrams.get(gram, set()) for gram in _trigrams(query)), key=len
+        )
+        need = math.ceil(len(postings) * MIN_SIMILARITY)
+        # A term sharing enough trigrams is in one of the rarest ones
+        candidates = set().union(*postings[: len(postings) - need + 1])
+        matches = []
+        for term in candidates:
+            if term[0] in kinds and term not in found:
+                shared = sum(term in terms for terms in postings)
+                if shared >= need:
+                    matches.append((shared, self.uses[term], term))
+        scored = {}
+        # Only the closest ones can make it to the suggestions
+        for shared, _, term in heapq.nlargest(limit, matches):
+            similarity = shared / len(postings)
+            # Between -0.75 and 0, the term does not start with the input
+            rest = self._score(term, query) - _WORD
+            scored[term] = _FUZZY - 0.5 * (1 - similarity) + rest / 2
+        return scored
+
+    @staticmethod
+    def _find(node: _TrieNode, key: str) -> Optional[_TrieNode]:
+        for char in key:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+    def _best(self, node: _TrieNode) -> List[Term]:
+        if node.best is None and not node.terms and len(node.children) == 1:
+            # Most nodes are in a chain of the characters of a single key
+            (child,) = node.children.values()
+            node.best = self._best(child)
+        elif node.best is None:
+            candidates = set(node.terms)
+            for child in node.children.values():
+                candidates.update(self._best(child))
+            node.best = heapq.nlargest(TOP, candidates, key=self._rank)
+        return node.best
+
+    def _below(self, node: _TrieNode) -> Set[Term]:
+        terms: Set[Term] = set()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            terms.update(node.terms)
+            stack.extend(node.children.values())
+        return terms
+
+    def _rank(self, term: Term) -> Tuple[int, int]:
+        # Shorter terms first, they are more likely to be what is typed
+        return self.uses[term], -len(term[1])
+
+    def _build(self, owner: Owner) -> None:
+        """Collect the terms of an object (again)"""
+        for term in self.terms.pop(owner, ()):
+            self.uses[term] -= 1
+            if self.uses[term]:
+                self._touch(term)
+            else:
+                self._remove(term)
+        for objid in self.deps.pop(owner, ()):
+            users = self.dependents[objid]
+            users.discard(owner)
+            if not users:
+                del self.dependents[objid]
+        table, objid = owner
+        obj = self.plot[table].get(objid)
+        if obj is None:
+            return
+        terms: List[Term] = []
+        deps: Set[str] = set()
+        if table in ("flows", "nodes"):
+            if obj.get("name") and obj.get("type", "regular") == "regular":
+                terms.append((table[:-1], obj["name"]))
+        elif table == "responses":
+            response = obj["response_object"]
+            if response.startswith("id#"):
+                self._calls("response", response, terms, deps)
+            elif response:
+                terms.append(("response", response))
+        elif table == "transitions":
+            self._calls("condition", obj["condition"], terms, deps)
+        else:
+            for item in obj["items"]:
+                for value in item.values():
+                    self._calls("processing", value, terms, deps)
+        # A term used twice by an object is suggested once
+        terms = list(dict.fromkeys(terms))
+        for term in terms:
+            self.uses[term] = self.uses.get(term, 0) + 1
+            if self.uses[term] == 1:
+                self._insert(term)
+            else:
+                self._touch(term)
+        self.terms[owner] = terms
+        self.deps[owner] = deps
+        for dep in deps:
+            self.dependents.setdefault(dep, set()).add(owner)
+        self._cache.clear()
+
+    def _calls(
+        self,
+        kind: str,
+        value: Any,
+        terms: List[Term],
+        deps: Set[str],
+        listed: bool = True,
+    ) -> None:
+        """
+        Terms of the functions called by a value: the function a linking object calls,
+        and the ones called or listed in its arguments (eg. ``cnd.any([...])``). Other
+        py_defs given as arguments (eg. ``re.I``) are left out.
+        """
+        if isinstance(value, list):
+            for element in value:
+                self._calls(kind, element, terms, deps)
+        elif isinstance(value, dict):
+            for element in value.values():
+                self._calls(kind, element, terms, deps, False)
+        elif isinstance(value, str) and value.startswith("id#ln"):
+            link = self.plot["linking"].get(value)
+            deps.add(value)
+            if link is None:
+                return
+            self._calls(kind, link["object"], terms, deps)
+            for arg in link.get("args", ()):
+                self._calls(kind, arg, terms, deps, False)
+            for arg in link.get("kwargs", {}).values():
+                self._calls(kind, arg, terms, deps, False)
+        elif listed and isinstance(value, str) and value.startswith("id#df"):
+            deps.add(value)
+            py_def = self.plot["py_defs"].get(value)
+            if py_def is not None:
+                terms.append((kind, py_def["name"]))
+
+    def _insert(self, term: Term) -> None:
+        for key in _keys(term[1]):
+            node = self.tries[term[0]]
+            node.best = None
+            for char in key:
+                node = node.children.setdefault(char, _TrieNode())
+                node.best = None
+            node.terms.add(term)
+        for gram in _trigrams(term[1]):
+            self.trigrams.setdefault(gram, set()).add(term)
+
+    def _touch(self, term: Term) -> None:
+        """Rank the candidates of the nodes above a term again, its uses changed"""
+        if term[0] not in self._ranked:
+            return
+        for key in _keys(term[1]):
+            node = self.tries[term[0]]
+            node.best = None
+            for char in key:
+                node = node.children[char]
+                node.best = None
+
+    def _remove(self, term: Term) -> None:
+        del self.uses[term]
+        for key in _keys(term[1]):
+            path = [self.tries[term[0]]]
+            for char in key:
+                path.append(path[-1].children[char])
+            path[-1].terms.discard(term)
+            for node in path:
+                node.best = None
+            # Drop the nodes left without terms
+            for parent, char, node in zip(path[-2::-1], key[::-1], path[:0:-1]):
+                if node.terms or node.children:
+                    break
+                del parent.children[char]
+        for gram in _trigrams(term[1]):
+            terms = self.trigrams[gram]
+            terms.discard(term)
+            if not terms:
+                del self.trigrams[gram]
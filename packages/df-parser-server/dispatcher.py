@@ -0,0 +1,344 @@
+"""
+Asyncio message loop of the server.
+
+Messages are handled concurrently and replied to as soon as they are done, the parent
+process matches the replies to the messages by ``msgId``. Messages concerning the same
+document (``payload.uri``) are still handled one after the other, in the order they
+were received.
+
+Consecutive messages of a coalescing kind (eg. ``parse_src``) for the same document
+replace each other: the older one is cancelled and replied to with
+``"superseded": true``. A message can also set ``payload.deadline``, the number of
+milliseconds after which it is answered with an error instead.
+
+The time spent on each message is recorded in ``Dispatcher.metrics``, see ``metrics``,
+and messages can be profiled with ``Dispatcher.profiler``, see ``profiling``.
+
+The parent process talks to the server over stdin and stdout, or several clients (eg.
+the extension of each window, and Dream Builder) connect to it over a socket, see
+``Dispatcher.listen``. Every connection is a ``Session`` with its own transport, and
+the replies go to the session of the message. The documents and caches are shared,
+so messages about the same document are still handled in order whatever their session,
+and the versions of the plots sent are numbered per document: a client only gets a
+delta if the last reply about the document went to it (see ``Document.version``).
+"""
+
+import asyncio
+import contextvars
+import os
+import socket
+import sys
+import time
+import traceback
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, Iterable, Optional, Set, Tuple, Type
+
+from channel import Channel, StreamOut
+from metrics import Metrics, Sample
+from profiling import Profiler
+
+# A handler takes the payload of the message and returns the payload of the reply.
+# Coroutine handlers can offload work to the executor, plain functions are run inline
+# and should be cheap.
+Handler = Callable[[dict], Any]
+
+# Messages can be as large as the whole source of a script
+LINE_LIMIT = 2**30
+
+
+class Superseded(Exception):
+    """Raised by handlers when the message is outdated, eg. an old version of a document"""
+
+
+class Session:
+    """A client of the server, and what the server keeps about it"""
+
+    def __init__(self, channel: Optional[Channel] = None):
+        self.channel = channel
+        # Version of the text of each document (as numbered by the editor of the client)
+        # of its last parse
+        self.document_versions: Dict[str, int] = {}
+
+
+# Session of the message handled by the current task, messages handled outside of the
+# dispatcher (eg. in tests) share a default one
+_session: contextvars.ContextVar[Session] = contextvars.ContextVar(
+    "session", default=Session()
+)
+
+
+def session() -> Session:
+    """The session of the message being handled"""
+    return _session.get()
+
+
+class _Tail:
+    """The last message of a document"""
+
+    def __init__(self, name: str, session: Session, after: Optional[asyncio.Task]):
+        self.name = name
+        self.session = session
+        # The task of the previous message, which has to finish first
+        self.after = after
+        self.task: Optional[asyncio.Task] = None
+
+
+class Dispatcher:
+    def __init__(
+        self,
+        handlers: Dict[str, Handler],
+        errors: Tuple[Type[Exception], ...] = (),
+        executor: Optional[Executor] = None,
+        coalesce: Iterable[str] = (),
+    ):
+        self.handlers = handlers
+        # Exceptions reported to the parent process instead of crashing the server
+        self.errors = errors
+        self.executor = executor
+        # Messages superseded by a newer message of the same kind for the same document
+        self.coalesce = set(coalesce)
+        # Last task of each document
+        self.tails: Dict[str, _Tail] = {}
+        self.sessions: Set[Session] = set()
+        self.metrics = Metrics()
+        self.profiler = Profiler()
+
+    async def run_in_executor(self, fn: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, fn, *args
+        )
+
+    async def serve(self) -> None:
+        """Handle messages from stdin until it is closed, replying on stdout"""
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=LINE_LIMIT)
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
+        )
+        session = Session(Channel(reader, sys.stdout.buffer))
+        await self._serve(session)
+        if self.tails:
+            tasks = [tail.task for tail in self.tails.values()]
+            await asyncio.gather(*tasks, return_exceptions=True)
+        session.channel.flush()
+
+    async def listen(self, path: str, idle: Optional[float] = None) -> None:
+        """
+        Handle the messages of the clients connecting to a Unix socket, until no client
+        was connected for ``idle`` seconds. Return at once if another server is already
+        listening on the socket. Only the user running the server can connect to it.
+        """
+        loop = asyncio.get_running_loop()
+        stopped = loop.create_future()
+        timer: Optional[asyncio.TimerHandle] = None
+
+        def schedule_stop() -> None:
+            nonlocal timer
+            if idle is not None and not self.sessions:
+                timer = loop.call_later(
+                    idle, lambda: stopped.done() or stopped.set_result(None)
+                )
+
+        async def connected(
+            reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+        ) -> None:
+            if timer is not None:
+                timer.cancel()
+            session = Session(Channel(reader, StreamOut(writer)))
+            self.sessions.add(session)
+            try:
+                await self._serve(session)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                # The messages still being handled are replied to nobody
+                self.sessions.discard(session)
+                session.channel.flush()
+                writer.close()
+                schedule_stop()
+
+        if _listening(path):
+            return
+        if os.path.exists(path):
+            # Left by a server which did not stop cleanly
+            os.unlink(path)
+        # Made private as it is created, not after, when others could have connected
+        umask = os.umask(0o077)
+        try:
+            server = await asyncio.start_unix_server(connected, path, limit=LINE_LIMIT)
+        finally:
+            os.umask(umask)
+        schedule_stop()
+        try:
+            async with server:
+                await stopped
+            if self.tails:
+                tasks = [tail.task for tail in self.tails.values()]
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    async def _serve(self, session: Session) -> None:
+        """Handle the messages of a session until its input is closed"""
+        while True:
+            data = await session.channel.read()
+            if data is None:
+                break
+            start = time.perf_counter()
+            try:
+                msg = session.channel.decode(data)
+            except Exception as e:
+                # Whatever the decoder raises on a broken frame, the next ones are fine
+                self._reject(session, None, f"Invalid message: {e!r}")
+                continue
+            decode = time.perf_counter() - start
+            if not (
+                isinstance(msg, dict)
+                and "id" in msg
+                and isinstance(msg.get("name"), str)
+                and isinstance(msg.get("payload", {}), dict)
+            ):
+                msgid = msg.get("id") if isinstance(msg, dict) else None
+                self._reject(
+                    session, msgid, "Invalid message: expected an id and a name"
+                )
+                continue
+            if msg["name"] == "handshake":
+                self.handshake(msg, session)
+            else:
+                sample = self.metrics.start(msg["name"], len(data), decode)
+                self.dispatch(msg, sample, session)
+
+    def _reject(self, session: Session, msgid: Any, error: str) -> None:
+        """Reply to a message which can not be handled, or log it if it has no id"""
+        if msgid is None:
+            print(error, file=sys.stderr)
+        else:
+            self.send({"msgId": msgid, "error": error}, None, session)
+
+    def handshake(self, msg: dict, session: Session) -> None:
+        """
+        Switch the transport of a session. This is handled as soon as it is read, and
+        the client must wait for the reply (sent with the old transport) before sending
+        anything else.
+        """
+        payload = msg.get("payload", {})
+        if "profile" in payload:
+            self.profiler.configure(**payload["profile"])
+        channel = session.channel.upgrade(
+            payload.get("framing", "lines"), payload.get("encoding", "json")
+        )
+        reply = {"framing": channel.framing, "encoding": channel.encoding}
+        session.channel.send({"msgId": msg["id"], "payload": reply})
+        session.channel.flush()
+        session.channel = channel
+
+    def dispatch(
+        self,
+        msg: dict,
+        sample: Optional[Sample] = None,
+        session: Optional[Session] = None,
+    ) -> asyncio.Task:
+        if sample is None:
+            sample = self.metrics.start(msg["name"], 0, 0.0)
+        if session is None:
+            session = _session.get()
+        payload = msg.get("payload", {})
+        uri = payload.get("uri", "")
+        previous = self.tails.get(uri)
+        after = previous.task if previous is not None else None
+        if (
+            previous is not None
+            and msg["name"] in self.coalesce
+            and previous.name == msg["name"]
+            # The other clients still want the reply to theirs
+            and previous.session is session
+        ):
+            # Only the newest of consecutive messages of this kind matters. Coalesced
+            # handlers must not have side effects before their last await, so that
+            # cancelling them at any point is safe.
+            previous.task.cancel()
+            after = previous.after
+        deadline = payload.get("deadline")
+        if deadline is not None:
+            deadline = asyncio.get_running_loop().time() + deadline / 1000
+        tail = _Tail(msg["name"], session, after)
+        tail.task = asyncio.create_task(self._handle(msg, tail, deadline, sample))
+        self.tails[uri] = tail
+        tail.task.add_done_callback(lambda task: self._done(msg, uri, tail, sample))
+        return tail.task
+
+    def _done(self, msg: dict, uri: str, tail: "_Tail", sample: Sample) -> None:
+        if self.tails.get(uri) is tail:
+            self.tails.pop(uri)
+        # Tasks cancelled before they started never got to reply
+        if tail.task.cancelled():
+            self.send({"msgId": msg["id"], "superseded": True}, sample, tail.session)
+
+    async def _handle(
+        self, msg: dict, tail: "_Tail", deadline: Optional[float], sample: Sample
+    ):
+        reply = {"msgId": msg["id"]}
+        _session.set(tail.session)
+        try:
+            if tail.after is not None:
+                await asyncio.wait([tail.after])
+            self.metrics.begin(sample)
+            profile = self.profiler.start(msg["name"])
+            try:
+                reply.update(await self._run(msg, tail, deadline))
+            finally:
+                self.profiler.stop(profile, msg)
+        except Superseded:
+            reply["superseded"] = True
+        self.send(reply, sample, tail.session)
+
+    async def _run(self, msg: dict, tail: "_Tail", deadline: Optional[float]) -> dict:
+        handler = self.handlers.get(msg["name"])
+        if handler is None:
+            return {"error": f"Unknown message: {msg['name']}"}
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                return {"error": "Deadline exceeded"}
+        try:
+            result = handler(msg.get("payload", {}))
+            if asyncio.iscoroutine(result):
+                result = await asyncio.wait_for(result, timeout)
+            return {"payload": result}
+        except asyncio.TimeoutError:
+            return {"error": "Deadline exceeded"}
+        except Superseded:
+            raise
+        except self.errors as e:
+            return {"error": str(e)}
+        except Exception as e:
+            # Other messages keep being served, but the bug should be visible
+            traceback.print_exc()
+            return {"error": f"Internal error: {e!r}"}
+
+    def send(
+        self,
+        reply: dict,
+        sample: Optional[Sample] = None,
+        session: Optional[Session] = None,
+    ) -> None:
+        channel = (session or _session.get()).channel
+        if channel is None:
+            return
+        start = time.perf_counter()
+        size = channel.send(reply)
+        if sample is not None:
+            self.metrics.finish(sample, reply, size, time.perf_counter() - start)
+
+
+def _listening(path: str) -> bool:
+    """Whether a server accepts connections on a Unix socket"""
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+    return True
@@ -0,0 +1,234 @@
+"""
+State of the documents (scripts) open in the parent process.
+"""
+
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from analysis import Analyzer
+from canonical import Canonicalizer
+from compact import CompactPlot
+from completion import CompletionIndex
+from editing import EditError, position
+from graph import GraphIndex
+from history import History
+from layout import Layout
+from plot_parser import ParsedScript, Plot
+from plot_store import PlotStore
+
+# Blank and comment lines before a node entry
+_PREAMBLE = re.compile(r"(?:[ \t]*(?:#[^\n]*)?\n)*[ \t]*")
+
+
+@dataclass
+class Document:
+    uri: str
+    # The last successful parse of the document
+    parsed: Optional[ParsedScript] = None
+    store: PlotStore = field(default_factory=PlotStore)
+    # Version of the last plot sent. Versions are numbered per document, not per
+    # client: a delta is only sent to a client whose base is this version, that is if
+    # the last reply about the document went to it, the others get the full plot (and
+    # the same for the graph, positions and canonical plot below).
+    version: int = 0
+    # Source and plot of a document whose store is not built: the plot was sent from the
+    # disk cache, or the document was left alone for a while (see ``cool``). The store
+    # is only built from them when the document is changed or edited.
+    cold: Optional[Tuple[str, CompactPlot]] = None
+    # Graph of the plot, kept up to date once it was asked for, and the version of the
+    # plot of the last graph sent, graphs are sent as deltas against it
+    graph: Optional[GraphIndex] = None
+    graph_version: Optional[int] = None
+    # Layout of the graph, and the version of the plot of the last positions sent
+    layout: Optional[Layout] = None
+    layout_version: Optional[int] = None
+    # Canonical form of the plot, kept up to date once it was asked for, and the version
+    # of the last canonical plot sent
+    canonical: Optional[Canonicalizer] = None
+    canonical_version: Optional[int] = None
+    # Checks of the plot, kept up to date once they were asked for
+    analysis: Optional[Analyzer] = None
+    # Terms of the plot suggested by the autocompletion, once it was asked for
+    completion: Optional[CompletionIndex] = None
+    # Edits made by the server which can be undone, kept when the document cools down
+    history: History = field(default_factory=History)
+
+    @property
+    def source(self) -> Optional[str]:
+        return self.parsed.source if self.parsed is not None else None
+
+    def require_parsed(self) -> ParsedScript:
+        if self.parsed is None:
+            raise EditError(f"Document {self.uri} has not been parsed yet")
+        return self.parsed
+
+    def require_plot(self) -> Plot:
+        if self.cold is not None:
+            return self.cold[1].to_plot()
+        self.require_parsed()
+        return self.store.plot
+
+    def require_graph(self) -> GraphIndex:
+        if self.graph is None:
+            self.graph = GraphIndex(self.require_plot())
+        return self.graph
+
+    def require_analysis(self, start: Optional[List[str]] = None) -> Analyzer:
+        if self.analysis is None:
+            self.analysis = Analyzer(self.require_plot(), start)
+        elif start != self.analysis.start:
+            self.analysis.start = start
+            self.analysis.reset(self.analysis.plot)
+        return self.analysis
+
+    def require_completion(self) -> CompletionIndex:
+        if self.completion is None:
+            self.completion = CompletionIndex(self.require_plot())
+        return self.completion
+
+    def require_canonical(self) -> Canonicalizer:
+        if self.canonical is None:
+            self.canonical = Canonicalizer(self.require_plot())
+        return self.canonical
+
+    def locate(self, objid: str) -> str:
+        """
+        Id of the object of the plot an id sent to the parent process stands for, which
+        is not the same for the merged linking objects of the canonical plot
+        """
+        if self.canonical is None:
+            return objid
+        locations = self.canonical.locations(objid)
+        if not locations:
+            return objid
+        if len(locations) > 1:
+            raise EditError(
+                f"{objid} is used in {len(locations)} places, edit the objects using "
+                "it instead"
+            )
+        return locations[0]
+
+    def reply(self, delta: bool, base: Optional[int]) -> dict:
+        """
+        Reply with the plot: either in full, or if the parent process has the
+        previous version of it, as a delta against that
+        """
+        changes = self.store.delta()
+        if self.graph is not None:
+            self.graph.update(changes)
+        if self.canonical is not None:
+            self.canonical.update(changes)
+        if self.analysis is not None:
+            self.analysis.update(changes)
+        if self.completion is not None:
+            self.completion.update(changes)
+        self.version += 1
+        if delta and base == self.version - 1:
+            return {"version": self.version, "delta": changes}
+        return {"version": self.version, "plot": self.store.plot}
+
+    def reply_graph(self, reply: dict, base: Optional[int]) -> dict:
+        """
+        Add the graph of the plot to a reply: either all of it, or if the parent
+        process has the one of the ``base`` version, the changes since then
+        """
+        graph = self.require_graph()
+        changes = graph.delta()
+        if base is not None and base == self.graph_version:
+            reply["graphDelta"] = changes
+        else:
+            reply["graph"] = graph.graph()
+        self.graph_version = self.version
+        return reply
+
+    def reply_canonical(self, reply: dict, base: Optional[int]) -> dict:
+        """
+        Replace the plot of a reply by its canonical form: either all of it, or if the
+        parent process has the one of the ``base`` version, the changes since then
+        """
+        canonical = self.require_canonical()
+        changes = canonical.delta()
+        reply.pop("plot", None)
+        reply.pop("delta", None)
+        if base is not None and base == self.canonical_version:
+            reply["delta"] = changes
+        else:
+            reply["plot"] = canonical.canonical_plot()
+        self.canonical_version = self.version
+        return reply
+
+    def reply_layout(self, reply: dict, base: Optional[int]) -> dict:
+        """
+        Add the positions of the nodes to a reply: either all of them, or if the parent
+        process has the ones of the ``base`` version, those which changed since then
+        """
+        graph = self.require_graph()
+        changes = graph.layout_changes()
+        if self.layout is None:
+            self.layout = Layout(graph.graph())
+            reply["positions"] = self.layout.positions()
+        else:
+            changed, removed = self.layout.update(changes)
+            if base is not None and base == self.layout_version:
+                reply["layoutDelta"] = {"changed": changed, "removed": removed}
+            else:
+                reply["positions"] = self.layout.positions()
+        self.layout_version = self.version
+        return reply
+
+    def reply_analysis(self, reply: dict, start: Optional[List[str]] = None) -> dict:
+        """
+        Add the problems found in the plot to a reply, with the range of the first line
+        of the node they are about
+        """
+        diagnostics = []
+        for diagnostic in self.require_analysis(start).diagnostics():
+            diagnostic = dict(diagnostic)
+            if self.parsed is not None and diagnostic["node"] in self.store.owner:
+                chunk = self.store.chunk_of(diagnostic["node"])
+                source = self.parsed.source
+                chunk_start, chunk_end = self.parsed.span(chunk)
+                start_offset = _PREAMBLE.match(source, chunk_start).end()
+                end = source.find("\n", start_offset, chunk_end)
+                end = chunk_end if end == -1 else end
+                diagnostic["range"] = {
+                    "start": position(source, start_offset),
+                    "end": position(source, end),
+                }
+            diagnostics.append(diagnostic)
+        reply["diagnostics"] = diagnostics
+        return reply
+
+    def reply_cold(self, source: str, plot: CompactPlot) -> dict:
+        self.cold = (source, plot)
+        self.version += 1
+        return {"version": self.version, "plot": plot.to_plot()}
+
+    def cool(self) -> None:
+        """
+        Only keep the source and the compact plot of the document, until it is changed
+        or edited again. The graph, layout, canonical plot, checks and autocompletion
+        terms are dropped too, so they are built (and sent in full) the next time.
+        """
+        if self.parsed is None:
+            return
+        self.cold = (self.parsed.source, CompactPlot.from_plot(self.store.plot))
+        self.parsed = None
+        self.store = PlotStore()
+        self.graph = self.graph_version = None
+        self.layout = self.layout_version = None
+        self.canonical = self.canonical_version = None
+        self.analysis = None
+        self.completion = None
+
+
+class DocumentStore:
+    def __init__(self):
+        self.documents: Dict[str, Document] = {}
+
+    def get(self, uri: str) -> Document:
+        doc = self.documents.get(uri)
+        if doc is None:
+            doc = self.documents[uri] = Document(uri)
+        return doc
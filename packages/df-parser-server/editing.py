@@ -0,0 +1,386 @@
+"""
+Applying ``put_obj`` and ``post_obj`` edits to the source of a dff script.
+
+Edits only regenerate the chunk (statement or node entry) containing the object, so
+the rest of the file - formatting, comments - is left untouched, and the following
+reparse is an incremental one. They are returned as text edits trimmed to the
+characters that actually changed, so the parent process doesn't have to replace the
+whole document.
+"""
+
+import json
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import libcst as cst
+
+from plot_parser import (
+    Chunk,
+    common_prefix,
+    common_suffix,
+    FlowSpec,
+    ParsedScript,
+    PlotParser,
+    Plot,
+    code_for,
+    label_target,
+    named_id,
+)
+from plot_store import NodeKey, PlotStore
+
+# Finds the id of a created object in the plot parsed from the edited source
+Created = Callable[[Plot], str]
+# (old, new) CST nodes to replace in a chunk
+Replacements = List[Tuple[cst.CSTNode, cst.CSTNode]]
+# Replacements of each chunk, by ``id(fragment)``
+ChunkEdits = Dict[int, Tuple[Chunk, Replacements]]
+
+
+class EditError(Exception):
+    """The requested edit can not be applied to the source."""
+
+
+class TextEdit(NamedTuple):
+    """Replacement of ``source[start:end]`` by ``text``"""
+
+    start: int
+    end: int
+    text: str
+
+    def apply(self, source: str) -> str:
+        return source[: self.start] + self.text + source[self.end :]
+
+
+def position(source: str, offset: int) -> Dict[str, int]:
+    """Line and character of an offset, as in vscode (in UTF-16 code units)"""
+    line_start = source.rfind("\n", 0, offset) + 1
+    prefix = source[line_start:offset]
+    character = (
+        len(prefix) if prefix.isascii() else len(prefix.encode("utf-16-le")) // 2
+    )
+    return {"line": source.count("\n", 0, line_start), "character": character}
+
+
+class TextEdits:
+    """
+    A sequence of edits, kept as non-overlapping edits of the original source, so they
+    can be applied at once by the parent process
+    """
+
+    def __init__(self):
+        self.edits: List[TextEdit] = []
+
+    def add(self, edit: TextEdit) -> None:
+        """Add an edit of the source with the previous edits applied"""
+        start, end, text = edit
+        edits = self.edits
+        before: List[TextEdit] = []
+        # Difference between offsets in the edited and the original source
+        delta = 0
+        i = 0
+        while i < len(edits) and edits[i].start + delta + len(edits[i].text) < start:
+            delta += len(edits[i].text) - (edits[i].end - edits[i].start)
+            before.append(edits[i])
+            i += 1
+        orig_start = start - delta
+        prefix = suffix = ""
+        last_end = None
+        # Merge the edits touching the new one
+        while i < len(edits) and edits[i].start + delta <= end:
+            old = edits[i]
+            old_start = old.start + delta
+            if old_start < start:
+                prefix = old.text[: start - old_start]
+                orig_start = old.start
+            if old_start + len(old.text) > end:
+                suffix = old.text[end - old_start :]
+                last_end = old.end
+            delta += len(old.text) - (old.end - old.start)
+            i += 1
+        orig_end = end - delta
+        if last_end is not None:
+            orig_end = max(orig_end, last_end)
+        merged = TextEdit(orig_start, orig_end, prefix + text + suffix)
+        self.edits = before + [merged] + edits[i:]
+
+    def apply(self, source: str) -> str:
+        """The original source with the edits applied"""
+        parts = []
+        last = 0
+        for start, end, text in self.edits:
+            parts += (source[last:start], text)
+            last = end
+        parts.append(source[last:])
+        return "".join(parts)
+
+    def inverse(self, source: str) -> "TextEdits":
+        """The edits of the edited source giving back the original one"""
+        inverse = TextEdits()
+        # Difference between offsets in the edited and the original source
+        delta = 0
+        for start, end, text in self.edits:
+            inverse.edits.append(
+                TextEdit(start + delta, start + delta + len(text), source[start:end])
+            )
+            delta += len(text) - (end - start)
+        return inverse
+
+    def ranges(self, source: str) -> List[dict]:
+        """The edits as vscode ``TextEdit``s of the original source"""
+        return [
+            {
+                "range": {
+                    "start": position(source, edit.start),
+                    "end": position(source, edit.end),
+                },
+                "newText": edit.text,
+            }
+            for edit in self.edits
+        ]
+
+
+def _expression(plot: Dict[str, Dict[str, Any]], value: str) -> cst.BaseExpression:
+    """Values of updates are python code, or ids of python objects"""
+    if value in plot["py_defs"]:
+        value = plot["py_defs"][value]["name"]
+    try:
+        return cst.parse_expression(value)
+    except cst.ParserSyntaxError as e:
+        raise EditError(f"Invalid expression {value!r}: {e.message}") from e
+
+
+def _string(value: str) -> cst.SimpleString:
+    return cst.SimpleString(json.dumps(value))
+
+
+def _append(container: cst.Dict, element: cst.DictElement) -> cst.Dict:
+    """Add an element to the end of a dict, keeping the layout of the existing ones"""
+    elements = list(container.elements)
+    if not elements:
+        return container.with_changes(elements=[element])
+    last = elements[-1]
+    if len(elements) > 1:
+        comma = elements[-2].comma
+    elif isinstance(container.lbrace.whitespace_after, cst.ParenthesizedWhitespace):
+        comma = cst.Comma(whitespace_after=container.lbrace.whitespace_after)
+    else:
+        comma = cst.Comma(whitespace_after=cst.SimpleWhitespace(" "))
+    elements[-1] = last.with_changes(comma=comma)
+    elements.append(element.with_changes(comma=last.comma))
+    return container.with_changes(elements=elements)
+
+
+class Editor:
+    """Translates edits of plot objects into edits of the source they were parsed from"""
+
+    def __init__(self, parser: PlotParser, parsed: ParsedScript, store: PlotStore):
+        self.parser = parser
+        self.parsed = parsed
+        self.store = store
+        self.plot = store.plot
+
+    def _locate(self, objid: str) -> Tuple[Chunk, cst.CSTNode]:
+        if self.store.owner.get(objid) is None:
+            raise EditError(f"Object {objid} not found")
+        chunk = self.store.chunk_of(objid)
+        fragment = self.parser.materialize(chunk, self.parsed)
+        return chunk, fragment.cst_nodes[self.store.local_id(objid)]
+
+    def _flow(self, objid: Optional[str]) -> Tuple[str, FlowSpec]:
+        """Plot name and spec of a flow, the first flow if ``objid`` is ``None``"""
+        if objid is None:
+            objid = next(iter(self.store.flows), None)
+            if objid is None:
+                raise EditError("The script has no flows")
+        if objid not in self.store.flows:
+            raise EditError(f"Flow {objid} not found")
+        return self.store.flows[objid]
+
+    def _flow_of(self, node_id: str) -> str:
+        if node_id not in self.store.flow_of:
+            raise EditError(f"Node {node_id} is not in a flow")
+        return self.plot["flows"][self.store.flow_of[node_id]]["name"]
+
+    def _splice(self, chunk: Chunk, replacements: Replacements) -> TextEdit:
+        """Edit of a chunk replacing (disjoint) nodes of its CST"""
+        root = chunk.fragment.cst
+        for old, new in replacements:
+            root = root.deep_replace(old, new)
+        code = code_for(root)
+        if chunk.is_node:
+            # Node chunks are parsed wrapped in ``{...\n}``
+            code = code[1:-2]
+        # Only the changed part of the chunk
+        start, end = self.parsed.span(chunk)
+        text = self.parsed.source[start:end]
+        prefix = common_prefix(text, code)
+        suffix = common_suffix(text, code, min(len(text), len(code)) - prefix)
+        return TextEdit(start + prefix, end - suffix, code[prefix : len(code) - suffix])
+
+    def _node_label(self, flow: str, name: str, priority: Any = None):
+        parts = [json.dumps(flow), json.dumps(name)]
+        if priority is not None and priority != "":
+            parts.append(str(priority))
+        return _expression(self.plot, f"({', '.join(parts)})")
+
+    def _label(self, target: str, priority: Any = None) -> cst.BaseExpression:
+        """Labels pointing to a node are written as ``("flow", "node")`` tuples"""
+        if target not in self.plot["nodes"]:
+            return _expression(self.plot, target)
+        node = self.plot["nodes"][target]
+        if node["type"] != "regular":
+            raise EditError(f"Transitions can not point to {node['type']} nodes")
+        return self._node_label(self._flow_of(target), node["name"], priority)
+
+    def _relabel(self, renames: Dict[NodeKey, NodeKey], chunks: ChunkEdits) -> None:
+        """Point the transitions to renamed nodes to their new name"""
+        for old_key, (flow, name) in renames.items():
+            for trans in self.store.waiting.get(old_key, ()):
+                chunk, element = self._locate(trans)
+                _, priority = label_target(element.key, chunk.flow)
+                new = self._node_label(flow, name, priority)
+                replacements = chunks.setdefault(id(chunk.fragment), (chunk, []))[1]
+                replacements.append((element.key, new))
+
+    def put(self, objid: str, update: Dict[str, Any]) -> Tuple[List[TextEdit], Created]:
+        """
+        Edits of the source updating the properties of an object (and the labels of
+        the transitions pointing to it, if it's renamed), and a function finding the
+        new id of the object
+        """
+        if objid in self.plot["flows"]:
+            if set(update) != {"name"}:
+                raise EditError("Can only update the name of flows")
+            return self.rename_flow(objid, update["name"])
+        chunk, node = self._locate(objid)
+        table = self.store.table_of[objid]
+        chunks: ChunkEdits = {}
+        if table == "nodes":
+            if set(update) != {"name"}:
+                raise EditError("Can only update the name of nodes")
+            if self.plot["nodes"][objid]["type"] != "regular":
+                raise EditError("Only regular nodes have a name")
+            name = update["name"]
+            # Only the key, so the labels of transitions inside the node can change too
+            chunks[id(chunk.fragment)] = (chunk, [(node.key, _string(name))])
+            old_name = self.plot["nodes"][objid]["name"]
+            self._relabel({(chunk.flow, old_name): (chunk.flow, name)}, chunks)
+            spec = self.store.flows[self.store.flow_of[objid]]
+            objid = named_id("nodes", spec[0], chunk.flow, json.dumps(name))
+        else:
+            new = node
+            for prop, value in update.items():
+                new = self._put_prop(table, chunk, new, prop, value)
+            chunks[id(chunk.fragment)] = (chunk, [(node, new)])
+        edits = sorted(
+            self._splice(c, replacements) for c, replacements in chunks.values()
+        )
+        if table == "transitions":
+            # The transitions of the edited node are parsed anew
+            parent = self.store.parent[objid]
+            i = self.plot["nodes"][parent]["transitions"].index(objid)
+            return edits, lambda plot: plot["nodes"][parent]["transitions"][i]
+        return edits, lambda plot: objid
+
+    def _put_prop(
+        self, table: str, chunk: Chunk, node: cst.CSTNode, prop: str, value: Any
+    ):
+        if table == "transitions" and prop == "condition":
+            return node.with_changes(value=_expression(self.plot, value))
+        if table == "transitions" and prop == "label":
+            _, priority = label_target(node.key, chunk.flow)
+            return node.with_changes(key=self._label(value, priority))
+        if table == "transitions" and prop == "priority":
+            target, _ = label_target(node.key, chunk.flow)
+            if target is None:
+                raise EditError("Only transitions to a node have a priority")
+            return node.with_changes(key=self._node_label(*target, value))
+        if table == "responses" and prop == "response_object":
+            return _expression(self.plot, value)
+        if table == "linking" and prop == "object":
+            if isinstance(node, cst.Call):
+                return node.with_changes(func=_expression(self.plot, value))
+            return _expression(self.plot, value)
+        raise EditError(f"Can not update {prop!r} of {table}")
+
+    def rename_flow(self, objid: str, name: str) -> Tuple[List[TextEdit], Created]:
+        plot_name, flow = self._flow(objid)
+        chunks: ChunkEdits = {}
+        renames = {
+            key: (name, key[1]) for key in self.store.waiting if key[0] == flow.name
+        }
+        self._relabel(renames, chunks)
+        edits = [self._splice(c, replacements) for c, replacements in chunks.values()]
+        edits.append(TextEdit(*self.parsed.key_span(flow), json.dumps(name)))
+        new_id = named_id("flows", plot_name, name)
+        return sorted(edits), lambda plot: new_id
+
+    def post(self, obj_type: str, props: Dict[str, Any]) -> Tuple[TextEdit, Created]:
+        """
+        Edit of the source adding a new object, and a function finding the id of the
+        object in the plot parsed from the edited source
+        """
+        if obj_type == "node":
+            return self._post_node(props)
+        if obj_type == "transition":
+            return self._post_transition(props)
+        raise EditError(f"Can not create objects of type {obj_type!r}")
+
+    def new_node_name(self, flow: FlowSpec) -> str:
+        names = {
+            self.plot["nodes"][n].get("name")
+            for n in self.plot["flows"][flow.objid]["nodes"]
+        }
+        i = len(names)
+        while f"node_{i}" in names:
+            i += 1
+        return f"node_{i}"
+
+    def _post_node(self, props: Dict[str, Any]) -> Tuple[TextEdit, Created]:
+        plot_name, flow = self._flow(props.get("flow"))
+        if self.parsed.close(flow) is None:
+            raise EditError(f"Flow {flow.name} is not a dict literal")
+        name = props.get("name") or self.new_node_name(flow)
+        response = props.get("response", '""')
+        entry = f"{json.dumps(name)}: {{RESPONSE: {response}, TRANSITIONS: {{}}}}"
+        objid = named_id("nodes", plot_name, flow.name, json.dumps(name))
+        return self._insert_node(flow, entry), lambda plot: objid
+
+    def _insert_node(self, flow: FlowSpec, entry: str) -> TextEdit:
+        source = self.parsed.source
+        close = self.parsed.close(flow)
+        if flow.node_chunks:
+            start, end = self.parsed.span(flow.node_chunks[-1])
+            line_start = source.rfind("\n", 0, start) + 1
+            indent = source[line_start:start]
+            between = source[end:close]
+            if between.lstrip().startswith(","):
+                pos = end + between.index(",") + 1
+                return TextEdit(pos, pos, f"\n{indent}{entry},")
+            return TextEdit(end, end, f",\n{indent}{entry}")
+        key_start, _ = self.parsed.key_span(flow)
+        line_start = source.rfind("\n", 0, key_start) + 1
+        indent = source[line_start:key_start]
+        return TextEdit(close, close, f"\n{indent}    {entry},\n{indent}")
+
+    def _post_transition(self, props: Dict[str, Any]) -> Tuple[TextEdit, Created]:
+        node_id = props.get("node")
+        if node_id is None:
+            raise EditError("A transition needs a source node")
+        chunk, element = self._locate(node_id)
+        if not isinstance(element.value, cst.Dict):
+            raise EditError(f"Node {node_id} is not a dict literal")
+        label = self._label(props.get("label", "repeat()"), props.get("priority"))
+        condition = _expression(self.plot, props.get("condition", "cnd.true()"))
+        transition = cst.DictElement(label, condition)
+        node = element.value
+        for el in node.elements:
+            if isinstance(el, cst.DictElement) and isinstance(el.value, cst.Dict):
+                key = el.key
+                if code_for(key).strip("\"'").upper() == "TRANSITIONS":
+                    new = node.deep_replace(el.value, _append(el.value, transition))
+                    break
+        else:
+            transitions = cst.Dict([transition])
+            new = _append(node, cst.DictElement(cst.Name("TRANSITIONS"), transitions))
+        edit = self._splice(chunk, [(element, element.with_changes(value=new))])
+        return edit, lambda plot: plot["nodes"][node_id]["transitions"][-1]
@@ -0,0 +1,268 @@
+"""
+Renderable graph of a plot, the same as ``plotToGraph`` in ``editor/src/utils/plot.ts``
+builds: a node per regular node (bot turn) and per transition between regular nodes
+(user turn), with edges node -> transition -> target node.
+
+The graph is kept up to date from the deltas of the plot, so that only the nodes whose
+record, transitions, flow or conditions changed are converted again. The flow of every
+node and the label of every condition are indexed instead of being searched for.
+"""
+
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from plot_parser import Plot
+
+Graph = Dict[str, List[Dict[str, Any]]]
+GNode = Dict[str, Any]
+# Flow and children of a graph node, what its layout depends on
+Entry = Tuple[str, List[str]]
+
+# Values of the ``Turn`` enum of the editor
+USER = 0
+BOT = 1
+
+
+def condition_label(plot: Plot, condition: str) -> str:
+    """Name of the python object called by a condition, as shown on transitions"""
+    if condition.startswith("id#ln"):
+        objid = plot["linking"][condition]["object"]
+        if objid.startswith("id#df"):
+            return plot["py_defs"][objid]["name"]
+    return "unknown"
+
+
+def build_graph(plot: Plot) -> Graph:
+    return GraphIndex(plot).graph()
+
+
+def _gnode(objid: str, label: str, turn: int, flow: str) -> GNode:
+    return {"id": objid, "label": label, "turn": turn, "flow": flow, "properties": []}
+
+
+def _changed_ids(delta: dict, table: str) -> Iterator[str]:
+    changes = delta.get(table)
+    if changes:
+        yield from changes["added"]
+        yield from changes["changed"]
+        yield from changes["removed"]
+
+
+class GraphIndex:
+    """Graph of a plot, updated from the deltas of the plot (see ``PlotStore.delta``)"""
+
+    def __init__(self, plot: Plot):
+        self.gnodes: Dict[str, GNode] = {}
+        self.kids: Dict[str, List[str]] = {}
+        # Graph nodes changed since the last delta, with their node and children then,
+        # and since the layout was last updated (an ordered set)
+        self.touched: Dict[str, Tuple[Optional[GNode], List[str]]] = {}
+        self.unlaid: Dict[str, None] = {}
+        self.reset(plot)
+
+    def reset(self, plot: Plot) -> None:
+        """Convert another plot in full, eg. the same one parsed again"""
+        self.plot = plot
+        # Everything is converted again, only what changed ends up in the deltas
+        for gid, gnode in self.gnodes.items():
+            self.touched.setdefault(gid, (gnode, self.kids[gid]))
+            self.unlaid[gid] = None
+        self.gnodes = {}
+        self.kids = {}
+        # Ids of the graph nodes of each regular node: itself, then its transitions
+        self.blocks: Dict[str, List[str]] = {}
+        # Objects (nodes, transitions, conditions) the graph nodes of each regular
+        # node depend on, and the other way around
+        self.deps: Dict[str, Set[str]] = {}
+        self.dependents: Dict[str, Set[str]] = {}
+        # Flow (id) of every node, and nodes of every flow
+        self.flow_of: Dict[str, str] = {}
+        self.members: Dict[str, List[str]] = {}
+        # Label of each condition and the objects it was found from, and the other way
+        # around. Only the conditions of graph nodes are kept.
+        self.labels: Dict[str, str] = {}
+        self.label_sources: Dict[str, List[str]] = {}
+        self.label_users: Dict[str, Set[str]] = {}
+        for flow, record in plot["flows"].items():
+            self._add_flow(flow, record)
+        for objid in plot["nodes"]:
+            self._build(objid)
+
+    def graph(self) -> Graph:
+        """The whole graph, nodes and edges in the order of the nodes of the plot"""
+        nodes = []
+        edges = []
+        for objid in self.plot["nodes"]:
+            block = self.blocks.get(objid)
+            if block is None:
+                continue
+            nodes.extend(self.gnodes[gid] for gid in block)
+            for trans in self.kids[objid]:
+                edges.append({"fromId": objid, "toId": trans})
+                edges.extend({"fromId": trans, "toId": trg} for trg in self.kids[trans])
+        return {"nodes": nodes, "edges": edges}
+
+    def update(self, delta: dict) -> None:
+        """Convert again the nodes affected by a delta of the plot"""
+        dirty: Dict[str, None] = {}
+        for table in ("linking", "py_defs"):
+            for objid in _changed_ids(delta, table):
+                for condition in list(self.label_users.get(objid, ())):
+                    self._forget(condition)
+                    dirty.update(dict.fromkeys(self.dependents.get(condition, ())))
+        if "flows" in delta:
+            dirty.update(dict.fromkeys(self._update_flows(delta["flows"])))
+        for objid in _changed_ids(delta, "transitions"):
+            dirty.update(dict.fromkeys(self.dependents.get(objid, ())))
+        for objid in _changed_ids(delta, "nodes"):
+            dirty[objid] = None
+            if (objid in self.blocks) != self._regular(objid):
+                # Transitions to it are shown or hidden
+                dirty.update(dict.fromkeys(self.dependents.get(objid, ())))
+        for objid in dirty:
+            self._build(objid)
+
+    def delta(self) -> dict:
+        """Added, removed and changed nodes and edges since the last delta"""
+        nodes: Dict[str, list] = {"added": [], "removed": [], "changed": []}
+        edges: Dict[str, list] = {"added": [], "removed": []}
+        for gid, (old, old_kids) in self.touched.items():
+            gnode = self.gnodes.get(gid)
+            kids = self.kids.get(gid, [])
+            if old is None and gnode is not None:
+                nodes["added"].append(gnode)
+            elif gnode is None and old is not None:
+                nodes["removed"].append(gid)
+            elif gnode != old:
+                nodes["changed"].append(gnode)
+            if kids != old_kids:
+                edges["added"] += [
+                    {"fromId": gid, "toId": kid} for kid in kids if kid not in old_kids
+                ]
+                edges["removed"] += [
+                    {"fromId": gid, "toId": kid} for kid in old_kids if kid not in kids
+                ]
+        self.touched = {}
+        return {"nodes": nodes, "edges": edges}
+
+    def layout_changes(self) -> Dict[str, Optional[Entry]]:
+        """
+        Flow and children of the graph nodes changed since the last call (``None`` for
+        removed ones), see ``Layout.update``
+        """
+        changes = {
+            gid: (
+                (self.gnodes[gid]["flow"], self.kids[gid])
+                if gid in self.gnodes
+                else None
+            )
+            for gid in self.unlaid
+        }
+        self.unlaid = {}
+        return changes
+
+    def _regular(self, objid: str) -> bool:
+        node = self.plot["nodes"].get(objid)
+        return node is not None and node["type"] == "regular"
+
+    def _label(self, condition: str) -> str:
+        label = self.labels.get(condition)
+        if label is None:
+            label = self.labels[condition] = condition_label(self.plot, condition)
+            sources = [condition]
+            link = self.plot["linking"].get(condition)
+            if link is not None:
+                sources.append(link["object"])
+            self.label_sources[condition] = sources
+            for objid in sources:
+                self.label_users.setdefault(objid, set()).add(condition)
+        return label
+
+    def _forget(self, condition: str) -> None:
+        """Drop the label of a condition"""
+        if self.labels.pop(condition, None) is None:
+            return
+        for objid in self.label_sources.pop(condition):
+            users = self.label_users[objid]
+            users.discard(condition)
+            if not users:
+                del self.label_users[objid]
+
+    def _add_flow(self, flow: str, record: Dict[str, Any]) -> None:
+        self.members[flow] = record["nodes"]
+        for node in record["nodes"]:
+            self.flow_of.setdefault(node, flow)
+
+    def _update_flows(self, changes: dict) -> List[str]:
+        """
+        Update the flow of the nodes of the changed flows, return the regular nodes
+        shown in another flow than before
+        """
+        nodes: Dict[str, None] = {}
+        for flow in (*changes["changed"], *changes["removed"]):
+            for node in self.members.pop(flow, ()):
+                nodes[node] = None
+                if self.flow_of.get(node) == flow:
+                    del self.flow_of[node]
+        for flow, record in (*changes["added"].items(), *changes["changed"].items()):
+            nodes.update(dict.fromkeys(record["nodes"]))
+            self._add_flow(flow, record)
+        return [
+            node
+            for node in nodes
+            if node in self.gnodes and self.gnodes[node]["flow"] != self._flow(node)
+        ]
+
+    def _flow(self, objid: str) -> str:
+        flow = self.flow_of.get(objid)
+        return self.plot["flows"][flow]["name"] if flow is not None else "noflow"
+
+    def _set(self, gid: str, gnode: Optional[GNode], kids: List[str]) -> None:
+        if gid not in self.touched:
+            self.touched[gid] = (self.gnodes.get(gid), self.kids.get(gid, []))
+        self.unlaid[gid] = None
+        if gnode is None:
+            del self.gnodes[gid]
+            del self.kids[gid]
+        else:
+            self.gnodes[gid] = gnode
+            self.kids[gid] = kids
+
+    def _build(self, objid: str) -> None:
+        """Convert a node of the plot (again)"""
+        for dep in self.deps.pop(objid, ()):
+            users = self.dependents[dep]
+            users.discard(objid)
+            if not users:
+                del self.dependents[dep]
+                # No graph node shows it anymore
+                self._forget(dep)
+        old = self.blocks.pop(objid, [])
+        node = self.plot["nodes"].get(objid)
+        if node is None or node["type"] != "regular":
+            for gid in old:
+                self._set(gid, None, [])
+            return
+
+        flow = self._flow(objid)
+        deps = {objid}
+        kids: List[str] = []
+        transitions = []
+        for trans_id in node.get("transitions", ()):
+            trans = self.plot["transitions"][trans_id]
+            deps.update((trans_id, trans["label"]))
+            if not self._regular(trans["label"]) or trans_id in kids:
+                continue
+            deps.add(trans["condition"])
+            kids.append(trans_id)
+            label = self._label(trans["condition"])
+            transitions.append((_gnode(trans_id, label, USER, flow), trans["label"]))
+        block = [objid, *kids]
+        for gid in set(old).difference(block):
+            self._set(gid, None, [])
+        self._set(objid, _gnode(objid, node.get("name") or "noname", BOT, flow), kids)
+        for gnode, target in transitions:
+            self._set(gnode["id"], gnode, [target])
+        self.blocks[objid] = block
+        self.deps[objid] = deps
+        for dep in deps:
+            self.dependents.setdefault(dep, set()).add(objid)
@@ -0,0 +1,130 @@
+"""
+Undo and redo of the edits the server made to a document (``put_obj``, ``post_obj``,
+``batch`` and ``dump_yaml``).
+
+A step of the history only keeps the text edits it made and the text they replaced,
+and for YAML documents the plot after it, as persistent tables (see ``persistent``)
+sharing everything but the changed objects with the plots of the other steps. So a
+step costs about the size of the change, whatever the size of the plot. The history
+of a document is capped by an estimate of the memory its steps use, the oldest steps
+are dropped first.
+
+Changes made to the document in the editor are not part of the history: a step can
+only be undone (or redone) on the source it left (or started from).
+"""
+
+import sys
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, List, Optional, Tuple
+
+from editing import EditError, TextEdits
+from plot_parser import content_hash
+
+# Estimated memory the history of a document may use, in bytes
+BUDGET = 4 * 1024 * 1024
+# Rough size of a step and of a text edit without their texts and plots, in bytes
+_STEP_BYTES = 400
+_EDIT_BYTES = 150
+
+
+def size_of(value: Any) -> int:
+    """Rough size of a JSON-like value, in bytes"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(size_of(k) + size_of(v) for k, v in value.items())
+    elif isinstance(value, list):
+        size += sum(size_of(v) for v in value)
+    return size
+
+
+@dataclass
+class Step:
+    # Edits of the source before the step, and of the source after it giving it back
+    redo: TextEdits
+    undo: TextEdits
+    before: bytes
+    after: bytes
+    # What the document keeps besides its source (eg. the plot) after the step
+    state: Any
+    size: int
+
+
+class History:
+    def __init__(self, budget: int = BUDGET):
+        self.budget = budget
+        self.done: Deque[Step] = deque()
+        self.undone: List[Step] = []
+        # State before the oldest step
+        self.base: Any = None
+        self.size = 0
+
+    def record(
+        self,
+        source: str,
+        edits: TextEdits,
+        new_source: str,
+        state: Tuple[Any, Any] = (None, None),
+        state_size: int = 0,
+        digests: Optional[Tuple[bytes, bytes]] = None,
+    ) -> None:
+        """
+        Add the edits of ``source`` giving ``new_source``, and the states before and
+        after them. The steps undone are dropped. The hashes of the sources are
+        computed if not given.
+        """
+        self.size -= sum(step.size for step in self.undone)
+        self.undone.clear()
+        if not self.done:
+            self.base = state[0]
+        undo = edits.inverse(source)
+        size = _STEP_BYTES + state_size
+        for edit in edits.edits + undo.edits:
+            size += _EDIT_BYTES + len(edit.text)
+        before, after = digests or (content_hash(source), content_hash(new_source))
+        step = Step(edits, undo, before, after, state[1], size)
+        self.done.append(step)
+        self.size += size
+        while self.size > self.budget and self.done:
+            dropped = self.done.popleft()
+            self.size -= dropped.size
+            self.base = dropped.state
+
+    def undo(self, source: str) -> Tuple[str, TextEdits, Any]:
+        """
+        The source and the state before the last step, and the edits of ``source``
+        giving that source
+        """
+        if not self.done:
+            raise EditError("Nothing to undo")
+        step = self.done[-1]
+        self._check(source, step.after, "undone")
+        self.undone.append(self.done.pop())
+        state = self.done[-1].state if self.done else self.base
+        return step.undo.apply(source), step.undo, state
+
+    def redo(self, source: str) -> Tuple[str, TextEdits, Any]:
+        """
+        The source and the state after the last step undone, and the edits of
+        ``source`` giving that source
+        """
+        if not self.undone:
+            raise EditError("Nothing to redo")
+        step = self.undone[-1]
+        self._check(source, step.before, "redone")
+        self.done.append(self.undone.pop())
+        return step.redo.apply(source), step.redo, step.state
+
+    def clear(self) -> None:
+        self.done.clear()
+        self.undone.clear()
+        self.base = None
+        self.size = 0
+
+    def _check(self, source: str, digest: bytes, action: str) -> None:
+        if content_hash(source) != digest:
+            # None of the steps apply to the document anymore
+            self.clear()
+            raise EditError(
+                f"The document was changed since the last edit, it can not be {action}"
+            )
@@ -0,0 +1,490 @@
+"""
+Flow-constrained layout of a graph, the same as ``getLayout`` in
+``editor/src/utils/layout.ts``, on NumPy arrays.
+
+Every node gets a vertical index, which is first its position among the children of
+its parent, then is pulled towards the indices of the nodes it is connected to and of
+the other nodes of its flow for a number of iterations. The nodes are then placed as
+a tree, the children of each node ordered by their vertical index.
+
+Unlike the editor, the tensions of all the nodes are computed at once in each
+iteration, from the per-flow sums and the sums over the incoming and outgoing edges.
+The editor updates the nodes one after the other (depth first from the roots), each
+seeing the indices already updated in the same iteration. Both converge to about the
+same indices (within half a row on the scripts of the extension), but siblings whose
+indices are closer than that may be ordered, and so placed, differently. Updating the
+nodes one at a time is about 15 times slower in Python, for the first layout of a
+large graph.
+Nodes which can not be reached from a node without incoming edges (eg. loops) are
+laid out as well, starting from the first of them.
+
+A :class:`Layout` can be updated when the graph changes. Only the nodes whose edges
+or flow changed get new vertical indices, pulled by their neighbours and flows which
+stay where they are, and only the subtree containing them is placed again. The nodes
+below it are moved by as much as its height changed.
+"""
+
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from graph import Entry, Graph
+
+# Same values as in the editor
+COLUMN_GAP = 100
+ROW_GAP = 40
+NODE_WIDTH = 160
+NODE_HEIGHT = 69
+# Weight of the edge lengths and of the distances between nodes of the same flow
+K = 0.1
+F = 0.01
+MAX_ITER = 100
+
+Positions = Dict[str, Dict[str, float]]
+
+
+def _children(graph: Graph) -> Dict[str, List[str]]:
+    """Children of every node, edges to unknown nodes are dropped"""
+    children: Dict[str, List[str]] = {node["id"]: [] for node in graph["nodes"]}
+    for edge in graph["edges"]:
+        if edge["fromId"] in children and edge["toId"] in children:
+            children[edge["fromId"]].append(edge["toId"])
+    return children
+
+
+def _grow(array: np.ndarray, count: int, fill=0) -> np.ndarray:
+    return np.concatenate((array, np.full(count, fill, dtype=array.dtype)))
+
+
+class _Fallback(Exception):
+    """The change can not be placed again locally"""
+
+
+class Layout:
+    """
+    Layout of a graph, which can be updated as the graph changes. Nodes are numbered
+    by slots, the slots of removed nodes are not reused.
+    """
+
+    def __init__(self, graph: Graph, iterations: int = MAX_ITER):
+        self.iterations = iterations
+        self.ids: List[str] = []
+        self.slot: Dict[str, int] = {}
+        self.alive: List[bool] = []
+        self.kids: List[List[int]] = []
+        self.parents: List[List[int]] = []
+        self.flows: Dict[str, int] = {}
+        self.flow = np.zeros(0, dtype=np.intp)
+        # Sum of the vertical indices and number of the nodes of every flow
+        self.flow_sum = np.zeros(0)
+        self.flow_size = np.zeros(0, dtype=np.intp)
+        self.index = np.zeros(0)
+        # Placement: the nodes in the order they were placed (preorder) and the
+        # position of every node in it, then the node it was placed under (-1 for
+        # roots), its column, the y of the space above it, the height of its children
+        # and the number of nodes placed under it, itself included
+        self.roots: List[int] = []
+        self.order: List[int] = []
+        self.pre = np.zeros(0, dtype=np.intp)
+        self.owner = np.zeros(0, dtype=np.intp)
+        self.depth = np.zeros(0, dtype=np.intp)
+        self.above = np.zeros(0)
+        self.kids_height = np.zeros(0)
+        self.size = np.zeros(0, dtype=np.intp)
+
+        self._add_nodes([(node["id"], node["flow"]) for node in graph["nodes"]])
+        for objid, children in _children(graph).items():
+            self._set_kids(self.slot[objid], [self.slot[kid] for kid in children])
+        self.roots = self._roots()
+        self._initial_indices()
+        self._relax(list(range(len(self.ids))))
+        self._place_all()
+
+    def positions(self) -> Positions:
+        """Position (top left corner) of every node"""
+        return self._positions(self.order)
+
+    def update(
+        self, changes: Dict[str, Optional[Entry]]
+    ) -> Tuple[Positions, List[str]]:
+        """
+        Lay out the graph again after some of its nodes changed. ``changes`` has the
+        flow and children of every added or changed node, and ``None`` for removed
+        ones. Return the positions which changed and the ids of the removed nodes.
+        """
+        before = (self.depth.copy(), self.above.copy(), self.kids_height.copy())
+        placed = len(self.ids)
+
+        removed = sorted(
+            self.slot[objid]
+            for objid, entry in changes.items()
+            if entry is None and objid in self.slot
+        )
+        # Nodes whose parents changed, sources whose children changed, and the nodes
+        # under which the removed nodes were placed
+        touched: Set[int] = set()
+        sources: Set[int] = set()
+        owners: Set[int] = set()
+        for i in removed:
+            touched.update(self.kids[i])
+            owners.add(int(self.owner[i]))
+            for parent in set(self.parents[i]):
+                sources.add(parent)
+                self._set_kids(parent, [kid for kid in self.kids[parent] if kid != i])
+            self._remove(i)
+            del self.slot[self.ids[i]]
+        touched.difference_update(removed)
+        self._add_nodes(
+            [
+                (objid, entry[0])
+                for objid, entry in changes.items()
+                if entry is not None and objid not in self.slot
+            ]
+        )
+        added = range(placed, len(self.ids))
+        moved = set()
+        for objid, entry in changes.items():
+            if entry is None:
+                continue
+            flow, children = entry
+            i = self.slot[objid]
+            if i < placed and self.flows.get(flow) != self.flow[i]:
+                moved.add(i)
+                self._move(i, flow)
+            kids = [self.slot[kid] for kid in children if kid in self.slot]
+            if kids != self.kids[i]:
+                touched.update(set(kids).symmetric_difference(self.kids[i]))
+                sources.add(i)
+                self._set_kids(i, kids)
+
+        # New nodes start where they are added, like in the first layout
+        for i in added:
+            parent = next(iter(self.parents[i]), None)
+            index = (
+                self.kids[parent].index(i) if parent is not None else len(self.roots)
+            )
+            self.index[i] = index
+            self.flow_sum[self.flow[i]] += index
+        active = touched | moved | set(added)
+        self._relax(sorted(active))
+
+        try:
+            # Roots are not placed again locally
+            if any(
+                i in self.roots or not self.parents[i] for i in touched | moved
+            ) or any(not self.parents[i] for i in added):
+                raise _Fallback()
+            owners.update(sources.difference(added))
+            owners = {i for i in owners if i < 0 or self.alive[i]}
+            owners.update(
+                parent for i in active for parent in self.parents[i] if parent < placed
+            )
+            changed = self._place_under(self._common_owner(owners)) if owners else []
+        except _Fallback:
+            self.roots = self._roots()
+            self._place_all()
+            changed = self.order
+        return self._changes(changed, before), [self.ids[i] for i in removed]
+
+    def _positions(self, slots: Iterable[int]) -> Positions:
+        slots = np.fromiter(slots, dtype=np.intp)
+        x, y = self._xy(slots, self.depth, self.above, self.kids_height)
+        ids = self.ids
+        return {
+            ids[i]: {"x": x, "y": y}
+            for i, x, y in zip(slots.tolist(), x.tolist(), y.tolist())
+        }
+
+    @staticmethod
+    def _xy(slots: np.ndarray, depth, above, kids_height):
+        x = depth[slots] * (NODE_WIDTH + COLUMN_GAP)
+        y = (
+            above[slots]
+            + ROW_GAP
+            + np.maximum(kids_height[slots] / 2 - NODE_HEIGHT / 2, 0)
+        )
+        return x, y
+
+    def _changes(self, slots: Iterable[int], before) -> Positions:
+        """Positions of the given nodes which moved since ``before``"""
+        slots = np.unique(np.fromiter(slots, dtype=np.intp))
+        old = slots < len(before[0])
+        x, y = self._xy(slots[old], *before)
+        new_x, new_y = self._xy(slots[old], self.depth, self.above, self.kids_height)
+        moved = np.ones(len(slots), dtype=bool)
+        moved[old] = (x != new_x) | (y != new_y)
+        return self._positions(slots[moved])
+
+    # Graph
+
+    def _add_nodes(self, nodes: List[Tuple[str, str]]) -> None:
+        count = len(nodes)
+        flows = []
+        for objid, flow in nodes:
+            self.slot[objid] = len(self.ids)
+            self.ids.append(objid)
+            flows.append(self.flows.setdefault(flow, len(self.flows)))
+        self.alive += [True] * count
+        self.kids += [[] for _ in range(count)]
+        self.parents += [[] for _ in range(count)]
+        self.flow = np.concatenate((self.flow, np.array(flows, dtype=np.intp)))
+        self._grow_flows()
+        np.add.at(self.flow_size, flows, 1)
+        self.index = _grow(self.index, count)
+        self.pre = _grow(self.pre, count, -1)
+        self.owner = _grow(self.owner, count, -1)
+        for name in ("depth", "above", "kids_height", "size"):
+            setattr(self, name, _grow(getattr(self, name), count))
+
+    def _grow_flows(self) -> None:
+        count = len(self.flows) - len(self.flow_sum)
+        self.flow_sum = _grow(self.flow_sum, count)
+        self.flow_size = _grow(self.flow_size, count)
+
+    def _remove(self, i: int) -> None:
+        self.alive[i] = False
+        self.flow_sum[self.flow[i]] -= self.index[i]
+        self.flow_size[self.flow[i]] -= 1
+        self._set_kids(i, [])
+
+    def _move(self, i: int, flow: str) -> None:
+        """Move a node to another flow"""
+        self.flow_sum[self.flow[i]] -= self.index[i]
+        self.flow_size[self.flow[i]] -= 1
+        self.flow[i] = self.flows.setdefault(flow, len(self.flows))
+        self._grow_flows()
+        self.flow_sum[self.flow[i]] += self.index[i]
+        self.flow_size[self.flow[i]] += 1
+
+    def _set_kids(self, i: int, kids: List[int]) -> None:
+        for kid in self.kids[i]:
+            self.parents[kid].remove(i)
+        self.kids[i] = kids
+        for kid in kids:
+            self.parents[kid].append(i)
+
+    def _roots(self) -> List[int]:
+        """
+        Nodes without incoming edges, then the first node of every part of the graph
+        which can not be reached from them
+        """
+        nodes = [i for i, alive in enumerate(self.alive) if alive]
+        roots = [i for i in nodes if not self.parents[i]]
+        reached = [False] * len(self.ids)
+        for i in roots:
+            reached[i] = True
+        stack = list(roots)
+        candidates = iter(nodes)
+        while True:
+            while stack:
+                for kid in self.kids[stack.pop()]:
+                    if not reached[kid]:
+                        reached[kid] = True
+                        stack.append(kid)
+            start = next((i for i in candidates if not reached[i]), None)
+            if start is None:
+                return roots
+            roots.append(start)
+            reached[start] = True
+            stack.append(start)
+
+    # Vertical indices
+
+    def _initial_indices(self) -> None:
+        """Position of every node among the children of its parent, depth first"""
+        index: List[Optional[int]] = [None] * len(self.ids)
+        stack = [(root, i) for i, root in enumerate(self.roots)][::-1]
+        while stack:
+            node, i = stack.pop()
+            if index[node] is not None:
+                continue
+            index[node] = i
+            kids = self.kids[node]
+            stack.extend(zip(reversed(kids), range(len(kids) - 1, -1, -1)))
+        self.index = np.array(index, dtype=float)
+        self.flow_sum = np.bincount(
+            self.flow, weights=self.index, minlength=len(self.flows)
+        )
+
+    def _relax(self, active: List[int]) -> None:
+        """
+        Pull the vertical indices of the active nodes towards their neighbours and
+        flows, the other nodes stay where they are. All of them are updated at once,
+        see the module docstring.
+        """
+        if not active:
+            return
+        nodes = np.array(active, dtype=np.intp)
+        count = len(active)
+        # Every edge pulls both of its ends: (active node, other end) pairs
+        pairs = np.array(
+            [
+                (k, other)
+                for k, i in enumerate(active)
+                for other in (*self.kids[i], *self.parents[i])
+            ],
+            dtype=np.intp,
+        ).reshape(-1, 2)
+        at, other = pairs[:, 0], pairs[:, 1]
+        degree = np.bincount(at, minlength=count)
+        flow = self.flow[nodes]
+        flow_size = self.flow_size[flow]
+        flows = len(self.flow_sum)
+        for _ in range(self.iterations):
+            index = self.index[nodes]
+            neighbours = np.bincount(at, weights=self.index[other], minlength=count)
+            tension = K * (neighbours - degree * index)
+            tension += F * (self.flow_sum[flow] - flow_size * index)
+            self.index[nodes] = index + tension
+            self.flow_sum += np.bincount(flow, weights=tension, minlength=flows)
+
+    # Placement
+
+    def _place_all(self) -> None:
+        self.order = self._walk(-1, lambda kid: False)
+        self._renumber()
+
+    def _renumber(self) -> None:
+        self.pre = np.full(len(self.ids), -1, dtype=np.intp)
+        self.pre[self.order] = np.arange(len(self.order))
+
+    def _common_owner(self, nodes: Set[int]) -> int:
+        """Closest node under which all the given ones were placed"""
+        common: Optional[int] = None
+        owner, depth = self.owner, self.depth
+        for node in nodes:
+            if node < 0:
+                raise _Fallback()
+            if common is None:
+                common = node
+                continue
+            a, b = common, node
+            while depth[a] > depth[b]:
+                a = owner[a]
+            while depth[b] > depth[a]:
+                b = owner[b]
+            while a != b and a >= 0:
+                a, b = owner[a], owner[b]
+            if a < 0:
+                raise _Fallback()
+            common = int(a)
+        if common is None:
+            raise _Fallback()
+        return common
+
+    def _place_under(self, top: int) -> List[int]:
+        """
+        Place the nodes under ``top`` again, return the nodes which may have moved.
+        Nodes placed before it stay where they are, and so do the ones placed after
+        it, except that they move by as much as its height changed.
+        """
+        start = int(self.pre[top])
+        stop = start + int(self.size[top])
+        pre = self.pre
+
+        def placed(kid: int) -> bool:
+            if pre[kid] >= stop:
+                # Would be placed earlier than it was
+                raise _Fallback()
+            return 0 <= pre[kid] < start
+
+        height = max(NODE_HEIGHT, self.kids_height[top])
+        order = self._walk(top, placed)
+        old = sum(1 for i in self.order[start:stop] if self.alive[i])
+        if sum(1 for i in order if pre[i] >= 0) != old or (
+            len(self.order) - (stop - start) + len(order) != len(self.slot)
+        ):
+            # Some nodes are not placed under it anymore, or can not be reached
+            raise _Fallback()
+        self.order[start:stop] = order
+        self._renumber()
+        changed = list(order)
+        # Its ancestors grow by as many nodes, and are centered on their children
+        # again if its height changed, which also moves the nodes after it
+        grown = len(order) - (stop - start)
+        delta = max(NODE_HEIGHT, self.kids_height[top]) - height
+        node = top
+        while node >= 0:
+            owner = int(self.owner[node])
+            if owner >= 0:
+                self.size[owner] += grown
+                end = int(self.pre[owner] + self.size[owner])
+            else:
+                end = len(self.order)
+            if delta:
+                after = self.order[int(self.pre[node] + self.size[node]) : end]
+                self.above[after] += delta
+                changed += after
+                if owner >= 0:
+                    height = max(NODE_HEIGHT, self.kids_height[owner])
+                    self.kids_height[owner] += delta
+                    delta = max(NODE_HEIGHT, self.kids_height[owner]) - height
+                    changed.append(owner)
+            node = owner
+        return changed
+
+    def _walk(self, top: int, placed: Callable[[int], bool]) -> List[int]:
+        """
+        Place ``top`` (-1: all the roots) and the nodes under it as a tree, each node
+        vertically centered on its children, return them in the order they were placed
+        """
+        index = self.index.tolist() if top < 0 else self.index
+        key = index.__getitem__
+        seen: Set[int] = set()
+        order: List[int] = []
+        owners: List[int] = []
+        depths: List[int] = []
+        aboves: List[float] = []
+        done: List[int] = []
+        heights: List[float] = []
+        sizes: List[int] = []
+
+        def enter(node: int, owner: int, depth: int, above: float) -> list:
+            seen.add(node)
+            order.append(node)
+            owners.append(owner)
+            depths.append(depth)
+            aboves.append(above)
+            kids = sorted(self.kids[node], key=key)
+            return [node, depth, above, kids, 0, 0.0, len(order) - 1]
+
+        # Frames of the nodes being placed: node, depth, y of the node above,
+        # children, number of children done, their total height (with gaps) and
+        # where the node is in the order
+        if top < 0:
+            stack = [[-1, -1, 0.0, sorted(self.roots, key=key), 0, 0.0, 0]]
+        else:
+            owner, depth = int(self.owner[top]), int(self.depth[top])
+            stack = [enter(top, owner, depth, float(self.above[top]))]
+        while stack:
+            frame = stack[-1]
+            node, depth, above, kids, i, height, entry = frame
+            if i < len(kids):
+                frame[4] += 1
+                kid = kids[i]
+                if kid in seen or placed(kid):
+                    # Already placed nodes take no space, only the gap
+                    frame[5] += ROW_GAP
+                else:
+                    stack.append(enter(kid, node, depth + 1, above + height))
+                continue
+            stack.pop()
+            if node < 0:
+                break
+            kids_height = max(height - ROW_GAP, 0)
+            done.append(node)
+            heights.append(kids_height)
+            sizes.append(len(order) - entry)
+            if stack:
+                stack[-1][5] += max(NODE_HEIGHT, kids_height) + ROW_GAP
+        self.owner[order] = owners
+        self.depth[order] = depths
+        self.above[order] = aboves
+        self.kids_height[done] = heights
+        self.size[done] = sizes
+        return order
+
+
+def layout(graph: Graph, iterations: int = MAX_ITER) -> Positions:
+    """Position (top left corner) of every node of the graph"""
+    return Layout(graph, iterations).positions()
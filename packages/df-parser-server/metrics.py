@@ -0,0 +1,213 @@
+"""
+Timing metrics of the messages handled by the server.
+
+Every message records how long it waited for the messages before it (``queued``), how
+long each stage of its handling took (``decode``, ``parse``, ``mutate``, ``codegen``,
+``reply`` and ``encode``), its latency from being read to its reply being encoded, and
+the size of the message and of the reply. These are kept in histograms by message name
+over a rolling window, along with the number of messages being handled (the queue
+depth) whenever one arrives. ``Metrics.stats`` summarizes them as percentiles, it is
+the reply of the ``stats`` message and what is written to the JSON lines dump.
+"""
+
+import asyncio
+import contextvars
+import json
+import math
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+# Buckets grow by 10%, so the percentiles are within 5% of the actual values
+_GROWTH = 1.1
+_LOG_GROWTH = math.log(_GROWTH)
+# Bucket of zero and negative values
+_ZERO = -(2**31)
+
+STAGES = ("queued", "decode", "parse", "mutate", "codegen", "reply", "encode")
+SIZES = ("message_bytes", "reply_bytes")
+
+
+class Histogram:
+    """Counts of values in exponentially growing buckets"""
+
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        bucket = math.floor(math.log(value) / _LOG_GROWTH) if value > 0 else _ZERO
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other: "Histogram") -> None:
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        """Estimate of the value below which a fraction ``q`` of the values are"""
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                if bucket == _ZERO:
+                    return 0.0
+                return min(_GROWTH ** (bucket + 0.5), self.max)
+        return self.max
+
+    def summary(self, scale: float = 1.0) -> dict:
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count * scale, 3),
+            "p50": round(self.quantile(0.5) * scale, 3),
+            "p99": round(self.quantile(0.99) * scale, 3),
+            "max": round(self.max * scale, 3),
+        }
+
+
+class Sample:
+    """Timings of a single message, recorded once it is replied to"""
+
+    __slots__ = ("name", "received", "times", "sizes")
+
+    def __init__(self, name: str, size: int, decode: float):
+        self.name = name
+        self.received = time.perf_counter()
+        self.times: Dict[str, float] = {"decode": decode}
+        self.sizes: Dict[str, int] = {"message_bytes": size}
+
+
+# Sample of the message handled by the current task
+_sample: contextvars.ContextVar[Optional[Sample]] = contextvars.ContextVar(
+    "sample", default=None
+)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Add the time spent in the block to a stage of the message being handled"""
+    sample = _sample.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if sample is not None:
+            elapsed = time.perf_counter() - start
+            sample.times[name] = sample.times.get(name, 0.0) + elapsed
+
+
+class Metrics:
+    """
+    Histograms of the last ``window`` to two ``window`` seconds: the histograms are
+    started over every ``window`` seconds, and the previous ones are kept meanwhile
+    """
+
+    def __init__(self, window: float = 60.0):
+        self.window = window
+        self.started = time.monotonic()
+        # Histograms by message name, then by stage (or size, or "latency")
+        self.current: Dict[str, Dict[str, Histogram]] = {}
+        self.previous: Dict[str, Dict[str, Histogram]] = {}
+        # Replies with an error or superseded since the start, by message name
+        self.errors: Dict[str, int] = {}
+        self.superseded: Dict[str, int] = {}
+        # Messages received and not replied to yet
+        self.depth = 0
+
+    def start(self, name: str, size: int, decode: float) -> Sample:
+        """Record a message which was just received and decoded"""
+        self.depth += 1
+        self._histogram("*", "queue_depth").add(self.depth)
+        return Sample(name, size, decode)
+
+    @staticmethod
+    def begin(sample: Sample) -> None:
+        """Start handling a message in the current task, it is not queued anymore"""
+        sample.times["queued"] = time.perf_counter() - sample.received
+        _sample.set(sample)
+
+    def finish(self, sample: Sample, reply: dict, size: int, encode: float) -> None:
+        """Record a message once its reply was encoded"""
+        self.depth -= 1
+        if "error" in reply:
+            self.errors[sample.name] = self.errors.get(sample.name, 0) + 1
+        if reply.get("superseded"):
+            self.superseded[sample.name] = self.superseded.get(sample.name, 0) + 1
+            return
+        sample.times["encode"] = encode
+        sample.sizes["reply_bytes"] = size
+        latency = time.perf_counter() - sample.received + sample.times["decode"]
+        self._histogram(sample.name, "latency").add(latency)
+        for stage, seconds in sample.times.items():
+            self._histogram(sample.name, stage).add(seconds)
+        for key, value in sample.sizes.items():
+            self._histogram(sample.name, key).add(value)
+
+    def stats(self) -> dict:
+        """Percentiles of the window, times in milliseconds"""
+        self._rotate()
+        merged: Dict[str, Dict[str, Histogram]] = {}
+        for histograms in (self.previous, self.current):
+            for name, keys in histograms.items():
+                for key, histogram in keys.items():
+                    merged.setdefault(name, {}).setdefault(key, Histogram()).merge(
+                        histogram
+                    )
+        queue = merged.pop("*", {}).get("queue_depth")
+        messages = {}
+        for name, keys in sorted(merged.items()):
+            summary = {
+                key: keys[key].summary(1 if key in SIZES else 1000)
+                for key in ("latency", *STAGES, *SIZES)
+                if key in keys
+            }
+            summary["errors"] = self.errors.get(name, 0)
+            summary["superseded"] = self.superseded.get(name, 0)
+            messages[name] = summary
+        return {
+            "window": round(time.monotonic() - self._window_start(), 3),
+            "depth": self.depth,
+            "queue_depth": queue.summary() if queue is not None else None,
+            "messages": messages,
+        }
+
+    async def dump(self, path: str, interval: float) -> None:
+        """Append the stats to a JSON lines file every ``interval`` seconds, forever"""
+        while True:
+            await asyncio.sleep(interval)
+            self.write(path)
+
+    def write(self, path: str) -> None:
+        with open(path, "a") as out:
+            out.write(json.dumps({"time": time.time(), **self.stats()}) + "\n")
+
+    def _window_start(self) -> float:
+        return self.started - self.window if self.previous else self.started
+
+    def _rotate(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.started
+        if elapsed < self.window:
+            return
+        # Nothing was recorded during the last window if it ended a while ago
+        self.previous = self.current if elapsed < 2 * self.window else {}
+        self.current = {}
+        self.started = now
+
+    def _histogram(self, name: str, key: str) -> Histogram:
+        self._rotate()
+        keys = self.current.setdefault(name, {})
+        histogram = keys.get(key)
+        if histogram is None:
+            histogram = keys[key] = Histogram()
+        return histogram
@@ -0,0 +1,157 @@
+"""
+Content-addressed parse cache on disk, so that reopening a script is fast.
+
+Two kinds of entries are kept in a SQLite database: the fragment of each chunk, keyed
+by the chunk key, and the plot of whole scripts (as a ``CompactPlot``), keyed by the
+hash of the source. Keys also include the version of the parser, so that entries
+written by another version are never used (they are evicted eventually). The size of
+the database is bounded, the least recently used entries are evicted first.
+"""
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from compact import CompactPlot
+from plot_parser import Fragment, content_hash
+
+CACHE_BYTES = 256 * 1024**2
+# Eviction removes more than needed, so that it does not run on every write
+EVICT_RATIO = 0.8
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key BLOB PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+"""
+
+
+def _batches(keys: List[bytes]) -> Iterator[Tuple[List[bytes], str]]:
+    """Split keys in batches below the SQLite limit on the number of parameters"""
+    for i in range(0, len(keys), 500):
+        batch = keys[i : i + 500]
+        yield batch, ",".join("?" * len(batch))
+
+
+def default_path() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join("~", ".cache")
+    return os.path.join(
+        os.path.expanduser(base), "dialog-flow-designer", "parse-cache.sqlite"
+    )
+
+
+def parser_version() -> bytes:
+    """Hash of the parser and plot format code, any change to it invalidates the cache"""
+    import compact
+    import plot_parser
+
+    h = hashlib.blake2b(digest_size=8)
+    for module in (plot_parser, compact):
+        with open(module.__file__, "rb") as f:
+            h.update(f.read())
+    return h.digest()
+
+
+class ParseCache:
+    def __init__(self, path: str, max_bytes: int = CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.version = parser_version()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(_SCHEMA)
+        (size,) = self.db.execute("SELECT TOTAL(size) FROM entries").fetchone()
+        self.size = int(size)
+
+    def plot(self, source: str) -> Optional[CompactPlot]:
+        value = self._get([self._plot_key(source)])[0]
+        return pickle.loads(value) if value is not None else None
+
+    def put_plot(self, source: str, plot: CompactPlot) -> None:
+        self._put([(self._plot_key(source), pickle.dumps(plot, -1))])
+
+    def fragments(self, keys: List[bytes]) -> List[Optional[Fragment]]:
+        """Cached fragments of the chunks with the given keys, ``None`` if missing"""
+        values = self._get([self._key(b"fragment", key) for key in keys])
+        return [pickle.loads(v) if v is not None else None for v in values]
+
+    def put_fragments(self, fragments: Iterable[Tuple[bytes, Fragment]]) -> None:
+        self._put(
+            [
+                (self._key(b"fragment", key), pickle.dumps(fragment, -1))
+                for key, fragment in fragments
+            ]
+        )
+
+    def close(self) -> None:
+        self.db.close()
+
+    def _key(self, kind: bytes, key: bytes) -> bytes:
+        return hashlib.blake2b(self.version + kind + key, digest_size=16).digest()
+
+    def _plot_key(self, source: str) -> bytes:
+        return self._key(b"plot", content_hash(source))
+
+    def _get(self, keys: List[bytes]) -> List[Optional[bytes]]:
+        found = {}
+        for batch, marks in _batches(keys):
+            found.update(
+                self.db.execute(
+                    f"SELECT key, value FROM entries WHERE key IN ({marks})", batch
+                )
+            )
+        if found:
+            now = time.time()
+            with self.db:
+                self.db.executemany(
+                    "UPDATE entries SET used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+        return [found.get(key) for key in keys]
+
+    def _put(self, entries: List[Tuple[bytes, bytes]]) -> None:
+        if not entries:
+            return
+        now = time.time()
+        with self.db:
+            keys = [key for key, _ in entries]
+            replaced = self._sizes(keys)
+            self.db.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                [(key, value, len(value), now) for key, value in entries],
+            )
+        self.size += sum(len(value) for _, value in entries) - replaced
+        if self.size > self.max_bytes:
+            self._evict(int(self.max_bytes * EVICT_RATIO))
+
+    def _sizes(self, keys: List[bytes]) -> int:
+        total = 0
+        for batch, marks in _batches(keys):
+            (size,) = self.db.execute(
+                f"SELECT TOTAL(size) FROM entries WHERE key IN ({marks})", batch
+            ).fetchone()
+            total += int(size)
+        return total
+
+    def _evict(self, target: int) -> None:
+        """Remove the least recently used entries, until the size is below target"""
+        # Other servers (eg. of other windows) may have written to the database
+        (size,) = self.db.execute("SELECT TOTAL(size) FROM entries").fetchone()
+        self.size = int(size)
+        removed = []
+        for key, size in self.db.execute("SELECT key, size FROM entries ORDER BY used"):
+            if self.size <= target:
+                break
+            removed.append((key,))
+            self.size -= size
+        with self.db:
+            self.db.executemany("DELETE FROM entries WHERE key = ?", removed)
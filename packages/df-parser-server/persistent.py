@@ -0,0 +1,234 @@
+"""
+Persistent (immutable) maps, which share most of their structure with the maps they
+were made from.
+
+A map is a hash array mapped trie: every node has up to 32 children, picked by 5 bits
+of the hash of the key, and only keeps the children it has (as a bitmap and a tuple).
+Setting or deleting a key copies the nodes from the root to the key, about log32(n)
+of them, and the other nodes are shared with the previous map. This is what keeps the
+plots of the undo history small (see ``history``): every version costs a few nodes
+per changed object instead of a copy of its tables.
+"""
+
+from typing import Any, Hashable, Iterator, Mapping, Optional, Tuple
+
+_BITS = 5
+_MASK = (1 << _BITS) - 1
+_HASH_BITS = 64
+_HASH_MASK = (1 << _HASH_BITS) - 1
+# Rough size of the node copied on each level by a change, in bytes: the object and
+# its tuple of up to 32 children
+NODE_BYTES = 400
+
+
+def _hash(key: Hashable) -> int:
+    return hash(key) & _HASH_MASK
+
+
+def _index(bitmap: int, bit: int) -> int:
+    return bin(bitmap & (bit - 1)).count("1")
+
+
+class _Node:
+    __slots__ = ("bitmap", "entries")
+
+    def __init__(self, bitmap: int, entries: tuple):
+        self.bitmap = bitmap
+        # (key, value) pairs and child nodes, in the order of their bits
+        self.entries = entries
+
+
+class _Collision:
+    """Keys whose hashes are the same, below the last level"""
+
+    __slots__ = ("pairs",)
+
+    def __init__(self, pairs: tuple):
+        self.pairs = pairs
+
+
+_EMPTY = _Node(0, ())
+
+
+def _pair(shift: int, first: tuple, second: tuple) -> Any:
+    """Smallest subtree holding two pairs whose keys differ"""
+    if shift >= _HASH_BITS:
+        return _Collision((first, second))
+    a = (_hash(first[0]) >> shift) & _MASK
+    b = (_hash(second[0]) >> shift) & _MASK
+    if a == b:
+        return _Node(1 << a, (_pair(shift + _BITS, first, second),))
+    entries = (first, second) if a < b else (second, first)
+    return _Node((1 << a) | (1 << b), entries)
+
+
+def _build(hashed: list, shift: int) -> Any:
+    """Node of (hash, pair)s whose keys are all different"""
+    if shift >= _HASH_BITS:
+        return _Collision(tuple(pair for _, pair in hashed))
+    buckets: dict = {}
+    for item in hashed:
+        buckets.setdefault((item[0] >> shift) & _MASK, []).append(item)
+    bitmap = 0
+    entries = []
+    for index in sorted(buckets):
+        bucket = buckets[index]
+        bitmap |= 1 << index
+        if len(bucket) == 1:
+            entries.append(bucket[0][1])
+        else:
+            entries.append(_build(bucket, shift + _BITS))
+    return _Node(bitmap, tuple(entries))
+
+
+def _set(node: Any, shift: int, h: int, key: Hashable, value: Any) -> Tuple[Any, bool]:
+    """The node with a key set, and whether the key was added"""
+    if isinstance(node, _Collision):
+        for i, (k, v) in enumerate(node.pairs):
+            if k == key:
+                if v is value:
+                    return node, False
+                pairs = node.pairs[:i] + ((key, value),) + node.pairs[i + 1 :]
+                return _Collision(pairs), False
+        return _Collision(node.pairs + ((key, value),)), True
+    bit = 1 << ((h >> shift) & _MASK)
+    i = _index(node.bitmap, bit)
+    entries = node.entries
+    if not node.bitmap & bit:
+        entries = entries[:i] + ((key, value),) + entries[i:]
+        return _Node(node.bitmap | bit, entries), True
+    entry = entries[i]
+    if type(entry) is tuple:
+        if entry[0] == key:
+            if entry[1] is value:
+                return node, False
+            new, added = (key, value), False
+        else:
+            new, added = _pair(shift + _BITS, entry, (key, value)), True
+    else:
+        new, added = _set(entry, shift + _BITS, h, key, value)
+        if new is entry:
+            return node, False
+    return _Node(node.bitmap, entries[:i] + (new,) + entries[i + 1 :]), added
+
+
+def _delete(node: Any, shift: int, h: int, key: Hashable) -> Any:
+    """
+    The node without a key: the same node if it was not there, ``None`` if nothing is
+    left, or the last pair if a single one is left (below the root)
+    """
+    if isinstance(node, _Collision):
+        pairs = tuple(pair for pair in node.pairs if pair[0] != key)
+        if len(pairs) == len(node.pairs):
+            return node
+        return pairs[0] if len(pairs) == 1 else _Collision(pairs)
+    bit = 1 << ((h >> shift) & _MASK)
+    if not node.bitmap & bit:
+        return node
+    i = _index(node.bitmap, bit)
+    entries = node.entries
+    entry = entries[i]
+    if type(entry) is tuple:
+        if entry[0] != key:
+            return node
+        new = None
+    else:
+        new = _delete(entry, shift + _BITS, h, key)
+        if new is entry:
+            return node
+    if new is None:
+        entries = entries[:i] + entries[i + 1 :]
+        if not entries:
+            return None
+        if shift and len(entries) == 1 and type(entries[0]) is tuple:
+            return entries[0]
+        return _Node(node.bitmap & ~bit, entries)
+    if shift and len(entries) == 1 and type(new) is tuple:
+        return new
+    return _Node(node.bitmap, entries[:i] + (new,) + entries[i + 1 :])
+
+
+def _pairs(node: Any) -> Iterator[tuple]:
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        for entry in node.pairs if isinstance(node, _Collision) else node.entries:
+            if type(entry) is tuple:
+                yield entry
+            else:
+                stack.append(entry)
+
+
+class PMap(Mapping):
+    """Persistent map, ``set`` and ``delete`` return a new map"""
+
+    __slots__ = ("_root", "_length")
+
+    def __init__(self, items: Optional[Mapping] = None):
+        self._root: Any = _EMPTY
+        self._length = 0
+        if items:
+            # All at once, rather than copying the path of every key
+            pairs = dict(items.items())
+            self._root = _build([(_hash(pair[0]), pair) for pair in pairs.items()], 0)
+            self._length = len(pairs)
+
+    @classmethod
+    def _make(cls, root: Any, length: int) -> "PMap":
+        pmap = cls.__new__(cls)
+        pmap._root = root
+        pmap._length = length
+        return pmap
+
+    def __getitem__(self, key: Hashable) -> Any:
+        h = _hash(key)
+        node = self._root
+        shift = 0
+        while True:
+            if isinstance(node, _Collision):
+                for k, v in node.pairs:
+                    if k == key:
+                        return v
+                raise KeyError(key)
+            bit = 1 << ((h >> shift) & _MASK)
+            if not node.bitmap & bit:
+                raise KeyError(key)
+            entry = node.entries[_index(node.bitmap, bit)]
+            if type(entry) is tuple:
+                if entry[0] == key:
+                    return entry[1]
+                raise KeyError(key)
+            node = entry
+            shift += _BITS
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return (key for key, _ in _pairs(self._root))
+
+    def __len__(self) -> int:
+        return self._length
+
+    def items(self) -> Iterator[Tuple[Hashable, Any]]:  # type: ignore[override]
+        return _pairs(self._root)
+
+    def set(self, key: Hashable, value: Any) -> "PMap":
+        root, added = _set(self._root, 0, _hash(key), key, value)
+        if root is self._root:
+            return self
+        return self._make(root, self._length + added)
+
+    def delete(self, key: Hashable) -> "PMap":
+        root = _delete(self._root, 0, _hash(key), key)
+        if root is self._root:
+            return self
+        return self._make(_EMPTY if root is None else root, self._length - 1)
+
+    def depth(self) -> int:
+        """Levels of nodes a change copies, about log32 of the length"""
+        length, depth = self._length, 1
+        while length > 1 << _BITS:
+            length >>= _BITS
+            depth += 1
+        return depth
+
+    def to_dict(self) -> dict:
+        return dict(_pairs(self._root))
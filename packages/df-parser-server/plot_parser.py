@@ -0,0 +1,1149 @@
+"""
+Incremental parser turning dff scripts into the ``Plot`` format (see
+``shared-types/df-parser-server.ts``).
+
+Instead of parsing the whole module with libcst on every change, the source is
+first split into chunks with a cheap bracket/string scanner: one chunk per top-level
+statement, and one chunk per node entry inside the ``flows`` dict. Each chunk is
+parsed on its own and the resulting plot pieces (a :class:`Fragment`) are cached by
+the hash of the chunk text, so an edit inside a single node only reparses that node.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import re
+import textwrap
+import weakref
+from bisect import bisect_left
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+import libcst as cst
+import numpy as np
+
+# The order of the tables in the ``Plot`` interface
+TABLES = (
+    "imports",
+    "py_defs",
+    "plots",
+    "flows",
+    "nodes",
+    "transitions",
+    "responses",
+    "processings",
+    "miscs",
+    "linking",
+)
+
+TYPE_PREFIXES = {
+    "flows": "fl",
+    "imports": "im",
+    "linking": "ln",
+    "miscs": "ms",
+    "plots": "pl",
+    "processings": "pr",
+    "py_defs": "df",
+    "responses": "rs",
+    "transitions": "tr",
+    "nodes": "nd",
+}
+
+# Maximum number of fragments kept in the cache
+CACHE_SIZE = 8192
+
+# Characters the scanner has to look at, everything else is skipped by the regex engine
+_INTERESTING = re.compile(r"[()\[\]{},:\n#'\"\\]")
+_STRING = re.compile(
+    r"""'''(?:\\[\s\S]|[^\\])*?'''|\"\"\"(?:\\[\s\S]|[^\\])*?\"\"\"
+    |'(?:\\.|[^'\\\n])*'|"(?:\\.|[^"\\\n])*\"""",
+    re.VERBOSE,
+)
+# Lines starting with these keywords continue the previous compound statement
+_CONTINUATIONS = re.compile(r"(?:else|elif|except|finally)\b")
+_DECORATED = re.compile(r"(?:@|def\b|class\b|async\b)")
+_PLOT_HEAD = re.compile(r"([A-Za-z_]\w*)\s*(?::[^=\n]*)?=\s*\{")
+_DFF_KEYWORDS = re.compile(r"\b(?:TRANSITIONS|RESPONSE|GLOBAL|LOCAL)\b")
+
+_EMPTY_MODULE = cst.Module(body=[])
+
+Plot = Dict[str, Dict[str, Any]]
+
+
+class ParseError(Exception):
+    """The source could not be parsed as a dff script."""
+
+
+def named_id(table: str, *key: str) -> str:
+    """
+    Id of an object identified by its name (eg. a node by its plot, flow and name).
+    These are derived from the name, so every process assigns the same ids.
+    """
+    digest = hashlib.blake2b(
+        "\0".join(key).encode(), digest_size=4, person=table.encode()
+    )
+    return f"id#{TYPE_PREFIXES[table]}_{digest.hexdigest()}"
+
+
+def import_id(name: str, count: int) -> str:
+    """
+    Id of the import of a name following ``count`` others of it in the script. Like the
+    objects of a fragment with the same path (see ``Fragment.new_id``), imports binding
+    a name again are numbered in the order of the source.
+    """
+    if count == 0:
+        return named_id("imports", name)
+    return named_id("imports", name, str(count))
+
+
+def content_hash(*parts: str) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part.encode("utf-8", "surrogatepass"))
+        h.update(b"\0")
+    return h.digest()
+
+
+def code_for(node: cst.CSTNode) -> str:
+    return _EMPTY_MODULE.code_for_node(node)
+
+
+# SCANNING
+
+
+@dataclass
+class Scan:
+    """Structural tokens of a source, enough to split it into chunks"""
+
+    # (position, character, depth) of every bracket, comma and colon
+    marks: List[Tuple[int, str, int]]
+    # Positions of newlines outside any brackets or strings
+    newlines: List[int]
+    # Number of brackets left open at the end of the source
+    depth: int
+
+
+def scan(source: str) -> Scan:
+    marks: List[Tuple[int, str, int]] = []
+    newlines: List[int] = []
+    depth = 0
+    pos = 0
+    search = _INTERESTING.search
+    while True:
+        m = search(source, pos)
+        if m is None:
+            break
+        i = m.start()
+        char = source[i]
+        pos = i + 1
+        if char in "([{":
+            marks.append((i, char, depth))
+            depth += 1
+        elif char in ")]}":
+            depth -= 1
+            if depth < 0:
+                line = source.count("\n", 0, i) + 1
+                raise ParseError(f"Unmatched '{char}' at line {line}")
+            marks.append((i, char, depth))
+        elif char == "\n":
+            if depth == 0:
+                newlines.append(i)
+        elif char in ",:":
+            marks.append((i, char, depth))
+        elif char == "#":
+            pos = source.find("\n", i)
+            if pos == -1:
+                break
+        elif char == "\\":
+            # Line continuation
+            pos = i + 2
+        else:
+            string = _STRING.match(source, i)
+            if string is None:
+                line = source.count("\n", 0, i) + 1
+                raise ParseError(f"Unterminated string literal at line {line}")
+            pos = string.end()
+    return Scan(marks, newlines, depth)
+
+
+def split_statements(source: str, newlines: List[int]) -> List[int]:
+    """
+    Return the start offsets of the top-level statements. Blank and comment lines
+    preceding a statement belong to it (libcst does the same with ``leading_lines``).
+    """
+    starts = [0]
+    first_code = 0
+    for nl in newlines:
+        i = nl + 1
+        if i >= len(source) or source[i] in " \t\f\r\n#":
+            continue
+        if _CONTINUATIONS.match(source, i):
+            continue
+        if source.startswith("@", first_code) and _DECORATED.match(source, i):
+            continue
+        first_code = i
+        start = i
+        while start > starts[-1]:
+            prev = source.rfind("\n", 0, start - 1) + 1
+            line = source[prev:start]
+            if line.strip() and not line.startswith("#"):
+                break
+            start = prev
+        if start > starts[-1]:
+            starts.append(start)
+    return starts
+
+
+# FRAGMENTS
+
+
+class ChunkSource(NamedTuple):
+    """Everything needed to build the fragment of a chunk, possibly in another process"""
+
+    # "stmt" for top-level statements, "node" for node entries of a plot
+    kind: str
+    text: str
+    # Line number of the first line of the chunk, for error messages
+    line: int
+    plot: str = ""
+    flow: str = ""
+
+    @property
+    def key(self) -> bytes:
+        return content_hash(self.kind, self.plot, self.flow, self.text)
+
+
+@dataclass
+class Fragment:
+    """Plot objects produced by a single chunk of the source"""
+
+    tables: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    # Names of the python objects referenced (value: ``None``) or defined (value: code)
+    py_defs: Dict[str, Optional[str]] = field(default_factory=dict)
+    # Transition id -> (flow name, node name, label code), resolved during assembly
+    targets: Dict[str, Tuple[str, str, str]] = field(default_factory=dict)
+    # The CST of the chunk, and the CST node of each object. These are not sent between
+    # processes, ``PlotParser.materialize`` rebuilds them when needed.
+    cst: Optional[cst.CSTNode] = None
+    cst_nodes: Dict[str, cst.CSTNode] = field(default_factory=dict)
+    # Ids given out while building the fragment
+    _taken: Set[str] = field(default_factory=set, repr=False)
+
+    def __getstate__(self):
+        return {**self.__dict__, "cst": None, "cst_nodes": {}, "_taken": set()}
+
+    def new_id(self, table: str, *path: str) -> str:
+        """
+        Id of a new object, derived from its path in the plot (eg. the node and the
+        target of a transition) so that it stays the same as long as the path does.
+        Objects with the same path are numbered in the order of the source.
+        """
+        objid = named_id(table, *path)
+        count = 0
+        while objid in self._taken:
+            count += 1
+            objid = named_id(table, *path, str(count))
+        self._taken.add(objid)
+        return objid
+
+    def add(
+        self, table: str, obj: Dict[str, Any], node: cst.CSTNode, objid: str
+    ) -> str:
+        self.tables.setdefault(table, {})[objid] = obj
+        self.cst_nodes[objid] = node
+        return objid
+
+
+def _literal(expr: cst.BaseExpression) -> Any:
+    """Evaluate a literal expression, raise ``ValueError`` if it's not a literal"""
+    if isinstance(expr, (cst.SimpleString, cst.ConcatenatedString)):
+        return expr.evaluated_value
+    if isinstance(expr, (cst.Integer, cst.Float)):
+        return expr.evaluated_value
+    if isinstance(expr, cst.UnaryOperation) and isinstance(expr.operator, cst.Minus):
+        return -_literal(expr.expression)
+    raise ValueError(code_for(expr))
+
+
+def _text(expr: cst.BaseExpression) -> str:
+    """Value of string literals, code of everything else"""
+    if isinstance(expr, (cst.SimpleString, cst.ConcatenatedString)):
+        value = expr.evaluated_value
+        if isinstance(value, str):
+            return value
+    return code_for(expr)
+
+
+def keyword(expr: cst.BaseExpression) -> Optional[str]:
+    """Name of a dff keyword used as a dict key, eg. ``RESPONSE`` or ``"response"``"""
+    if isinstance(expr, cst.Name):
+        return expr.value.upper()
+    if isinstance(expr, cst.Attribute):
+        return expr.attr.value.upper()
+    if isinstance(expr, cst.SimpleString):
+        return str(expr.evaluated_value).upper()
+    return None
+
+
+def label_target(label: cst.BaseExpression, flow: str):
+    """
+    Split a transition label like ``("flow", "node", 1.5)`` into the (flow, node)
+    target and the priority. Either can be ``None``.
+    """
+    try:
+        if isinstance(label, cst.Tuple):
+            parts = [_literal(el.value) for el in label.elements]
+        else:
+            parts = [_literal(label)]
+    except ValueError:
+        return None, None
+    priority = None
+    if len(parts) > 1 and isinstance(parts[-1], (int, float)):
+        priority = parts.pop()
+    if len(parts) == 1 and isinstance(parts[0], str):
+        return (flow, parts[0]), priority
+    if len(parts) == 2 and all(isinstance(p, str) for p in parts):
+        return (parts[0], parts[1]), priority
+    return None, priority
+
+
+class _NodeBuilder:
+    """Collects the plot objects of a single node entry into a fragment"""
+
+    def __init__(self, fragment: Fragment, plot: str, flow: str):
+        self.fragment = fragment
+        self.plot = plot
+        self.flow = flow
+
+    def py_def(self, expr: cst.BaseExpression) -> str:
+        name = code_for(expr)
+        self.fragment.py_defs.setdefault(name, None)
+        return named_id("py_defs", name)
+
+    def value(
+        self, expr: cst.BaseExpression, path: Tuple[str, ...], parent: str
+    ) -> Any:
+        if isinstance(expr, (cst.Name, cst.Attribute)):
+            return self.py_def(expr)
+        if isinstance(expr, cst.Call):
+            return self.linking(expr, path, parent)
+        if isinstance(expr, (cst.List, cst.Tuple, cst.Set)):
+            return [
+                self.value(el.value, (*path, str(i)), parent)
+                for i, el in enumerate(expr.elements)
+            ]
+        return _text(expr)
+
+    def linking(
+        self,
+        expr: cst.BaseExpression,
+        path: Tuple[str, ...],
+        parent: Optional[str] = None,
+    ) -> str:
+        objid = self.fragment.new_id("linking", *path)
+        obj: Dict[str, Any] = {}
+        if isinstance(expr, cst.Call):
+            obj["object"] = self.value(expr.func, (objid, "object"), objid)
+            args = [
+                self.value(arg.value, (objid, "args", str(i)), objid)
+                for i, arg in enumerate(a for a in expr.args if a.keyword is None)
+            ]
+            kwargs = {
+                arg.keyword.value: self.value(
+                    arg.value, (objid, "kwargs", arg.keyword.value), objid
+                )
+                for arg in expr.args
+                if arg.keyword is not None
+            }
+            if args:
+                obj["args"] = args
+            if kwargs:
+                obj["kwargs"] = kwargs
+        else:
+            obj["object"] = self.py_def(expr)
+        if parent is not None:
+            obj["parent"] = parent
+        return self.fragment.add("linking", obj, expr, objid)
+
+    def reference(self, expr: cst.BaseExpression, *path: str) -> str:
+        """Conditions, responses etc. are either a linking or plain code"""
+        if isinstance(expr, (cst.Name, cst.Attribute, cst.Call)):
+            return self.linking(expr, path)
+        return _text(expr)
+
+    def transition(self, element: cst.DictElement, node_id: str) -> str:
+        label = element.key
+        target = priority = None
+        linked = isinstance(label, (cst.Name, cst.Attribute, cst.Call))
+        if not linked:
+            target, priority = label_target(label, self.flow)
+        # Transitions are told apart by their target rather than their position, so
+        # that reordering them or changing their condition keeps the ids
+        key = ("node", *target) if target is not None else ("label", code_for(label))
+        objid = self.fragment.new_id("transitions", node_id, *key)
+        trans: Dict[str, Any] = {
+            "label": "",
+            "condition": self.reference(element.value, objid, "condition"),
+        }
+        if linked:
+            trans["label"] = self.linking(label, (objid, "label"))
+        else:
+            if priority is not None:
+                trans["priority"] = priority
+            trans["label"] = code_for(label)
+        self.fragment.add("transitions", trans, element, objid)
+        if target is not None:
+            self.fragment.targets[objid] = (*target, trans["label"])
+        return objid
+
+    def node(self, element: cst.DictElement) -> None:
+        key = keyword(element.key) if isinstance(element.key, cst.Name) else None
+        objid = named_id("nodes", self.plot, self.flow, code_for(element.key))
+        node: Dict[str, Any] = {}
+        if key in ("GLOBAL", "LOCAL"):
+            node["type"] = key.lower()
+        else:
+            node["type"] = "regular"
+            try:
+                node["name"] = str(_literal(element.key))
+            except ValueError:
+                node["name"] = code_for(element.key)
+        if isinstance(element.value, cst.Dict):
+            for prop in element.value.elements:
+                if isinstance(prop, cst.DictElement):
+                    self.node_prop(node, objid, keyword(prop.key), prop.value)
+        self.fragment.add("nodes", node, element, objid)
+
+    def node_prop(
+        self,
+        node: Dict[str, Any],
+        node_id: str,
+        key: Optional[str],
+        value: cst.BaseExpression,
+    ):
+        if key == "RESPONSE":
+            objid = self.fragment.new_id("responses", node_id)
+            response = {"response_object": self.reference(value, objid, "response")}
+            node["response"] = self.fragment.add("responses", response, value, objid)
+        elif key == "TRANSITIONS" and isinstance(value, cst.Dict) and value.elements:
+            node["transitions"] = [
+                self.transition(el, node_id)
+                for el in value.elements
+                if isinstance(el, cst.DictElement)
+            ]
+        elif key == "PROCESSING" and isinstance(value, cst.Dict):
+            objid = self.fragment.new_id("processings", node_id)
+            items = [
+                {
+                    code_for(el.key): self.reference(
+                        el.value, objid, "items", code_for(el.key)
+                    )
+                }
+                for el in value.elements
+                if isinstance(el, cst.DictElement)
+            ]
+            node["processing"] = self.fragment.add(
+                "processings", {"items": items}, value, objid
+            )
+        elif key == "MISC" and isinstance(value, cst.Dict):
+            items = {}
+            for el in value.elements:
+                if isinstance(el, cst.DictElement):
+                    items[_text(el.key)] = _text(el.value)
+            objid = self.fragment.new_id("miscs", node_id)
+            node["misc"] = self.fragment.add("miscs", {"items": items}, value, objid)
+
+
+def _comment(leading_lines) -> Optional[str]:
+    comments = [
+        line.comment.value for line in leading_lines if line.comment is not None
+    ]
+    return "\n".join(comments) if comments else None
+
+
+def _import_codes(stmt: cst.BaseSmallStatement) -> List[Tuple[str, str]]:
+    """(name, code) of each name imported by the statement"""
+    res = []
+    if isinstance(stmt, cst.Import):
+        for alias in stmt.names:
+            code = f"import {code_for(alias.name)}"
+            if alias.asname is not None:
+                code += f" as {code_for(alias.asname.name)}"
+            res.append((alias.evaluated_alias or alias.evaluated_name, code))
+    elif isinstance(stmt, cst.ImportFrom):
+        module = "." * len(stmt.relative) + (
+            code_for(stmt.module) if stmt.module else ""
+        )
+        if isinstance(stmt.names, cst.ImportStar):
+            return [("*", f"from {module} import *")]
+        for alias in stmt.names:
+            code = f"from {module} import {code_for(alias.name)}"
+            if alias.asname is not None:
+                code += f" as {code_for(alias.asname.name)}"
+            res.append((alias.evaluated_alias or alias.evaluated_name, code))
+    return res
+
+
+class _DefCollector(cst.CSTVisitor):
+    def __init__(self, module: cst.Module):
+        self.module = module
+        self.defs: Dict[str, str] = {}
+
+    def visit_FunctionDef(self, node: cst.FunctionDef) -> None:
+        code = textwrap.dedent(self.module.code_for_node(node))
+        self.defs.setdefault(node.name.value, code)
+
+
+def build_fragment(chunk: ChunkSource) -> Fragment:
+    """
+    Parse a chunk and collect its plot objects.
+
+    This is a pure function of the chunk, so it can run in a worker process, and
+    building the same chunk again gives the exact same ids.
+    """
+    fragment = Fragment()
+    try:
+        if chunk.kind == "node":
+            fragment.cst = cst.parse_expression("{" + chunk.text + "\n}")
+        else:
+            fragment.cst = cst.parse_module(chunk.text)
+    except cst.ParserSyntaxError as e:
+        line = chunk.line + e.raw_line - 1
+        raise ParseError(f"Syntax error at line {line}: {e.message}") from e
+
+    if chunk.kind == "node":
+        builder = _NodeBuilder(fragment, chunk.plot, chunk.flow)
+        for element in fragment.cst.elements:
+            if isinstance(element, cst.DictElement):
+                builder.node(element)
+    else:
+        module = fragment.cst
+        for i, stmt in enumerate(module.body):
+            if isinstance(stmt, cst.SimpleStatementLine):
+                comment = _comment(
+                    [*(module.header if i == 0 else ()), *stmt.leading_lines]
+                )
+                for small in stmt.body:
+                    for name, code in _import_codes(small):
+                        obj = {"name": name, "code": code}
+                        if comment is not None:
+                            obj["comment"] = comment
+                            comment = None
+                        # Like nodes, imports are identified by the name they bind,
+                        # the ones of other statements binding it again are numbered
+                        # once the plot is assembled (see ``import_id``)
+                        objid = fragment.new_id("imports", name)
+                        fragment.add("imports", obj, stmt, objid)
+        collector = _DefCollector(module)
+        module.visit(collector)
+        fragment.py_defs.update(collector.defs)
+    fragment._taken = set()
+    return fragment
+
+
+def build_fragments(chunks: List[ChunkSource]) -> List[Fragment]:
+    return [build_fragment(chunk) for chunk in chunks]
+
+
+# PARSER
+
+
+@dataclass(eq=False)
+class Chunk:
+    """
+    A chunk of the source along with the plot objects parsed from it. Its offsets are
+    kept by the plan (see ``ParsePlan.span``), so that the plans following an edit of
+    another chunk keep the chunk as it is.
+    """
+
+    # Index of the start of the chunk in ``ParsePlan.positions``, the end follows it
+    slot: int
+    # ``None`` until built, see ``ParsePlan``
+    fragment: Optional[Fragment]
+    # Name of the plot and the flow containing the node, ``None`` for statements
+    plot: Optional[str] = None
+    flow: Optional[str] = None
+    # Index of the plot in ``ParsePlan.plots`` (-1 for statements), of the flow in the
+    # plot (-1 for the nodes at the top level of the plot) and of the chunk in its list
+    path: Tuple[int, int, int] = (-1, -1, 0)
+
+    @property
+    def is_node(self) -> bool:
+        return self.plot is not None
+
+    @property
+    def kind(self) -> str:
+        return "node" if self.is_node else "stmt"
+
+
+@dataclass(eq=False)
+class FlowSpec:
+    name: str
+    objid: str
+    # Index of the span of the flow key (eg. ``"greeting_flow"``) in
+    # ``ParsePlan.positions``
+    key_slot: int
+    # Index of the closing brace of the flow dict, ``None`` if the value isn't a dict
+    close_slot: Optional[int]
+    node_chunks: List[Chunk] = field(default_factory=list)
+
+
+@dataclass(eq=False)
+class PlotSpec:
+    name: str
+    objid: str
+    flows: List[FlowSpec] = field(default_factory=list)
+    # Nodes at the top level of the plot dict (``GLOBAL``)
+    node_chunks: List[Chunk] = field(default_factory=list)
+
+
+@dataclass(eq=False)
+class ParsePlan:
+    """
+    A script split into chunks. The fragments of the chunks missing from the cache
+    still have to be built, either in place or in worker processes.
+    """
+
+    source: str
+    statements: List[Chunk]
+    plots: List[PlotSpec]
+    # Offsets of the chunks (start and end) and of the flows (key and closing brace),
+    # in the order of the source, so that an edit only has to shift the ones after it.
+    # Plans share them, they are never changed in place (and a list while planning).
+    positions: np.ndarray
+    # The chunk starting at each of the ``positions``, ``None`` for the others
+    starts: List[Optional[Chunk]]
+    missing: List[Chunk] = field(default_factory=list)
+    # Fragments of the previous parse of the document by key, looked up before the
+    # cache, which may not hold all the chunks of a large document
+    reused: Dict[bytes, Fragment] = field(default_factory=dict, repr=False)
+    # Ids of the fragments given to the chunks, ``None`` if not known. Every chunk has
+    # a fragment of its own, so that the objects of identical chunks (eg. two
+    # ``import re``) can be told apart by the chunk they come from.
+    owned: Optional[Set[int]] = field(default_factory=set, repr=False)
+    # The parse this one was planned from and, if the edit since then was inside a
+    # single chunk, that chunk and the one replacing it: the others are the same
+    base: Optional[weakref.ref] = field(default=None, repr=False)
+    replaced: Optional[Tuple[Chunk, Chunk]] = field(default=None, repr=False)
+
+    def chunks(self) -> Iterator[Chunk]:
+        yield from self.statements
+        for spec in self.plots:
+            yield from spec.node_chunks
+            for flow in spec.flows:
+                yield from flow.node_chunks
+
+    def span(self, chunk: Chunk) -> Tuple[int, int]:
+        """Start and end offsets of a chunk"""
+        return int(self.positions[chunk.slot]), int(self.positions[chunk.slot + 1])
+
+    def key_span(self, flow: FlowSpec) -> Tuple[int, int]:
+        """Start and end offsets of the key of a flow"""
+        slot = flow.key_slot
+        return int(self.positions[slot]), int(self.positions[slot + 1])
+
+    def close(self, flow: FlowSpec) -> Optional[int]:
+        """Offset of the closing brace of a flow dict, ``None`` if it isn't a dict"""
+        if flow.close_slot is None:
+            return None
+        return int(self.positions[flow.close_slot])
+
+    def key(self, chunk: Chunk) -> bytes:
+        """Key of the fragment of a chunk in the cache, see ``ChunkSource.key``"""
+        start, end = self.span(chunk)
+        text = self.source[start:end]
+        return content_hash(chunk.kind, chunk.plot or "", chunk.flow or "", text)
+
+    def chunk_source(self, chunk: Chunk, line: Optional[int] = None) -> ChunkSource:
+        """The text of a chunk and its line, counted unless given"""
+        start, end = self.span(chunk)
+        if line is None:
+            line = self.source.count("\n", 0, start) + 1
+        text = self.source[start:end]
+        if chunk.is_node:
+            return ChunkSource("node", text, line, chunk.plot, chunk.flow)
+        return ChunkSource("stmt", text, line)
+
+    def missing_sources(self) -> List[ChunkSource]:
+        sources = []
+        # Missing chunks are in the order of the source, so the newlines before each
+        # one are only counted once
+        line = 1
+        counted = 0
+        for chunk in self.missing:
+            start = int(self.positions[chunk.slot])
+            if start < counted:
+                line = 1
+                counted = 0
+            line += self.source.count("\n", counted, start)
+            counted = start
+            sources.append(self.chunk_source(chunk, line))
+        return sources
+
+
+@dataclass(eq=False)
+class ParsedScript(ParsePlan):
+    plot: Plot = field(default_factory=dict)
+
+
+class _LRU(OrderedDict):
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        try:
+            self.move_to_end(key)
+            return self[key]
+        except KeyError:
+            return default
+
+    def put(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+class PlotParser:
+    """
+    Parses dff scripts into plots, caching the fragments of every chunk.
+
+    Parsing happens in two steps, so that the expensive part can be moved to worker
+    processes: :meth:`plan` splits the script into chunks and looks up their fragments
+    in the cache, then :meth:`complete` takes the fragments of the missing chunks and
+    assembles the plot. :meth:`parse` does both in the current process.
+    """
+
+    def __init__(self, cache_size: int = CACHE_SIZE, grow: bool = True):
+        self.cache = _LRU(cache_size)
+        # Whether the cache grows to hold the chunks of the largest script parsed twice
+        # (eg. the fragments kept for a document cooled down, and those of another
+        # version of it)
+        self.grow = grow
+
+    def parse(
+        self,
+        source: str,
+        previous: Optional[ParsedScript] = None,
+        assemble: bool = True,
+    ) -> ParsedScript:
+        plan = self.plan(source, previous)
+        return self.complete(plan, build_fragments(plan.missing_sources()), assemble)
+
+    def plan(self, source: str, previous: Optional[ParsedScript] = None) -> ParsePlan:
+        """
+        Split a script into chunks. If the previous parse of the same document is
+        given, and the edit since then is contained in a single chunk, only that chunk
+        is rescanned.
+        """
+        if previous is not None:
+            if previous.source == source:
+                return ParsePlan(
+                    source,
+                    previous.statements,
+                    previous.plots,
+                    previous.positions,
+                    previous.starts,
+                    base=weakref.ref(previous),
+                )
+            plan = self._replan(source, previous)
+            if plan is not None:
+                return plan
+        return self._plan(source, previous)
+
+    def complete(
+        self, plan: ParsePlan, fragments: List[Fragment], assemble: bool = True
+    ) -> ParsedScript:
+        """
+        Fill in the fragments of the missing chunks. Unless ``assemble`` is false (eg.
+        when the plot is kept in a ``PlotStore``), also assemble the plot.
+        """
+        for chunk, fragment in zip(plan.missing, fragments):
+            chunk.fragment = fragment
+            self.cache.put(plan.key(chunk), fragment)
+        plot = self._assemble(plan.statements, plan.plots) if assemble else {}
+        return ParsedScript(
+            plan.source,
+            plan.statements,
+            plan.plots,
+            plan.positions,
+            plan.starts,
+            base=plan.base,
+            replaced=plan.replaced,
+            plot=plot,
+        )
+
+    def materialize(self, chunk: Chunk, parsed: ParsePlan) -> Fragment:
+        """Make sure the CST of a chunk is available, eg. for editing it"""
+        fragment = chunk.fragment
+        if fragment.cst is None:
+            rebuilt = build_fragment(parsed.chunk_source(chunk))
+            fragment.cst = rebuilt.cst
+            fragment.cst_nodes = rebuilt.cst_nodes
+        return fragment
+
+    def release(self, parsed: ParsedScript) -> None:
+        """Drop the CSTs of the chunks of a parse, :meth:`materialize` rebuilds them"""
+        for chunk in parsed.chunks():
+            chunk.fragment.cst = None
+            chunk.fragment.cst_nodes = {}
+
+    def _chunk(
+        self, plan: ParsePlan, start: int, end: int, path, plot=None, flow=None
+    ) -> Chunk:
+        """Add a chunk to a plan being made by ``_plan``"""
+        chunk = Chunk(len(plan.positions), None, plot, flow, path)
+        plan.positions += (start, end)
+        plan.starts += (chunk, None)
+        self._fill(plan, chunk)
+        return chunk
+
+    def _fill(self, plan: ParsePlan, chunk: Chunk) -> None:
+        """Give a chunk its fragment, or add it to the missing ones"""
+        key = plan.key(chunk)
+        fragment = plan.reused.pop(key, None)
+        if fragment is not None:
+            # Into the cache too, eg. for the next parse once the document cooled down
+            self.cache.put(key, fragment)
+        else:
+            fragment = self.cache.get(key)
+            if fragment is None:
+                plan.missing.append(chunk)
+                return
+            if plan.owned is None or id(fragment) in plan.owned:
+                fragment = replace(fragment)
+        if plan.owned is not None:
+            plan.owned.add(id(fragment))
+        chunk.fragment = fragment
+
+    def _plan(self, source: str, previous: Optional[ParsePlan] = None) -> ParsePlan:
+        structure = scan(source)
+        if structure.depth:
+            raise ParseError("Unclosed bracket at the end of the script")
+        starts = split_statements(source, structure.newlines)
+        ends = starts[1:] + [len(source)]
+        offsets = [mark[0] for mark in structure.marks]
+        plan = ParsePlan(source, [], [], [], [])
+        if previous is not None:
+            plan.reused = {
+                previous.key(chunk): chunk.fragment
+                for chunk in previous.chunks()
+                if chunk.fragment is not None
+            }
+        for start, end in zip(starts, ends):
+            head = _PLOT_HEAD.match(source, _code_start(source, start, end))
+            if head is not None and _DFF_KEYWORDS.search(source, start, end):
+                plan.plots.append(
+                    self._plan_plot(
+                        plan, len(plan.plots), head, structure.marks, offsets
+                    )
+                )
+            elif source[start:end].strip():
+                path = (-1, -1, len(plan.statements))
+                plan.statements.append(self._chunk(plan, start, end, path))
+        plan.reused = {}
+        plan.positions = np.array(plan.positions, dtype=np.int64)
+        if self.grow:
+            chunks = len(plan.starts) - plan.starts.count(None)
+            self.cache.maxsize = max(self.cache.maxsize, 2 * chunks)
+        return plan
+
+    def _replan(self, source: str, previous: ParsePlan) -> Optional[ParsePlan]:
+        old = previous.source
+        prefix = common_prefix(old, source)
+        suffix = common_suffix(old, source, min(len(old), len(source)) - prefix)
+        old_end = len(old) - suffix
+        delta = len(source) - len(old)
+        # The edit must be inside the last chunk starting before it
+        slot = int(np.searchsorted(previous.positions, prefix)) - 1
+        edited = previous.starts[slot] if slot >= 0 else None
+        if edited is None:
+            return None
+        old_start, old_stop = previous.span(edited)
+        if old_end >= old_stop:
+            return None
+        start, end = old_start, old_stop + delta
+        text = source[start:end]
+        try:
+            structure = scan(text)
+        except ParseError:
+            # Eg. an opened triple quoted string, which might be closed by a later chunk
+            return None
+        if structure.depth:
+            return None
+        if edited.is_node:
+            if any(char == "," and depth == 0 for _, char, depth in structure.marks):
+                return None
+            if not edited.flow:
+                # A node at the top level of the plot is only one as long as its key
+                # is ``GLOBAL``, otherwise it is a flow
+                colon = next(
+                    (
+                        pos
+                        for pos, char, depth in structure.marks
+                        if char == ":" and not depth
+                    ),
+                    None,
+                )
+                if colon is None or text[:colon].strip() != "GLOBAL":
+                    return None
+        else:
+            # The edit must not have split the statement, joined it to the previous or
+            # the next one (see ``split_statements``), or turned it into a plot
+            if split_statements(text, structure.newlines) != [0]:
+                return None
+            code = _code_start(text, 0, len(text))
+            old_code = _code_start(old, old_start, old_stop)
+            last_line = text.rstrip().rsplit("\n", 1)[-1]
+            if (
+                last_line.startswith("#")
+                or (code and text[code - 1] != "\n")
+                or _CONTINUATIONS.match(text, code)
+                or _PLOT_HEAD.match(text, code)
+                or text.startswith("@", code) != old.startswith("@", old_code)
+            ):
+                return None
+            index = edited.path[2]
+            if (
+                index
+                and _DECORATED.match(text, code)
+                and not _DECORATED.match(old, old_code)
+            ):
+                before_start, before_end = previous.span(previous.statements[index - 1])
+                if before_end == old_start and old.startswith(
+                    "@", _code_start(old, before_start, before_end)
+                ):
+                    return None
+
+        # Only the offsets after the edit change, the other chunks are kept as they are
+        positions = previous.positions.copy()
+        positions[np.searchsorted(positions, prefix, "right") :] += delta
+        replacement = Chunk(edited.slot, None, edited.plot, edited.flow, edited.path)
+        starts = _replaced(previous.starts, edited.slot, replacement)
+        plan = ParsePlan(
+            source,
+            previous.statements,
+            previous.plots,
+            positions,
+            starts,
+            # The fragments of the other chunks are not known here
+            owned=None,
+            base=weakref.ref(previous),
+            replaced=(edited, replacement),
+        )
+        self._fill(plan, replacement)
+        plot, flow, index = edited.path
+        if plot < 0:
+            plan.statements = _replaced(previous.statements, index, replacement)
+            return plan
+        spec = previous.plots[plot]
+        if flow < 0:
+            chunks = _replaced(spec.node_chunks, index, replacement)
+            spec = replace(spec, node_chunks=chunks)
+        else:
+            chunks = _replaced(spec.flows[flow].node_chunks, index, replacement)
+            flows = _replaced(
+                spec.flows, flow, replace(spec.flows[flow], node_chunks=chunks)
+            )
+            spec = replace(spec, flows=flows)
+        plan.plots = _replaced(previous.plots, plot, spec)
+        return plan
+
+    def _plan_plot(
+        self, plan: ParsePlan, index: int, head: re.Match, marks, offsets
+    ) -> PlotSpec:
+        source = plan.source
+        name = head.group(1)
+        open_idx = bisect_left(offsets, head.end() - 1)
+        close_idx = _matching(marks, open_idx)
+        spec = PlotSpec(name, named_id("plots", name))
+        for a, b in _entries(source, marks, open_idx, close_idx):
+            colon = _find(marks, ":", marks[open_idx][2] + 1, a, b, offsets)
+            if colon is None:
+                continue
+            key_start, key_end = _strip(source, a, colon)
+            flow_key = source[key_start:key_end]
+            if flow_key == "GLOBAL":
+                path = (index, -1, len(spec.node_chunks))
+                spec.node_chunks.append(self._chunk(plan, a, b, path, name, ""))
+                continue
+            flow_name = self._flow_name(flow_key)
+            flow = FlowSpec(
+                flow_name, named_id("flows", name, flow_name), len(plan.positions), None
+            )
+            plan.positions += (key_start, key_end)
+            plan.starts += (None, None)
+            spec.flows.append(flow)
+            value_idx = bisect_left(offsets, colon + 1)
+            if (
+                value_idx < len(marks)
+                and marks[value_idx][1] == "{"
+                and not source[colon + 1 : marks[value_idx][0]].strip()
+            ):
+                flow_close = _matching(marks, value_idx)
+                for c, d in _entries(source, marks, value_idx, flow_close):
+                    path = (index, len(spec.flows) - 1, len(flow.node_chunks))
+                    flow.node_chunks.append(
+                        self._chunk(plan, c, d, path, name, flow_name)
+                    )
+                flow.close_slot = len(plan.positions)
+                plan.positions.append(marks[flow_close][0])
+                plan.starts.append(None)
+        return spec
+
+    def _flow_name(self, key: str) -> str:
+        cache_key = content_hash("flow", key)
+        name = self.cache.get(cache_key)
+        if name is None:
+            try:
+                name = str(_literal(cst.parse_expression(f"({key}\n)")))
+            except (ValueError, cst.ParserSyntaxError):
+                name = key
+            self.cache.put(cache_key, name)
+        return name
+
+    def _assemble(self, statements: List[Chunk], plots: List[PlotSpec]) -> Plot:
+        plot: Plot = {table: {} for table in TABLES}
+        py_defs: Dict[str, Optional[str]] = {}
+        targets: Dict[str, Tuple[str, str, str]] = {}
+        # Number of imports of each name so far, see ``import_id``
+        imported: Dict[str, int] = {}
+
+        def merge(fragment: Fragment):
+            for table, objects in fragment.tables.items():
+                if table != "imports":
+                    plot[table].update(objects)
+                    continue
+                for record in objects.values():
+                    count = imported.get(record["name"], 0)
+                    plot["imports"][import_id(record["name"], count)] = record
+                    imported[record["name"]] = count + 1
+            for name, code in fragment.py_defs.items():
+                if code is not None or name not in py_defs:
+                    py_defs[name] = code
+            targets.update(fragment.targets)
+
+        for chunk in statements:
+            merge(chunk.fragment)
+
+        node_ids: Dict[Tuple[str, str], str] = {}
+        for spec in plots:
+            plot["plots"][spec.objid] = {
+                "name": spec.name,
+                "flows": [f.objid for f in spec.flows],
+            }
+            for chunk in spec.node_chunks:
+                merge(chunk.fragment)
+            for flow in spec.flows:
+                flow_nodes = []
+                for chunk in flow.node_chunks:
+                    merge(chunk.fragment)
+                    for objid, node in chunk.fragment.tables.get("nodes", {}).items():
+                        flow_nodes.append(objid)
+                        if node["type"] == "regular":
+                            node_ids[(flow.name, node["name"])] = objid
+                plot["flows"][flow.objid] = {"name": flow.name, "nodes": flow_nodes}
+
+        # Labels can point to nodes anywhere in the plot, so only resolve them now.
+        # Fragments are shared with the cache, so never mutate them in place.
+        transitions = plot["transitions"]
+        for objid, (flow, node, _) in targets.items():
+            target = node_ids.get((flow, node))
+            if target is not None:
+                transitions[objid] = {**transitions[objid], "label": target}
+
+        for name, code in py_defs.items():
+            obj = {"name": name}
+            if code is not None:
+                obj["code"] = code
+            plot["py_defs"][named_id("py_defs", name)] = obj
+        return plot
+
+
+def _replaced(items: list, index: int, item) -> list:
+    """A copy of a list with one item replaced"""
+    items = list(items)
+    items[index] = item
+    return items
+
+
+def common_prefix(a: str, b: str) -> int:
+    # Binary search, so the comparisons run in C
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def common_suffix(a: str, b: str, limit: int) -> int:
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid : len(a) - lo] == b[len(b) - mid : len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _code_start(source: str, start: int, end: int) -> int:
+    """Skip the blank and comment lines at the beginning of a chunk"""
+    i = start
+    while i < end:
+        line_end = source.find("\n", i, end)
+        line_end = end if line_end == -1 else line_end + 1
+        line = source[i:line_end]
+        stripped = line.lstrip()
+        if stripped and not stripped.startswith("#"):
+            return i + len(line) - len(stripped)
+        i = line_end
+    return end
+
+
+def _matching(marks, open_idx: int) -> int:
+    """Index of the bracket closing the one at ``open_idx``"""
+    depth = marks[open_idx][2]
+    for i in range(open_idx + 1, len(marks)):
+        if marks[i][2] == depth and marks[i][1] in ")]}":
+            return i
+    raise ParseError("Unbalanced brackets")
+
+
+def _entries(source: str, marks, open_idx: int, close_idx: int):
+    """Yield the (start, end) of the comma separated entries inside the brackets"""
+    depth = marks[open_idx][2] + 1
+    start = marks[open_idx][0] + 1
+    for i in range(open_idx + 1, close_idx + 1):
+        pos, char, mark_depth = marks[i]
+        if (char == "," and mark_depth == depth) or i == close_idx:
+            a, b = _strip(source, start, pos)
+            if a < b:
+                yield a, b
+            start = pos + 1
+
+
+def _find(
+    marks, char: str, depth: int, start: int, end: int, positions
+) -> Optional[int]:
+    for i in range(bisect_left(positions, start), len(marks)):
+        pos, mark_char, mark_depth = marks[i]
+        if pos >= end:
+            break
+        if mark_char == char and mark_depth == depth:
+            return pos
+    return None
+
+
+def _strip(source: str, start: int, end: int) -> Tuple[int, int]:
+    text = source[start:end]
+    stripped = text.strip()
+    if not stripped:
+        return start, start
+    a = start + text.index(stripped[0])
+    return a, a + len(stripped)
@@ -0,0 +1,348 @@
+"""
+Indexed, incrementally maintained plot of a document.
+
+Instead of assembling a new plot from all the fragments after every parse, the store
+only adds and removes the objects of the chunks that changed, and keeps the indexes
+needed to edit the plot: the table and chunk of every object, the node of every
+transition, the flow of every node and the users of every linking object. When the
+parse was planned from the previous one by replacing a single chunk (see
+``PlotParser._replan``), only that chunk and its flow are looked at.
+"""
+
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from plot_parser import (
+    TABLES,
+    Chunk,
+    FlowSpec,
+    Fragment,
+    ParsedScript,
+    Plot,
+    import_id,
+    named_id,
+)
+
+# (flow name, node name) of a regular node
+NodeKey = Tuple[str, str]
+
+
+def linking_refs(record: Dict[str, Any]) -> Iterator[str]:
+    """Ids of the linking objects used by an object (but not its parent)"""
+    stack = [v for k, v in record.items() if k != "parent"]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, str):
+            if value.startswith("id#ln_"):
+                yield value
+        elif isinstance(value, list):
+            stack.extend(value)
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+
+
+class PlotStore:
+    def __init__(self):
+        self.plot: Plot = {table: {} for table in TABLES}
+        # The parse the plot is of
+        self.parsed: Optional[ParsedScript] = None
+        self.table_of: Dict[str, str] = {}
+        # The fragment each object comes from, ``None`` for plots and flows
+        self.owner: Dict[str, Optional[Fragment]] = {}
+        # Chunk of each fragment in the last parse, by ``id(fragment)``
+        self.chunks: Dict[int, Chunk] = {}
+        # Reverse indexes
+        self.parent: Dict[str, str] = {}
+        self.flow_of: Dict[str, str] = {}
+        self.users: Dict[str, Set[str]] = {}
+        self.flows: Dict[str, Tuple[str, FlowSpec]] = {}
+        # Labels are resolved to the id of the node they point to, so transitions
+        # have to be updated when the node appears or disappears
+        self.node_ids: Dict[NodeKey, str] = {}
+        self.waiting: Dict[NodeKey, Set[str]] = {}
+        # Number of fragments referencing or defining each py_def, and the code of the
+        # definitions by ``id(fragment)``
+        self.py_def_refs: Dict[str, int] = {}
+        self.py_def_codes: Dict[str, Dict[int, str]] = {}
+        # Fragments importing each name by ``id(fragment)``, and the ids of the imports
+        # of the name, numbered in the order of the source (see ``import_id``)
+        self.importers: Dict[str, Dict[int, Fragment]] = {}
+        self.import_ids: Dict[str, List[str]] = {}
+        # Id of each import in its fragment, if not the same
+        self.local_ids: Dict[str, str] = {}
+        # Objects changed since the last delta, and their record then (records are
+        # replaced, never changed in place)
+        self.touched: Dict[str, Tuple[str, Optional[Dict[str, Any]]]] = {}
+
+    def get(self, objid: str) -> Tuple[str, Dict[str, Any]]:
+        """Table and record of an object, ``KeyError`` if there is no such object"""
+        table = self.table_of[objid]
+        return table, self.plot[table][objid]
+
+    def chunk_of(self, objid: str) -> Chunk:
+        return self.chunks[id(self.owner[objid])]
+
+    def local_id(self, objid: str) -> str:
+        """Id of an object in its fragment, eg. for ``Fragment.cst_nodes``"""
+        return self.local_ids.get(objid, objid)
+
+    def apply(self, parsed: ParsedScript) -> None:
+        """Update the plot to a new parse of the document"""
+        base = parsed.base() if parsed.base is not None else None
+        incremental = base is not None and base is self.parsed
+        if incremental:
+            removed: List[Chunk] = []
+            added: List[Chunk] = []
+            if parsed.replaced is not None:
+                removed, added = [parsed.replaced[0]], [parsed.replaced[1]]
+            for chunk in removed:
+                del self.chunks[id(chunk.fragment)]
+            for chunk in added:
+                self.chunks[id(chunk.fragment)] = chunk
+        else:
+            chunks = {id(chunk.fragment): chunk for chunk in parsed.chunks()}
+            removed = [c for key, c in self.chunks.items() if key not in chunks]
+            added = [c for key, c in chunks.items() if key not in self.chunks]
+            self.chunks = chunks
+        self.parsed = parsed
+        # Names of the python objects referenced or defined by the changed chunks, most
+        # are used all over the script so they are only updated once, same for imports
+        py_defs: Dict[str, None] = {}
+        imports: Dict[str, None] = {}
+        # Adding first, so that objects keeping their id (eg. an edited node) are only
+        # updated, and the transitions pointing to them are left alone
+        for chunk in added:
+            self._add(chunk)
+            py_defs.update(dict.fromkeys(chunk.fragment.py_defs))
+            imports.update(self._imported(chunk.fragment))
+        for chunk in removed:
+            self._remove(chunk)
+            py_defs.update(dict.fromkeys(chunk.fragment.py_defs))
+            imports.update(self._imported(chunk.fragment))
+        for name in py_defs:
+            self._py_def(name)
+        for name in imports:
+            self._imports(name)
+        if not incremental:
+            self._structure(parsed)
+            return
+        for old, new in zip(removed, added):
+            self._replace_nodes(parsed, old, new)
+
+    def delta(self) -> dict:
+        """Added, removed and changed objects of each table since the last delta"""
+        delta: Dict[str, Dict[str, Any]] = {}
+        for objid, (table, old) in self.touched.items():
+            record = self.plot[table].get(objid)
+            # Changed back since (eg. by a rolled back batch)
+            if record is old or record == old:
+                continue
+            changes = delta.setdefault(
+                table, {"added": {}, "removed": [], "changed": {}}
+            )
+            if record is None:
+                changes["removed"].append(objid)
+            elif old is not None:
+                changes["changed"][objid] = record
+            else:
+                changes["added"][objid] = record
+        self.touched = {}
+        return delta
+
+    def _touch(self, table: str, objid: str) -> None:
+        if objid not in self.touched:
+            self.touched[objid] = (table, self.plot[table].get(objid))
+
+    def _set(
+        self,
+        table: str,
+        objid: str,
+        record: Dict[str, Any],
+        owner: Optional[Fragment],
+    ) -> None:
+        objects = self.plot[table]
+        old = objects.get(objid)
+        if old is record or old == record:
+            self.owner[objid] = owner
+            return
+        self._touch(table, objid)
+        if old is not None:
+            self._unlink(objid, old)
+        objects[objid] = record
+        self.table_of[objid] = table
+        self.owner[objid] = owner
+        for ref in linking_refs(record):
+            self.users.setdefault(ref, set()).add(objid)
+
+    def _delete(self, table: str, objid: str) -> None:
+        self._touch(table, objid)
+        self._unlink(objid, self.plot[table].pop(objid))
+        del self.table_of[objid]
+        del self.owner[objid]
+
+    def _unlink(self, objid: str, record: Dict[str, Any]) -> None:
+        for ref in linking_refs(record):
+            users = self.users.get(ref)
+            if users is not None:
+                users.discard(objid)
+                if not users:
+                    del self.users[ref]
+
+    def _resolved(self, objid: str, fragment: Fragment) -> Dict[str, Any]:
+        record = fragment.tables["transitions"][objid]
+        flow, node, _ = fragment.targets[objid]
+        target = self.node_ids.get((flow, node))
+        return {**record, "label": target} if target is not None else record
+
+    def _retarget(self, key: NodeKey) -> None:
+        for objid in self.waiting.get(key, ()):
+            fragment = self.owner[objid]
+            self._set("transitions", objid, self._resolved(objid, fragment), fragment)
+
+    @staticmethod
+    def _imported(fragment: Fragment) -> Dict[str, None]:
+        """Names imported by a fragment"""
+        return {
+            record["name"]: None
+            for record in fragment.tables.get("imports", {}).values()
+        }
+
+    def _add(self, chunk: Chunk) -> None:
+        fragment = chunk.fragment
+        for name in self._imported(fragment):
+            self.importers.setdefault(name, {})[id(fragment)] = fragment
+        for table, objects in fragment.tables.items():
+            if table == "imports":
+                continue
+            for objid, record in objects.items():
+                if objid in fragment.targets:
+                    flow, node, _ = fragment.targets[objid]
+                    self.waiting.setdefault((flow, node), set()).add(objid)
+                    record = self._resolved(objid, fragment)
+                self._set(table, objid, record, fragment)
+                if table == "nodes":
+                    for trans in record.get("transitions", ()):
+                        self.parent[trans] = objid
+                    key = (chunk.flow, record.get("name"))
+                    if record["type"] == "regular" and self.node_ids.get(key) != objid:
+                        self.node_ids[key] = objid
+                        self._retarget(key)
+        for name, code in fragment.py_defs.items():
+            self.py_def_refs[name] = self.py_def_refs.get(name, 0) + 1
+            if code is not None:
+                self.py_def_codes.setdefault(name, {})[id(fragment)] = code
+
+    def _remove(self, chunk: Chunk) -> None:
+        fragment = chunk.fragment
+        for name in self._imported(fragment):
+            del self.importers[name][id(fragment)]
+        for table, objects in fragment.tables.items():
+            if table == "imports":
+                continue
+            for objid, record in objects.items():
+                # The same object may have been redefined by another chunk
+                if self.owner.get(objid) is not fragment:
+                    continue
+                self._delete(table, objid)
+                if objid in fragment.targets:
+                    flow, node, _ = fragment.targets[objid]
+                    self.waiting.get((flow, node), set()).discard(objid)
+                if table == "transitions":
+                    self.parent.pop(objid, None)
+                elif table == "nodes" and record["type"] == "regular":
+                    key = (chunk.flow, record["name"])
+                    if self.node_ids.get(key) == objid:
+                        del self.node_ids[key]
+                        self._retarget(key)
+        for name, code in fragment.py_defs.items():
+            self.py_def_refs[name] -= 1
+            if code is not None:
+                codes = self.py_def_codes[name]
+                del codes[id(fragment)]
+                if not codes:
+                    del self.py_def_codes[name]
+
+    def _py_def(self, name: str) -> None:
+        objid = named_id("py_defs", name)
+        if not self.py_def_refs[name]:
+            del self.py_def_refs[name]
+            if objid in self.table_of:
+                self._delete("py_defs", objid)
+            return
+        record = {"name": name}
+        codes = self.py_def_codes.get(name)
+        if codes:
+            record["code"] = next(iter(codes.values()))
+        self._set("py_defs", objid, record, None)
+
+    def _imports(self, name: str) -> None:
+        """Number the imports of a name in the order of the source"""
+        fragments = sorted(
+            self.importers.get(name, {}).values(),
+            key=lambda fragment: self.chunks[id(fragment)].path,
+        )
+        ids: List[str] = []
+        for fragment in fragments:
+            for local_id, record in fragment.tables["imports"].items():
+                if record["name"] == name:
+                    objid = import_id(name, len(ids))
+                    ids.append(objid)
+                    self._set("imports", objid, record, fragment)
+                    if local_id != objid:
+                        self.local_ids[objid] = local_id
+                    else:
+                        self.local_ids.pop(objid, None)
+        for objid in self.import_ids.get(name, [])[len(ids) :]:
+            self._delete("imports", objid)
+            self.local_ids.pop(objid, None)
+        if ids:
+            self.import_ids[name] = ids
+        else:
+            self.import_ids.pop(name, None)
+            self.importers.pop(name, None)
+
+    def _replace_nodes(self, parsed: ParsedScript, old: Chunk, new: Chunk) -> None:
+        """Update the flow of a node chunk replaced by another"""
+        plot, flow, _ = new.path
+        if flow < 0:
+            # A statement or a node at the top level of a plot
+            return
+        spec = parsed.plots[plot]
+        flow_spec = spec.flows[flow]
+        self.flows[flow_spec.objid] = (spec.name, flow_spec)
+        self._set("flows", flow_spec.objid, self._flow(flow_spec), None)
+        for node in old.fragment.tables.get("nodes", {}):
+            if node not in self.table_of:
+                self.flow_of.pop(node, None)
+        for node in new.fragment.tables.get("nodes", {}):
+            self.flow_of[node] = flow_spec.objid
+
+    @staticmethod
+    def _flow(flow: FlowSpec) -> Dict[str, Any]:
+        nodes = [
+            objid
+            for chunk in flow.node_chunks
+            for objid in chunk.fragment.tables.get("nodes", {})
+        ]
+        return {"name": flow.name, "nodes": nodes}
+
+    def _structure(self, parsed: ParsedScript) -> None:
+        """Update the plots and flows, which are not part of any fragment"""
+        seen: List[str] = []
+        self.flows = {}
+        for spec in parsed.plots:
+            flows = [flow.objid for flow in spec.flows]
+            self._set("plots", spec.objid, {"name": spec.name, "flows": flows}, None)
+            seen.append(spec.objid)
+            for flow in spec.flows:
+                record = self._flow(flow)
+                self._set("flows", flow.objid, record, None)
+                self.flows[flow.objid] = (spec.name, flow)
+                seen.append(flow.objid)
+                for node in record["nodes"]:
+                    self.flow_of[node] = flow.objid
+        seen_set = set(seen)
+        for table in ("plots", "flows"):
+            for objid in [objid for objid in self.plot[table] if objid not in seen_set]:
+                self._delete(table, objid)
+        for node in [node for node in self.flow_of if node not in self.table_of]:
+            del self.flow_of[node]
@@ -0,0 +1,144 @@
+"""
+Opt-in profiling of the messages handled by the server.
+
+Profiling is set up with environment variables, or with the ``profile`` option of the
+handshake (an object with the keys ``directory``, ``messages``, ``threshold`` and
+``mode``, in the same order):
+
+- ``DF_PARSER_PROFILE_DIR``: directory the profiles are written to, profiling is off
+  without it
+- ``DF_PARSER_PROFILE``: comma separated names of the messages to profile, ``*`` for
+  all of them (the default)
+- ``DF_PARSER_PROFILE_THRESHOLD``: only keep the profiles of messages which took at
+  least this many milliseconds
+- ``DF_PARSER_PROFILE_MODE``: ``cpu`` (cProfile, the default), ``memory``
+  (tracemalloc) or both, comma separated
+
+Each profiled message gets a ``.pstats`` file (for ``pstats`` or snakeviz) and/or a
+tracemalloc snapshot, with a text file of its top allocations by line. Files are named
+after the time, the message name, its ``msgId`` and the document.
+
+The profilers are process-wide, so a single message is profiled at a time, and the
+profile includes whatever other messages ran concurrently. The chunks of a message
+profiled with cProfile are parsed in the server process rather than in the workers,
+so that the parser shows in the profile.
+"""
+
+import cProfile
+import os
+import re
+import time
+import tracemalloc
+from typing import List, Optional
+
+# Allocations listed in the text summary of a snapshot
+TOP_ALLOCATIONS = 50
+
+
+class Profile:
+    """Profilers of a message being handled"""
+
+    def __init__(self, cpu: bool, memory: bool):
+        self.started = time.perf_counter()
+        self.cpu = cProfile.Profile() if cpu else None
+        self.memory = memory and not tracemalloc.is_tracing()
+        if self.memory:
+            tracemalloc.start()
+        if self.cpu is not None:
+            self.cpu.enable()
+
+    def stop(self) -> Optional[tracemalloc.Snapshot]:
+        if self.cpu is not None:
+            self.cpu.disable()
+        if not self.memory:
+            return None
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        return snapshot
+
+
+class Profiler:
+    def __init__(
+        self,
+        directory: str = "",
+        messages: str = "*",
+        threshold: float = 0.0,
+        mode: str = "cpu",
+    ):
+        self.configure(directory, messages, threshold, mode)
+        self.active: Optional[Profile] = None
+
+    @classmethod
+    def from_env(cls) -> "Profiler":
+        return cls(
+            os.environ.get("DF_PARSER_PROFILE_DIR", ""),
+            os.environ.get("DF_PARSER_PROFILE", "*"),
+            float(os.environ.get("DF_PARSER_PROFILE_THRESHOLD", 0)),
+            os.environ.get("DF_PARSER_PROFILE_MODE", "cpu"),
+        )
+
+    def configure(
+        self,
+        directory: str = "",
+        messages: str = "*",
+        threshold: float = 0.0,
+        mode: str = "cpu",
+    ) -> None:
+        self.directory = directory
+        self.messages = {name.strip() for name in messages.split(",") if name.strip()}
+        # Seconds
+        self.threshold = threshold / 1000
+        modes = {m.strip() for m in mode.split(",")}
+        self.cpu = "cpu" in modes
+        self.memory = "memory" in modes
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def start(self, name: str) -> Optional[Profile]:
+        """Start profiling a message if it is selected, and nothing else is profiled"""
+        if (
+            not self.directory
+            or self.active is not None
+            or ("*" not in self.messages and name not in self.messages)
+        ):
+            return None
+        self.active = Profile(self.cpu, self.memory)
+        return self.active
+
+    def stop(self, profile: Optional[Profile], msg: dict) -> List[str]:
+        """Stop profiling a message, and return the files written for it"""
+        if profile is None:
+            return []
+        self.active = None
+        elapsed = time.perf_counter() - profile.started
+        snapshot = profile.stop()
+        if elapsed < self.threshold:
+            return []
+        uri = msg.get("payload", {}).get("uri", "")
+        label = "-".join(
+            _slug(part)
+            for part in (
+                time.strftime("%Y%m%d-%H%M%S"),
+                msg["name"],
+                str(msg["id"]),
+                os.path.basename(uri),
+            )
+            if part
+        )
+        base = os.path.join(self.directory, label)
+        files = []
+        if profile.cpu is not None:
+            profile.cpu.dump_stats(base + ".pstats")
+            files.append(base + ".pstats")
+        if snapshot is not None:
+            snapshot.dump(base + ".tracemalloc")
+            with open(base + ".allocations.txt", "w") as out:
+                out.write(f"{msg['name']} {msg['id']} {uri} {elapsed * 1000:.1f}ms\n")
+                for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                    out.write(f"{stat}\n")
+            files += [base + ".tracemalloc", base + ".allocations.txt"]
+        return files
+
+
+def _slug(text: str) -> str:
+    return re.sub(r"[^\w.]+", "_", text)[:64]
@@ -1,8 +1,501 @@
-import json
+import argparse
+import asyncio
+import os
+import urllib.parse
 
-while True:
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+from compact import CompactPlot
+from dispatcher import Dispatcher, Superseded, session
+from documents import Document, DocumentStore
+from editing import EditError, Editor, TextEdits
+from metrics import stage
+from parse_cache import ParseCache, default_path
+from plot_parser import (
+    ChunkSource,
+    Fragment,
+    ParsedScript,
+    ParseError,
+    ParsePlan,
+    PlotParser,
+    build_fragments,
+)
+from profiling import Profiler
+from simulation import SimulationError, merge, simulate
+from workspace import Workspace
+from yaml_plots import YamlPlot
+
+# Parses with less new source than this are done inline, shipping the chunks to the
+# workers and back would take longer than parsing them
+POOL_THRESHOLD = 16 * 1024
+WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+# Simulations of more turns than this are split between the workers
+SIMULATION_SPLIT = 50_000
+# Location of the parse cache on disk, an empty string disables it
+CACHE_PATH = os.environ.get("DF_PARSER_CACHE", default_path())
+# The plot of a document is written to the disk cache once it stopped changing for
+# this many seconds
+SAVE_DELAY = 2.0
+# Documents no message was about for this many seconds only keep their source and a
+# compact plot, see ``Document.cool``
+COOL_DELAY = 300.0
+# File the stats are appended to every ``STATS_INTERVAL`` seconds as JSON lines, an
+# empty string disables it
+STATS_PATH = os.environ.get("DF_PARSER_STATS", "")
+STATS_INTERVAL = float(os.environ.get("DF_PARSER_STATS_INTERVAL", 60))
+# A server listening on a socket stops once no client was connected for this many
+# seconds
+IDLE_SHUTDOWN = 600.0
+
+parser = PlotParser()
+documents = DocumentStore()
+dispatcher = Dispatcher(
+    {},
+    errors=(ParseError, EditError, SimulationError),
+    coalesce={"parse_src", "parse_yaml"},
+)
+cache: Optional[ParseCache] = None
+_saves: Dict[str, asyncio.TimerHandle] = {}
+_cools: Dict[str, asyncio.TimerHandle] = {}
+# Indexes of the workspace folders, by path
+workspaces: Dict[str, Workspace] = {}
+# Plots of the YAML documents of the test mode, by uri
+yaml_documents: Dict[str, YamlPlot] = {}
+
+
+async def _build(sources: List[ChunkSource]) -> List[Fragment]:
+    profile = dispatcher.profiler.active
+    if sum(len(s.text) for s in sources) < POOL_THRESHOLD or (
+        # Only what runs in this process shows in the profile
+        profile is not None
+        and profile.cpu is not None
+    ):
+        return build_fragments(sources)
+    # Interleave the chunks, so that the batches are about the same size
+    batches = [sources[i::WORKERS] for i in range(WORKERS)]
+    results = await asyncio.gather(
+        *(dispatcher.run_in_executor(build_fragments, batch) for batch in batches)
+    )
+    fragments = [None] * len(sources)
+    for i, result in enumerate(results):
+        fragments[i::WORKERS] = result
+    return fragments
+
+
+async def _fragments(plan: ParsePlan) -> List[Fragment]:
+    """Fragments of the chunks missing from the memory cache, from disk or built"""
+    sources = plan.missing_sources()
+    if cache is None:
+        return await _build(sources)
+    fragments = cache.fragments([s.key for s in sources])
+    missing = [i for i, fragment in enumerate(fragments) if fragment is None]
+    built = await _build([sources[i] for i in missing])
+    for i, fragment in zip(missing, built):
+        fragments[i] = fragment
+    cache.put_fragments((sources[i].key, fragments[i]) for i in missing)
+    return fragments
+
+
+async def _warm(doc: Document) -> None:
+    """Build the store of a document whose plot was sent from the disk cache"""
+    if doc.cold is None:
+        return
+    source, plot = doc.cold
+    with stage("parse"):
+        plan = parser.plan(source)
+        parsed = parser.complete(plan, await _fragments(plan), assemble=False)
+    doc.parsed = parsed
+    doc.cold = None
+    with stage("mutate"):
+        doc.store.apply(parsed)
+        doc.store.delta()
+        if doc.graph is not None:
+            doc.graph.reset(doc.store.plot)
+        if doc.canonical is not None:
+            doc.canonical.reset(doc.store.plot)
+        if doc.analysis is not None:
+            doc.analysis.reset(doc.store.plot)
+        if doc.completion is not None:
+            doc.completion.reset(doc.store.plot)
+    if doc.store.plot != plot.to_plot():
+        # Ids only depend on the source, but the parser may have been updated since
+        # the plot was cached, and deltas against the plot sent would be wrong then,
+        # so skip a version to have the next reply sent in full
+        doc.version += 1
+
+
+def _schedule(timers: Dict[str, asyncio.TimerHandle], delay: float, fn, doc) -> None:
+    """Call ``fn(doc)`` after ``delay`` seconds, unless scheduled again before that"""
+    handle = timers.pop(doc.uri, None)
+    if handle is not None:
+        handle.cancel()
+    timers[doc.uri] = asyncio.get_running_loop().call_later(delay, fn, doc)
+
+
+def _save(doc: Document) -> None:
+    _saves.pop(doc.uri, None)
+    if doc.parsed is not None:
+        cache.put_plot(doc.parsed.source, CompactPlot.from_plot(doc.store.plot))
+
+
+def _schedule_save(doc: Document) -> None:
+    if cache is not None:
+        _schedule(_saves, SAVE_DELAY, _save, doc)
+
+
+def _cool(doc: Document) -> None:
+    _cools.pop(doc.uri, None)
+    if doc.uri in dispatcher.tails:
+        # A message about it is still being handled
+        _schedule(_cools, COOL_DELAY, _cool, doc)
+        return
+    if doc.parsed is not None:
+        # The fragments stay in the cache, so that the ids are the same once warm again
+        parser.release(doc.parsed)
+    doc.cool()
+
+
+def _document(payload: dict) -> Document:
+    """The document a message is about, cooled down once left alone for a while"""
+    doc = documents.get(payload.get("uri", ""))
+    _schedule(_cools, COOL_DELAY, _cool, doc)
+    return doc
+
+
+def _check_version(uri: str, payload: dict) -> None:
+    """Drop the parse of an older version of a document than the last one parsed"""
+    version = payload.get("documentVersion")
+    if version is not None:
+        # Each client numbers the versions of its documents
+        versions = session().document_versions
+        if version < versions.get(uri, version):
+            raise Superseded()
+        versions[uri] = version
+
+
+async def parse_src(payload: dict) -> dict:
+    doc = _document(payload)
+    _check_version(doc.uri, payload)
+    source = payload["source"]
+    if doc.parsed is None and doc.cold is None and cache is not None:
+        plot = cache.plot(source)
+        if plot is not None:
+            with stage("reply"):
+                return _with_options(doc.reply_cold(source, plot), doc, payload)
+    await _warm(doc)
+    with stage("parse"):
+        plan = parser.plan(source, doc.parsed)
+        fragments = await _fragments(plan)
+        doc.parsed = parser.complete(plan, fragments, assemble=False)
+    with stage("mutate"):
+        doc.store.apply(doc.parsed)
+    _schedule_save(doc)
+    with stage("reply"):
+        reply = doc.reply(payload.get("delta", False), payload.get("baseVersion"))
+        return _with_options(reply, doc, payload)
+
+
+def _with_options(reply: dict, doc: Document, payload: dict) -> dict:
+    """
+    Send the canonical plot, and add the graph, the positions of its nodes, the
+    problems found in the plot and the definitions of its py_defs to a reply, if asked
+    for
+    """
+    base = payload.get("baseVersion") if payload.get("delta") else None
+    if payload.get("canonical"):
+        doc.reply_canonical(reply, base)
+    if payload.get("graph"):
+        doc.reply_graph(reply, base)
+    if payload.get("layout"):
+        doc.reply_layout(reply, base)
+    if payload.get("analysis"):
+        doc.reply_analysis(reply, payload.get("start"))
+    if payload.get("definitions"):
+        reply["definitions"] = _definitions(doc)
+    return reply
+
+
+def _path(uri: str) -> str:
+    """Path of a file uri, other uris (and paths) are taken as paths"""
+    parsed = urllib.parse.urlparse(uri)
+    path = urllib.parse.unquote(parsed.path) if parsed.scheme == "file" else uri
+    return os.path.abspath(path)
+
+
+def _definitions(doc: Document) -> dict:
+    """Where the py_defs of a document are defined, if it is in an indexed workspace"""
+    path = _path(doc.uri)
+    for workspace in workspaces.values():
+        if workspace.contains(path):
+            return workspace.definitions(path, doc.require_plot())
+    return {}
+
+
+def layout(payload: dict) -> dict:
+    """Positions of the nodes of the graph of the last plot sent"""
+    doc = documents.get(payload.get("uri", ""))
+    with stage("reply"):
+        return doc.reply_layout({"version": doc.version}, payload.get("baseVersion"))
+
+
+def _edit(doc: Document, parsed: ParsedScript, name: str, payload: dict):
+    """
+    Apply a put_obj or post_obj, return the new parse, the text edits (last first)
+    and the id of the object
+    """
+    editor = Editor(parser, parsed, doc.store)
+    with stage("codegen"):
+        if name == "put_obj":
+            objid = doc.locate(payload["objid"])
+            edits, created = editor.put(objid, payload["update"])
+        elif name == "post_obj":
+            edit, created = editor.post(payload["type"], payload.get("props", {}))
+            edits = [edit]
+        else:
+            raise EditError(f"Can not batch {name} messages")
+        # Backwards, so the offsets of the remaining edits stay valid
+        edits.reverse()
+        source = parsed.source
+        for edit in edits:
+            source = edit.apply(source)
+    # Edits mostly touch a single chunk, so this is an incremental reparse
+    with stage("parse"):
+        parsed = parser.parse(source, parsed, assemble=False)
+    with stage("mutate"):
+        doc.store.apply(parsed)
+    return parsed, edits, created(doc.store.plot)
+
+
+def _resolve(value, objids: List[str]):
+    """Replace ``"$<i>"`` by the id of the object of the i-th operation of a batch"""
+    if isinstance(value, str) and value.startswith("$") and value[1:].isdigit():
+        i = int(value[1:])
+        if i >= len(objids):
+            raise EditError(f"{value} refers to a later operation")
+        return objids[i]
+    if isinstance(value, dict):
+        return {key: _resolve(v, objids) for key, v in value.items()}
+    return value
+
+
+def _transaction(doc: Document, operations: List[dict]) -> Tuple[List[dict], list]:
+    """
+    Apply edits to a document, either all of them or none. Return the text edits
+    to apply to the document, and the ids of the objects of each operation.
+    """
+    parsed = original = doc.require_parsed()
+    edits = TextEdits()
+    objids: List[str] = []
     try:
-        msg = json.loads(input())
-    except EOFError:
-        break
-    print(json.dumps({"msgId": msg["id"]}))
+        for op in operations:
+            payload = _resolve(op["payload"], objids)
+            parsed, op_edits, objid = _edit(doc, parsed, op["name"], payload)
+            for edit in op_edits:
+                edits.add(edit)
+            objids.append(objid)
+    except Exception:
+        # Roll the store back to the last committed parse
+        with stage("mutate"):
+            doc.store.apply(original)
+        raise
+    doc.parsed = parsed
+    doc.history.record(original.source, edits, parsed.source)
+    return edits.ranges(original.source), objids
+
+
+async def put_obj(payload: dict) -> dict:
+    doc = _document(payload)
+    await _warm(doc)
+    edits, _ = _transaction(doc, [{"name": "put_obj", "payload": payload}])
+    return {"edits": edits}
+
+
+async def post_obj(payload: dict) -> dict:
+    doc = _document(payload)
+    await _warm(doc)
+    edits, [objid] = _transaction(doc, [{"name": "post_obj", "payload": payload}])
+    return {"edits": edits, "objid": objid}
+
+
+async def batch(payload: dict) -> dict:
+    """
+    Apply several edits at once. Either all of them are applied or none, and the
+    changes are only sent back once.
+    """
+    doc = _document(payload)
+    await _warm(doc)
+    edits, objids = _transaction(doc, payload["operations"])
+    return {"edits": edits, "objids": objids}
+
+
+async def simulate_plot(payload: dict) -> dict:
+    """
+    Run synthetic conversations over the plot of a document, and count the visits of
+    every node and transition, see ``simulation``
+    """
+    doc = _document(payload)
+    plot = doc.require_plot()
+    conversations = payload.get("conversations", 1000)
+    turns = payload.get("turns", 100)
+    options = {
+        key: payload[key]
+        for key in ("leaves", "default", "start", "fallback")
+        if key in payload
+    }
+    parts = 1
+    if conversations * turns >= SIMULATION_SPLIT:
+        parts = max(1, min(WORKERS, conversations))
+    sizes = [conversations // parts + (i < conversations % parts) for i in range(parts)]
+    seeds = np.random.SeedSequence(payload.get("seed")).spawn(parts)
+    results = await asyncio.gather(
+        *(
+            dispatcher.run_in_executor(
+                partial(simulate, plot, size, turns, seed, **options)
+            )
+            for size, seed in zip(sizes, seeds)
+        )
+    )
+    return merge(results)
+
+
+async def complete(payload: dict) -> dict:
+    """Suggestions for the autocompletion of an input, see ``completion``"""
+    doc = _document(payload)
+    await _warm(doc)
+    with stage("reply"):
+        suggestions = doc.require_completion().complete(
+            payload["input"], payload.get("kinds"), payload.get("limit", 10)
+        )
+    return {"suggestions": suggestions}
+
+
+async def index_workspace(payload: dict) -> dict:
+    """
+    Index the python files of a workspace folder, or the ones which changed since the
+    last time, see ``workspace``
+    """
+    root = _path(payload["uri"])
+    workspace = workspaces.get(root)
+    if workspace is None:
+        workspace = workspaces[root] = Workspace(root, WORKERS)
+    with stage("parse"):
+        return await workspace.refresh(dispatcher.run_in_executor)
+
+
+async def _travel(payload: dict, redo: bool) -> dict:
+    """
+    Undo (or redo) the last edit the server made to a document, see ``history``. The
+    plot is sent by the ``parse_src`` of the document once the edits are applied.
+    """
+    yaml_doc = yaml_documents.get(payload["uri"])
+    if yaml_doc is not None:
+        with stage("codegen"):
+            return {"edits": yaml_doc.redo() if redo else yaml_doc.undo()}
+    doc = _document(payload)
+    await _warm(doc)
+    parsed = doc.require_parsed()
+    with stage("codegen"):
+        move = doc.history.redo if redo else doc.history.undo
+        source, edits, _ = move(parsed.source)
+    with stage("parse"):
+        plan = parser.plan(source, parsed)
+        doc.parsed = parser.complete(plan, await _fragments(plan), assemble=False)
+    with stage("mutate"):
+        doc.store.apply(doc.parsed)
+    return {"edits": edits.ranges(parsed.source)}
+
+
+async def undo(payload: dict) -> dict:
+    return await _travel(payload, False)
+
+
+async def redo(payload: dict) -> dict:
+    return await _travel(payload, True)
+
+
+def parse_yaml(payload: dict) -> dict:
+    """The plot of a YAML document, see ``yaml_plots``"""
+    _check_version(payload["uri"], payload)
+    doc = yaml_documents.get(payload["uri"])
+    if doc is None:
+        doc = yaml_documents[payload["uri"]] = YamlPlot()
+    with stage("parse"):
+        return {"plot": doc.load(payload["source"])}
+
+
+def dump_yaml(payload: dict) -> dict:
+    """
+    Apply ``put_obj`` and ``post_obj`` operations to a YAML document, either all of
+    them or none, and return the text edits to apply to it
+    """
+    doc = yaml_documents.get(payload["uri"])
+    if doc is None:
+        raise EditError(f"Document {payload['uri']} has not been parsed yet")
+    with stage("codegen"):
+        edits, objids = doc.edit(payload["operations"], _resolve)
+    return {"edits": edits, "objids": objids}
+
+
+dispatcher.handlers.update(
+    {
+        "parse_src": parse_src,
+        "put_obj": put_obj,
+        "post_obj": post_obj,
+        "batch": batch,
+        "layout": layout,
+        "simulate": simulate_plot,
+        "complete": complete,
+        "index_workspace": index_workspace,
+        "parse_yaml": parse_yaml,
+        "dump_yaml": dump_yaml,
+        "undo": undo,
+        "redo": redo,
+        # Percentiles of the time spent on each kind of message, see ``metrics``
+        "stats": lambda payload: dispatcher.metrics.stats(),
+    }
+)
+
+
+def _arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Parse dff scripts for the messages of stdin, or of the clients of "
+        "a socket, which then share the documents and caches"
+    )
+    parser.add_argument("--socket", help="path of a Unix socket to listen on")
+    parser.add_argument(
+        "--idle",
+        type=float,
+        default=IDLE_SHUTDOWN,
+        help="stop listening once no client was connected for this many seconds",
+    )
+    return parser.parse_args()
+
+
+async def main(args: argparse.Namespace) -> None:
+    if STATS_PATH:
+        dump = asyncio.create_task(dispatcher.metrics.dump(STATS_PATH, STATS_INTERVAL))
+    if args.socket is not None:
+        await dispatcher.listen(args.socket, args.idle)
+    else:
+        await dispatcher.serve()
+    if STATS_PATH:
+        dump.cancel()
+        dispatcher.metrics.write(STATS_PATH)
+
+
+if __name__ == "__main__":
+    args = _arguments()
+    if CACHE_PATH:
+        cache = ParseCache(CACHE_PATH)
+    dispatcher.profiler = Profiler.from_env()
+    with ProcessPoolExecutor(WORKERS) as executor:
+        dispatcher.executor = executor
+        asyncio.run(main(args))
+    if cache is not None:
+        # Write the plots which were still changing when the server stopped
+        for uri in list(_saves):
+            _save(documents.get(uri))
+        cache.close()
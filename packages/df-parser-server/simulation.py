@@ -0,0 +1,371 @@
+"""
+Simulation of conversations over a plot, following the transitions as dff does.
+
+The condition of every transition is compiled into an evaluator: ``cnd.all``,
+``cnd.any``, ``cnd.neg``, ``cnd.true`` and ``cnd.false`` are evaluated as such, every
+other condition (a leaf, eg. ``loc_cnd.check_flag("x")``) is stubbed as a constant or
+as true with some probability. Leaves are looked up by their name and arguments as in
+the plot (``loc_cnd.check_flag(x)``), then by their name alone.
+
+At each turn the transitions of the current node, of the ``LOCAL`` node of its flow and
+of the ``GLOBAL`` node are tried by decreasing priority, the node's first, then the
+local ones, then the global ones, each in the order of the source, and the first one
+whose condition holds is taken. Without any, the conversation goes to the fallback
+node. That is the order ``Actor`` picks labels in, so the candidates of every node are
+sorted once. ``lbl.repeat``, ``lbl.previous``, ``lbl.to_start``, ``lbl.to_fallback``,
+``lbl.forward`` and ``lbl.backward`` labels are followed too, other labels which are not
+a node of the plot lead to the fallback node.
+
+Many conversations are run at once with NumPy: the conversations at the same node are
+evaluated together, every evaluator works on a whole group.
+"""
+
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from plot_parser import Plot
+
+DEFAULT_PRIORITY = 1.0
+# Target of ``lbl.previous``, resolved during the run
+_PREVIOUS = -1
+
+# A condition is either constant, or evaluated for a group of conversations
+Evaluator = Union[bool, Callable[[int, np.random.Generator], np.ndarray]]
+Leaves = Dict[str, Union[bool, float]]
+
+
+class SimulationError(Exception):
+    """The plot can not be simulated with the given options."""
+
+
+def _number(text: Any) -> Optional[float]:
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+class Simulation:
+    """Transitions of a plot compiled for ``run``"""
+
+    def __init__(
+        self,
+        plot: Plot,
+        leaves: Optional[Leaves] = None,
+        default: float = 0.5,
+        start: Optional[str] = None,
+        fallback: Optional[str] = None,
+    ):
+        self.plot = plot
+        self.leaves = leaves or {}
+        self.default = default
+        # Probability of every leaf met, by its key
+        self.used: Dict[str, Union[bool, float]] = {}
+        regular = [
+            objid for objid, node in plot["nodes"].items() if node["type"] == "regular"
+        ]
+        if not regular:
+            raise SimulationError("The plot has no nodes to simulate")
+        self.nodes = regular
+        self.index = {objid: i for i, objid in enumerate(regular)}
+        # Modules imported under each name, to recognize dff's conditions and labels
+        self.modules = {
+            record["name"]: record["code"] for record in plot["imports"].values()
+        }
+        self.transitions: List[str] = []
+        self.trans_index: Dict[str, int] = {}
+        # The first regular node of the plot unless given
+        self.start = self._node(start, 0)
+        self.fallback = self._node(fallback, self.start)
+        # Flow of every node, and the nodes of every flow in order
+        self.flow_of: Dict[str, str] = {}
+        for flow, record in plot["flows"].items():
+            for objid in record["nodes"]:
+                self.flow_of.setdefault(objid, flow)
+        self.scopes = self._scopes()
+        self.candidates = [self._candidates(objid) for objid in regular]
+
+    def run(self, conversations: int, turns: int, seed: Any = None) -> dict:
+        """Visits of every node and transition over ``turns`` turns of conversations"""
+        rng = np.random.default_rng(seed)
+        state = np.full(conversations, self.start, dtype=np.intp)
+        previous = state.copy()
+        visits = np.bincount(state, minlength=len(self.nodes))
+        taken = np.zeros(len(self.transitions), dtype=np.int64)
+        fallbacks = 0
+        for _ in range(turns):
+            order = np.argsort(state, kind="stable")
+            ordered = state[order]
+            bounds = np.flatnonzero(np.diff(ordered)) + 1
+            new = np.empty_like(state)
+            chosen = np.full(conversations, -1, dtype=np.intp)
+            for group in np.split(order, bounds):
+                node = state[group[0]]
+                targets, picks = self._step(node, len(group), rng)
+                if (targets == _PREVIOUS).any():
+                    targets = np.where(targets == _PREVIOUS, previous[group], targets)
+                new[group] = targets
+                chosen[group] = picks
+            fallbacks += int((chosen < 0).sum())
+            previous = state
+            state = new
+            visits += np.bincount(state, minlength=len(self.nodes))
+            taken += np.bincount(chosen[chosen >= 0], minlength=len(self.transitions))
+        return {
+            "turns": conversations * turns,
+            "nodes": {
+                objid: int(count) for objid, count in zip(self.nodes, visits) if count
+            },
+            "transitions": {
+                objid: int(count)
+                for objid, count in zip(self.transitions, taken)
+                if count
+            },
+            "fallbacks": fallbacks,
+            "leaves": self.used,
+        }
+
+    def _step(
+        self, node: int, size: int, rng: np.random.Generator
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Next node and transition taken (-1 for none) of a group at a node"""
+        targets = np.full(size, self.fallback, dtype=np.intp)
+        picks = np.full(size, -1, dtype=np.intp)
+        open_ = np.ones(size, dtype=bool)
+        for evaluator, target, trans in self.candidates[node]:
+            if evaluator is True:
+                hit = open_
+            elif evaluator is False:
+                continue
+            else:
+                hit = open_ & evaluator(size, rng)
+            targets[hit] = target
+            picks[hit] = trans
+            if hit is open_:
+                break
+            open_ &= ~hit
+            if not open_.any():
+                break
+        return targets, picks
+
+    def _node(self, objid: Optional[str], default: int) -> int:
+        if objid is None:
+            return default
+        if objid not in self.index:
+            raise SimulationError(f"{objid} is not a regular node of the plot")
+        return self.index[objid]
+
+    def _scopes(self) -> Dict[str, List[str]]:
+        """The global node, and the local node of every flow"""
+        scopes: Dict[str, List[str]] = {}
+        for objid, node in self.plot["nodes"].items():
+            if node["type"] == "global":
+                scopes.setdefault("", []).append(objid)
+            elif node["type"] == "local":
+                scopes.setdefault(self.flow_of.get(objid, ""), []).append(objid)
+        return scopes
+
+    def _candidates(self, objid: str) -> List[Tuple[Evaluator, int, int]]:
+        """Transitions that may be taken at a node, in the order they are tried"""
+        flow = self.flow_of.get(objid)
+        owners = [objid]
+        if flow is not None:
+            owners += self.scopes.get(flow, [])
+        owners += self.scopes.get("", [])
+        ranked = []
+        for scope, owner in enumerate(owners):
+            for trans_id in self.plot["nodes"][owner].get("transitions", ()):
+                trans = self.plot["transitions"][trans_id]
+                target, priority = self._target(objid, trans)
+                if priority is None:
+                    # Priorities which are not a number literal (eg. a variable)
+                    # can't be known, the default one is assumed
+                    priority = _number(trans.get("priority", DEFAULT_PRIORITY))
+                if priority is None:
+                    priority = DEFAULT_PRIORITY
+                evaluator = self._condition(trans["condition"])
+                ranked.append(
+                    (-priority, scope, len(ranked), evaluator, target, trans_id)
+                )
+        ranked.sort(key=lambda candidate: candidate[:3])
+        candidates = []
+        for *_, evaluator, target, trans_id in ranked:
+            if evaluator is False:
+                continue
+            if trans_id not in self.trans_index:
+                self.trans_index[trans_id] = len(self.transitions)
+                self.transitions.append(trans_id)
+            candidates.append((evaluator, target, self.trans_index[trans_id]))
+            if evaluator is True:
+                # The next ones are never tried
+                break
+        return candidates
+
+    def _target(self, objid: str, trans: Dict[str, Any]) -> Tuple[int, Optional[float]]:
+        """Node a transition leads to from a node, and the priority set by its label"""
+        label = trans["label"]
+        if label in self.index:
+            return self.index[label], None
+        link = self.plot["linking"].get(label)
+        if link is None:
+            # A node which is not in the plot
+            return self.fallback, None
+        name = self._builtin(link["object"], "labels")
+        args = link.get("args", [])
+        priority = _number(args[0]) if args else None
+        here = self.index[objid]
+        if name == "repeat":
+            return here, priority
+        if name == "previous":
+            return _PREVIOUS, priority
+        if name == "to_start":
+            return self.start, priority
+        if name in ("forward", "backward"):
+            flow = self.flow_of.get(objid)
+            if flow is None:
+                # A node outside of the flows, it has no siblings
+                return self.fallback, priority
+            siblings = [
+                node for node in self.plot["flows"][flow]["nodes"] if node in self.index
+            ]
+            step = 1 if name == "forward" else -1
+            sibling = siblings[(siblings.index(objid) + step) % len(siblings)]
+            return self.index[sibling], priority
+        return self.fallback, priority
+
+    def _name(self, objid: str) -> str:
+        py_def = self.plot["py_defs"].get(objid)
+        return py_def["name"] if py_def is not None else objid
+
+    def _builtin(self, objid: str, module: str) -> Optional[str]:
+        """Name of the function of dff's ``module`` an object is, if it is one"""
+        name = self._name(objid)
+        if "." not in name:
+            return None
+        prefix, function = name.rsplit(".", 1)
+        code = self.modules.get(prefix.split(".", 1)[0], prefix)
+        if re.search(rf"\b(df_engine|dff)\b.*\b{module}\b", code):
+            return function
+        return None
+
+    def _condition(self, value: Any) -> Evaluator:
+        """Compile a condition (a linking object, a python object or code)"""
+        if isinstance(value, list):
+            # Lists of conditions only appear as arguments of cnd.all/cnd.any
+            return self._all([self._condition(item) for item in value])
+        link = self.plot["linking"].get(value)
+        if link is None:
+            # Also eg. ``cnd.true`` in a list, without calling it
+            function = self._builtin(value, "conditions")
+            if function in ("true", "false"):
+                return function == "true"
+            return self._leaf(self._name(value))
+        name = self._name(link["object"])
+        function = self._builtin(link["object"], "conditions")
+        args = link.get("args", [])
+        if function == "true" and not args:
+            return True
+        if function == "false" and not args:
+            return False
+        if function in ("all", "any", "neg", "negation") and len(args) == 1:
+            arg = args[0]
+            items = arg if isinstance(arg, list) else [arg]
+            compiled = [self._condition(item) for item in items]
+            if function == "all":
+                return self._all(compiled)
+            if function == "any":
+                return self._any(compiled)
+            return self._neg(compiled[0])
+        return self._leaf(self._code(value), name)
+
+    def _code(self, value: Any) -> str:
+        if isinstance(value, list):
+            return f"[{', '.join(self._code(item) for item in value)}]"
+        link = self.plot["linking"].get(value)
+        if link is None:
+            return self._name(value)
+        name = self._name(link["object"])
+        args = [self._code(arg) for arg in link.get("args", [])]
+        args += [f"{key}={self._code(v)}" for key, v in link.get("kwargs", {}).items()]
+        return f"{name}({', '.join(args)})" if args else name
+
+    def _leaf(self, *keys: str) -> Evaluator:
+        for key in keys:
+            if key in self.leaves:
+                value = self.leaves[key]
+                break
+        else:
+            key, value = keys[0], self.default
+        self.used[key] = value
+        if isinstance(value, bool) or value in (0, 1):
+            return bool(value)
+        return lambda size, rng: rng.random(size) < value
+
+    @staticmethod
+    def _all(items: List[Evaluator]) -> Evaluator:
+        if any(item is False for item in items):
+            return False
+        items = [item for item in items if item is not True]
+        if not items:
+            return True
+        if len(items) == 1:
+            return items[0]
+
+        def evaluate(size: int, rng: np.random.Generator) -> np.ndarray:
+            result = items[0](size, rng)
+            for item in items[1:]:
+                result &= item(size, rng)
+            return result
+
+        return evaluate
+
+    @staticmethod
+    def _any(items: List[Evaluator]) -> Evaluator:
+        if any(item is True for item in items):
+            return True
+        items = [item for item in items if item is not False]
+        if not items:
+            return False
+        if len(items) == 1:
+            return items[0]
+
+        def evaluate(size: int, rng: np.random.Generator) -> np.ndarray:
+            result = items[0](size, rng)
+            for item in items[1:]:
+                result |= item(size, rng)
+            return result
+
+        return evaluate
+
+    @staticmethod
+    def _neg(item: Evaluator) -> Evaluator:
+        if isinstance(item, bool):
+            return not item
+        return lambda size, rng: ~item(size, rng)
+
+
+def simulate(
+    plot: Plot,
+    conversations: int,
+    turns: int,
+    seed: Any = None,
+    **options,
+) -> dict:
+    """Compile a plot and run conversations over it, see ``Simulation``"""
+    return Simulation(plot, **options).run(conversations, turns, seed)
+
+
+def merge(results: List[dict]) -> dict:
+    """Sum the results of several runs over the same plot"""
+    merged = {"turns": 0, "nodes": {}, "transitions": {}, "fallbacks": 0, "leaves": {}}
+    for result in results:
+        merged["turns"] += result["turns"]
+        merged["fallbacks"] += result["fallbacks"]
+        merged["leaves"].update(result["leaves"])
+        for key in ("nodes", "transitions"):
+            counts = merged[key]
+            for objid, count in result[key].items():
+                counts[objid] = counts.get(objid, 0) + count
+    return merged
@@ -0,0 +1,98 @@
+"""
+Tests of the server, run from ``packages/df-parser-server`` with ``python -m pytest``.
+"""
+
+import os
+import random
+import sys
+from typing import Dict, List
+
+import pytest
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+# The modules of the server are imported by name, as ``server.py`` does
+sys.path.insert(0, os.path.dirname(_HERE))
+# The scripts the extension is tried on
+SCRIPTS = os.path.join(_HERE, "..", "..", "extension", "test")
+
+
+@pytest.fixture(scope="session")
+def scripts() -> Dict[str, str]:
+    """Sources of the dff scripts of the extension, by name"""
+    sources = {}
+    for name in ("book_skill", "covid_skill", "funfact_skill"):
+        with open(os.path.join(SCRIPTS, name + ".py")) as f:
+            sources[name] = f.read()
+    return sources
+
+
+# Inserted at random places of the scripts, mostly what can change their structure
+SNIPPETS = [
+    "GLOBAL",
+    "LOCAL",
+    "TRANSITIONS",
+    ",",
+    ":",
+    "{",
+    "}",
+    "(",
+    ")",
+    "#",
+    "'",
+    '"',
+    "\n",
+    " ",
+    "x",
+    "@x\n",
+    "else:\n",
+    "def f():\n    pass\n",
+    "plot = {",
+    "\nimport re\n",
+    '"a": {}',
+    "cnd.true()",
+]
+
+
+def random_edit(rng: random.Random, source: str) -> str:
+    """Insert a snippet or a piece of the source somewhere, replacing a few characters"""
+    pos = rng.randrange(len(source) + 1)
+    if rng.random() < 0.7:
+        text = rng.choice(SNIPPETS)
+    else:
+        start = rng.randrange(len(source))
+        text = source[start : start + rng.randrange(12)]
+    return source[:pos] + text + source[pos + rng.choice([0, 0, 1, 3, 10]) :]
+
+
+def _offset(source: str, pos: dict) -> int:
+    """Offset of a vscode position, counted in UTF-16 code units"""
+    lines = source.split("\n")
+    line_start = sum(len(line) + 1 for line in lines[: pos["line"]])
+    units = 0
+    for i, char in enumerate(lines[pos["line"]]):
+        if units == pos["character"]:
+            return line_start + i
+        units += 2 if ord(char) > 0xFFFF else 1
+    assert units == pos["character"]
+    return line_start + len(lines[pos["line"]])
+
+
+def apply_ranges(source: str, ranges: List[dict]) -> str:
+    """Apply vscode edits of a source at once, as the editor does"""
+    edits = [
+        (_offset(source, r["range"]["start"]), _offset(source, r["range"]["end"]), r)
+        for r in ranges
+    ]
+    for start, end, edit in sorted(edits, key=lambda e: e[0], reverse=True):
+        source = source[:start] + edit["newText"] + source[end:]
+    return source
+
+
+def apply_delta(plot: dict, delta: dict) -> None:
+    """Apply a delta of a plot (see ``PlotStore.delta``) to it"""
+    for table, changes in delta.items():
+        objects = plot[table]
+        objects.update(changes["added"])
+        objects.update(changes["changed"])
+        for objid in changes["removed"]:
+            del objects[objid]
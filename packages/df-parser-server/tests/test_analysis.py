@@ -0,0 +1,112 @@
+import random
+
+import pytest
+
+from analysis import Analyzer
+from plot_parser import ParseError, PlotParser
+from plot_store import PlotStore
+
+from conftest import random_edit
+
+SCRIPT = """
+import df_engine.conditions as cnd
+import df_engine.labels as lbl
+from df_engine.core.keywords import RESPONSE, TRANSITIONS
+
+plot = {
+    "flow": {
+        "start": {TRANSITIONS: {"a": cnd.true(), "nowhere": cnd.true()}},
+        "a": {TRANSITIONS: {"b": cnd.true()}},
+        "b": {TRANSITIONS: {"c": cnd.true(), "a": cnd.false()}},
+        "c": {TRANSITIONS: {"b": cnd.true(), lbl.repeat(): cnd.true()}},
+        "alone": {RESPONSE: "", TRANSITIONS: {"start": cnd.true()}},
+    },
+}
+"""
+
+
+def _key(diagnostic: dict) -> tuple:
+    return diagnostic["code"], diagnostic["objid"]
+
+
+def _codes(analyzer: Analyzer, plot: dict) -> list:
+    return sorted(
+        (d["code"], plot["nodes"][d["node"]]["name"]) for d in analyzer.diagnostics()
+    )
+
+
+def test_cycles_unreachable_nodes_and_dangling_labels():
+    plot = PlotParser().parse(SCRIPT).plot
+    analyzer = Analyzer(plot)
+    assert _codes(analyzer, plot) == [
+        # a -> b -> c -> b, and c -> c, never leave {a, b, c}
+        ("closed-cycle", "a"),
+        ("dangling-label", "start"),
+        ("unreachable", "alone"),
+    ]
+    [cycle] = [d for d in analyzer.diagnostics() if d["code"] == "closed-cycle"]
+    assert cycle["message"] == "The conversation can not leave the nodes 'a', 'b', 'c'"
+    components = sorted(
+        sorted(plot["nodes"][n]["name"] for n in c) for c in analyzer._components()
+    )
+    assert components == [["a", "b", "c"], ["alone"], ["start"]]
+
+
+def test_cycles_with_a_way_out():
+    edited = SCRIPT.replace('"a": cnd.false()', '"end": cnd.false()')
+    edited = edited.replace(
+        '    "alone"', '    "end": {RESPONSE: ""},\n        "alone"'
+    )
+    plot = PlotParser().parse(edited).plot
+    expected = [("dangling-label", "start"), ("unreachable", "alone")]
+    assert _codes(Analyzer(plot), plot) == expected
+    # Or a GLOBAL transition
+    edited = SCRIPT.replace("plot = {", "plot = {\n    GLOBAL: {TRANSITIONS: {}},", 1)
+    edited = edited.replace("TRANSITIONS\n", "TRANSITIONS, GLOBAL\n")
+    edited = edited.replace("{}}", '{("flow", "start"): cnd.true()}}')
+    plot = PlotParser().parse(edited).plot
+    assert _codes(Analyzer(plot), plot) == expected
+
+
+@pytest.mark.parametrize("name", ["book_skill", "covid_skill", "funfact_skill"])
+def test_updated_diagnostics_are_a_reset(scripts, name):
+    rng = random.Random(3)
+    parser = PlotParser()
+    source = scripts[name]
+    parsed = parser.parse(source, assemble=False)
+    store = PlotStore()
+    store.apply(parsed)
+    store.delta()
+    analyzer = Analyzer(store.plot)
+    for step in range(100):
+        edited = random_edit(rng, source)
+        try:
+            parsed = parser.parse(edited, parsed, assemble=False)
+        except ParseError:
+            continue
+        source = edited
+        store.apply(parsed)
+        analyzer.update(store.delta())
+        fresh = Analyzer(store.plot).diagnostics()
+        assert sorted(analyzer.diagnostics(), key=_key) == sorted(fresh, key=_key), step
+
+
+def test_diagnostics_are_kept_until_the_structure_changes():
+    parser = PlotParser()
+    parsed = parser.parse(SCRIPT, assemble=False)
+    store = PlotStore()
+    store.apply(parsed)
+    store.delta()
+    analyzer = Analyzer(store.plot)
+    diagnostics = analyzer.diagnostics()
+    for old, new in (('"b": cnd.true()', '"b": cnd.false()'), ('""', '"Hi"')):
+        parsed = parser.parse(parsed.source.replace(old, new), parsed, assemble=False)
+        store.apply(parsed)
+        analyzer.update(store.delta())
+        assert analyzer.diagnostics() is diagnostics
+    edited = parsed.source.replace('"c": cnd.true()', '"start": cnd.true()')
+    store.apply(parser.parse(edited, parsed, assemble=False))
+    analyzer.update(store.delta())
+    assert analyzer.diagnostics() == Analyzer(store.plot).diagnostics()
+    # The start node joins the cycle
+    assert analyzer.diagnostics() != diagnostics
@@ -0,0 +1,80 @@
+import copy
+import random
+
+import pytest
+
+from canonical import Canonicalizer
+from plot_parser import ParseError, PlotParser
+from plot_store import PlotStore
+
+from conftest import random_edit
+
+EDITS = 100
+# Indexes of a Canonicalizer which only depend on the plot
+STATE = ("tables", "entry_of", "members", "keys", "entries", "refs", "users")
+
+
+@pytest.mark.parametrize("name", ["book_skill", "covid_skill", "funfact_skill"])
+def test_updated_tables_are_a_reset(scripts, name):
+    rng = random.Random(2)
+    parser = PlotParser()
+    source = scripts[name]
+    parsed = parser.parse(source, assemble=False)
+    store = PlotStore()
+    store.apply(parsed)
+    store.delta()
+    canonical = Canonicalizer(store.plot)
+    canonical.delta()
+    sent = copy.deepcopy(canonical.canonical_plot())
+    for step in range(EDITS):
+        edited = random_edit(rng, source)
+        try:
+            parsed = parser.parse(edited, parsed, assemble=False)
+        except ParseError:
+            continue
+        source = edited
+        store.apply(parsed)
+        canonical.update(store.delta())
+        fresh = Canonicalizer(store.plot)
+        for attr in STATE:
+            assert getattr(canonical, attr) == getattr(fresh, attr), (step, attr)
+        # The deltas add up to the canonical plot too
+        for table, changes in canonical.delta().items():
+            sent[table].update(changes["added"])
+            sent[table].update(changes["changed"])
+            for objid in changes["removed"]:
+                del sent[table][objid]
+        assert sent == canonical.canonical_plot(), step
+
+
+SCRIPT = """
+import df_engine.conditions as cnd
+from df_engine.core.keywords import TRANSITIONS
+
+plot = {
+    "flow": {
+        "a": {TRANSITIONS: {"b": cnd.true(), "c": cnd.true()}},
+        "b": {TRANSITIONS: {"a": cnd.true()}},
+        "c": {},
+    },
+}
+"""
+
+
+def test_calls_are_merged_and_split():
+    parser = PlotParser()
+    parsed = parser.parse(SCRIPT, assemble=False)
+    store = PlotStore()
+    store.apply(parsed)
+    store.delta()
+    canonical = Canonicalizer(store.plot)
+    [entry] = canonical.members
+    assert len(canonical.members[entry]) == 3
+    edited = SCRIPT.replace('"a": cnd.true()', '"a": cnd.false()')
+    store.apply(parser.parse(edited, parsed, assemble=False))
+    canonical.update(store.delta())
+    assert sorted(map(len, canonical.members.values())) == [1, 2]
+    assert entry in canonical.members
+    fresh = Canonicalizer(store.plot)
+    for attr in STATE:
+        assert getattr(canonical, attr) == getattr(fresh, attr), attr
@@ -0,0 +1,66 @@
+import json
+import random
+
+import pytest
+
+from compact import CompactPlot
+from plot_parser import TABLES, ParseError, PlotParser
+from plot_store import PlotStore
+
+from conftest import random_edit
+
+EDITS = 50
+
+
+def _same(plot: dict, expected: dict) -> bool:
+    """Equal, with the same order of the keys and the same types of the values"""
+    return json.dumps(plot) == json.dumps(expected) and _types(plot) == _types(expected)
+
+
+def _types(value):
+    if isinstance(value, dict):
+        return {key: _types(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_types(item) for item in value]
+    return type(value).__name__
+
+
+@pytest.mark.parametrize("name", ["book_skill", "covid_skill", "funfact_skill"])
+def test_compact_plots_are_the_plots(scripts, name):
+    plot = PlotParser().parse(scripts[name]).plot
+    compact = CompactPlot.from_plot(plot)
+    assert _same(compact.to_plot(), plot)
+    # Every id is stored once
+    assert len(compact.values) == len(set(map(repr, compact.values)))
+    for table in TABLES:
+        assert list(compact.records(table)) == list(plot[table].items())
+
+
+def test_values_keep_their_type():
+    plot = {table: {} for table in TABLES}
+    plot["py_defs"]["id#df1"] = {"name": "1", "args": [1, 1.0, True, None, "1"]}
+    plot["linking"]["id#ln1"] = {
+        "object": "id#df1",
+        "args": [[], [[]], {}, {"é": "ü\n"}],
+        "kwargs": {"b": 0, "a": False, "c": -2.5},
+    }
+    compact = CompactPlot.from_plot(plot)
+    assert _same(compact.to_plot(), plot)
+
+
+def test_compact_plots_of_edited_scripts(scripts):
+    rng = random.Random(5)
+    parser = PlotParser()
+    source = scripts["book_skill"]
+    parsed = parser.parse(source, assemble=False)
+    store = PlotStore()
+    for _ in range(EDITS):
+        edited = random_edit(rng, source)
+        try:
+            parsed = parser.parse(edited, parsed, assemble=False)
+        except ParseError:
+            continue
+        source = edited
+        store.apply(parsed)
+        store.delta()
+        assert _same(CompactPlot.from_plot(store.plot).to_plot(), store.plot)
@@ -0,0 +1,168 @@
+import random
+
+import pytest
+
+from completion import CompletionIndex
+from plot_parser import ParseError, PlotParser
+from plot_store import PlotStore
+
+from conftest import random_edit
+
+EDITS = 100
+# Indexes of a CompletionIndex which only depend on the plot
+STATE = ("uses", "terms", "deps", "dependents", "trigrams")
+QUERIES = ("", "a", "loc", "about", "book", "flo", "star", "Hel", "abuot_bok", "cnd")
+
+SCRIPT = """
+import df_engine.conditions as cnd
+import loc_cnd
+from df_engine.core.keywords import RESPONSE, TRANSITIONS
+
+plot = {
+    "global_flow": {
+        "start": {
+            RESPONSE: "Hello",
+            TRANSITIONS: {
+                ("book_flow", "about_book"): loc_cnd.about_book(),
+                ("book_flow", "about_movie"): loc_cnd.about_movie(),
+            },
+        },
+    },
+    "book_flow": {
+        "about_book": {
+            RESPONSE: "Tell me about a book",
+            TRANSITIONS: {"about_movie": loc_cnd.about_book()},
+        },
+        "about_movie": {
+            RESPONSE: "Hello again",
+            TRANSITIONS: {("global_flow", "start"): cnd.true()},
+        },
+    },
+}
+"""
+
+
+def _values(results: list) -> list:
+    return [(r["type"], r["value"]) for r in results]
+
+
+def _found(results: list) -> list:
+    """Values of the terms found from the input, not close to it"""
+    return [value for r, value in zip(results, _values(results)) if r["score"] > -2]
+
+
+def _same(results: list, expected: list) -> bool:
+    """Equal up to the order, and the choice, of the terms with the lowest score"""
+    scores = [r["score"] for r in results]
+    if scores != [r["score"] for r in expected]:
+        return False
+    above = [r for r in results if r["score"] > min(scores, default=0)]
+    return sorted(map(str, above)) == sorted(
+        str(r) for r in expected if r["score"] > min(scores, default=0)
+    )
+
+
+def test_prefixes_then_word_starts_then_typos():
+    index = CompletionIndex(PlotParser().parse(SCRIPT).plot)
+    # Used twice, then once
+    assert _values(index.complete("loc_cnd.about", ["condition"])) == [
+        ("condition", "loc_cnd.about_book"),
+        ("condition", "loc_cnd.about_movie"),
+    ]
+    # The start of the terms first, then the start of one of their words
+    results = index.complete("about")
+    assert _values(results) == [
+        ("node", "about_book"),
+        ("node", "about_movie"),
+        ("condition", "loc_cnd.about_book"),
+        ("condition", "loc_cnd.about_movie"),
+        ("response", "Tell me about a book"),
+    ]
+    assert results[1]["score"] > -1 > results[2]["score"]
+    assert _values(index.complete("book", ["flow", "node"])) == [
+        ("flow", "book_flow"),
+        ("node", "about_book"),
+    ]
+    assert _values(index.complete("hel", ["response"])) == [
+        ("response", "Hello"),
+        ("response", "Hello again"),
+    ]
+    # Close to the input, once the prefixes are not enough
+    results = index.complete("loc_cnd.abuot_bok", ["condition"])
+    assert _values(results)[:1] == [("condition", "loc_cnd.about_book")]
+    assert results[0]["score"] < -2
+    assert _values(index.complete("loc_cnd.about", ["condition"], limit=1)) == [
+        ("condition", "loc_cnd.about_book")
+    ]
+    assert index.complete("zzz") == []
+
+
+def test_terms_are_collected_again_after_an_edit():
+    parser = PlotParser()
+    parsed = parser.parse(SCRIPT, assemble=False)
+    store = PlotStore()
+    store.apply(parsed)
+    store.delta()
+    index = CompletionIndex(store.plot)
+    assert _found(index.complete("loc_cnd.about_m")) == [
+        ("condition", "loc_cnd.about_movie")
+    ]
+    edits = (
+        ("loc_cnd.about_movie()", "loc_cnd.about_film()"),
+        ('"Hello again"', '"Goodbye"'),
+        ("book_flow", "library"),
+    )
+    for old, new in edits:
+        parsed = parser.parse(parsed.source.replace(old, new), parsed, assemble=False)
+        store.apply(parsed)
+        index.update(store.delta())
+    assert _found(index.complete("loc_cnd.about_m")) == []
+    assert _found(index.complete("loc_cnd.about_f")) == [
+        ("condition", "loc_cnd.about_film")
+    ]
+    assert _found(index.complete("hel", ["response"])) == [("response", "Hello")]
+    assert _found(index.complete("lib")) == [("flow", "library")]
+    assert _found(index.complete("book_")) == []
+    assert index.uses[("condition", "loc_cnd.about_book")] == 2
+    parsed = parser.parse(
+        parsed.source.replace('"about_movie": loc_cnd.about_book()', '"x": cnd.true()'),
+        parsed,
+        assemble=False,
+    )
+    store.apply(parsed)
+    index.update(store.delta())
+    # Used once now, the same as about_film
+    assert index.uses[("condition", "loc_cnd.about_book")] == 1
+    fresh = CompletionIndex(store.plot)
+    for text in QUERIES:
+        assert _same(index.complete(text), fresh.complete(text)), text
+
+
+@pytest.mark.parametrize("name", ["book_skill", "covid_skill", "funfact_skill"])
+def test_updated_terms_are_a_reset(scripts, name):
+    rng = random.Random(4)
+    parser = PlotParser()
+    source = scripts[name]
+    parsed = parser.parse(source, assemble=False)
+    store = PlotStore()
+    store.apply(parsed)
+    store.delta()
+    index = CompletionIndex(store.plot)
+    for step in range(EDITS):
+        edited = random_edit(rng, source)
+        try:
+            parsed = parser.parse(edited, parsed, assemble=False)
+        except ParseError:
+            continue
+        source = edited
+        store.apply(parsed)
+        index.update(store.delta())
+        # Searched between the edits, so that the candidates of the tries are kept
+        index.complete(QUERIES[step % len(QUERIES)])
+    fresh = CompletionIndex(store.plot)
+    for attr in STATE:
+        assert getattr(index, attr) == getattr(fresh, attr), attr
+    for text in QUERIES:
+        for kinds in (None, ["condition"], ["node", "flow"]):
+            results = index.complete(text, kinds)
+            assert _same(results, fresh.complete(text, kinds)), (text, kinds)
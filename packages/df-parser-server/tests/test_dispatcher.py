@@ -0,0 +1,116 @@
+import asyncio
+import random
+from typing import List
+
+from dispatcher import Dispatcher, Session
+
+
+class Replies:
+    """Channel keeping the replies sent to a session"""
+
+    def __init__(self):
+        self.replies: List[dict] = []
+
+    def send(self, reply: dict) -> int:
+        self.replies.append(reply)
+        return 0
+
+    def by_id(self) -> dict:
+        return {reply["msgId"]: reply for reply in self.replies}
+
+
+def _session() -> Session:
+    return Session(Replies())
+
+
+def _msg(msgid, name: str, uri: str = "doc", **payload) -> dict:
+    return {"id": msgid, "name": name, "payload": {"uri": uri, **payload}}
+
+
+def test_older_parse_of_the_same_session_is_superseded():
+    async def run():
+        release = asyncio.Event()
+
+        async def parse_src(payload):
+            await release.wait()
+            return payload["n"]
+
+        dispatcher = Dispatcher({"parse_src": parse_src}, coalesce={"parse_src"})
+        first, second = _session(), _session()
+        tasks = [
+            dispatcher.dispatch(_msg(1, "parse_src", n=1), session=first),
+            # Waits behind the first one, then takes its place
+            dispatcher.dispatch(_msg(2, "parse_src", n=2), session=first),
+            dispatcher.dispatch(_msg(3, "parse_src", n=3), session=first),
+            # Another client still wants the reply to its own
+            dispatcher.dispatch(_msg(4, "parse_src", n=4), session=second),
+            dispatcher.dispatch(_msg(5, "parse_src", "other", n=5), session=first),
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return first.channel.by_id(), second.channel.by_id()
+
+    first, second = asyncio.run(run())
+    assert first[1] == {"msgId": 1, "superseded": True}
+    assert first[2] == {"msgId": 2, "superseded": True}
+    assert first[3] == {"msgId": 3, "payload": 3}
+    assert first[5] == {"msgId": 5, "payload": 5}
+    assert second == {4: {"msgId": 4, "payload": 4}}
+
+
+def test_deadline_exceeded():
+    async def run():
+        async def slow(payload):
+            await asyncio.sleep(1)
+            return "done"
+
+        dispatcher = Dispatcher({"slow": slow, "fast": lambda payload: "done"})
+        session = _session()
+        await asyncio.gather(
+            dispatcher.dispatch(_msg(1, "slow", deadline=10), session=session),
+            # Past its deadline while waiting for the first one
+            dispatcher.dispatch(_msg(2, "fast", deadline=5), session=session),
+            dispatcher.dispatch(_msg(3, "fast", "other", deadline=5), session=session),
+        )
+        return session.channel.by_id()
+
+    replies = asyncio.run(run())
+    assert replies[1] == {"msgId": 1, "error": "Deadline exceeded"}
+    assert replies[2] == {"msgId": 2, "error": "Deadline exceeded"}
+    assert replies[3] == {"msgId": 3, "payload": "done"}
+
+
+def test_messages_of_a_document_run_in_order():
+    rng = random.Random(0)
+    handled: List[tuple] = []
+
+    async def run():
+        async def work(payload):
+            handled.append(("start", payload["uri"], payload["n"]))
+            await asyncio.sleep(rng.random() / 1000)
+            handled.append(("end", payload["uri"], payload["n"]))
+            return payload["n"]
+
+        dispatcher = Dispatcher({"work": work, "quick": lambda payload: payload["n"]})
+        sessions = [_session(), _session()]
+        tasks = []
+        for n in range(60):
+            name = rng.choice(["work", "work", "quick"])
+            msg = _msg(n, name, rng.choice("ab"), n=n)
+            tasks.append(dispatcher.dispatch(msg, session=rng.choice(sessions)))
+        await asyncio.gather(*tasks)
+        return tasks, sessions
+
+    tasks, sessions = asyncio.run(run())
+    for uri in "ab":
+        events = [(event, n) for event, u, n in handled if u == uri]
+        # Never interleaved, and in the order received
+        assert events == [(e, n) for _, n in events[::2] for e in ("start", "end")]
+        assert [n for _, n in events[::2]] == sorted(n for _, n in events[::2])
+    # Documents are handled concurrently
+    assert [u for _, u, _ in handled[:4]] != [handled[0][1]] * 4
+    replies = {}
+    for session in sessions:
+        replies.update(session.channel.by_id())
+    assert replies == {n: {"msgId": n, "payload": n} for n in range(60)}
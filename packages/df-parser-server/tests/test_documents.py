@@ -0,0 +1,93 @@
+import copy
+import random
+
+import pytest
+
+from documents import Document
+from plot_parser import ParseError, PlotParser
+
+from conftest import apply_delta, random_edit
+
+EDITS = 150
+
+
+def _apply_graph_delta(graph: dict, delta: dict) -> None:
+    nodes = {gnode["id"]: gnode for gnode in graph["nodes"]}
+    for gnode in (*delta["nodes"]["added"], *delta["nodes"]["changed"]):
+        nodes[gnode["id"]] = gnode
+    for gid in delta["nodes"]["removed"]:
+        del nodes[gid]
+    edges = [e for e in graph["edges"] if e not in delta["edges"]["removed"]]
+    graph["nodes"] = list(nodes.values())
+    graph["edges"] = edges + delta["edges"]["added"]
+
+
+def _same_graph(a: dict, b: dict) -> bool:
+    def key(edge):
+        return edge["fromId"], edge["toId"]
+
+    nodes = sorted(a["nodes"], key=lambda n: n["id"])
+    return nodes == sorted(b["nodes"], key=lambda n: n["id"]) and sorted(
+        a["edges"], key=key
+    ) == sorted(b["edges"], key=key)
+
+
+@pytest.mark.parametrize("name", ["book_skill", "covid_skill", "funfact_skill"])
+def test_deltas_add_up_to_the_full_replies(scripts, name):
+    rng = random.Random(0)
+    parser = PlotParser()
+    doc = Document(name)
+    source = scripts[name]
+    doc.parsed = parser.parse(source, assemble=False)
+    doc.store.apply(doc.parsed)
+    reply = doc.reply(True, None)
+    doc.reply_graph(reply, None)
+    doc.reply_layout(reply, None)
+    plot = copy.deepcopy(reply["plot"])
+    graph = copy.deepcopy(reply["graph"])
+    positions = dict(reply["positions"])
+    seen = {"removed": 0, "changed": 0, "graph": 0, "layout": 0}
+    for step in range(EDITS):
+        edited = random_edit(rng, source)
+        try:
+            parsed = parser.parse(edited, doc.parsed, assemble=False)
+        except ParseError:
+            continue
+        source, doc.parsed = edited, parsed
+        doc.store.apply(parsed)
+        base = doc.version
+        reply = doc.reply(True, base)
+        doc.reply_graph(reply, base)
+        doc.reply_layout(reply, base)
+        assert reply["version"] == base + 1
+        apply_delta(plot, reply["delta"])
+        assert plot == doc.store.plot, f"edit {step} of {name}"
+        _apply_graph_delta(graph, reply["graphDelta"])
+        assert _same_graph(graph, doc.graph.graph()), f"edit {step} of {name}"
+        layout = reply["layoutDelta"]
+        positions.update(layout["changed"])
+        for gid in layout["removed"]:
+            del positions[gid]
+        assert positions == doc.layout.positions(), f"edit {step} of {name}"
+        for changes in reply["delta"].values():
+            seen["removed"] += len(changes["removed"])
+            seen["changed"] += len(changes["changed"])
+        seen["graph"] += any(reply["graphDelta"]["nodes"].values())
+        seen["layout"] += bool(layout["changed"] or layout["removed"])
+    assert all(seen.values()), seen
+
+
+def test_replies_are_full_against_another_version(scripts):
+    doc = Document("full")
+    doc.parsed = PlotParser().parse(scripts["funfact_skill"], assemble=False)
+    doc.store.apply(doc.parsed)
+    first = doc.reply(True, None)
+    doc.reply_graph(first, None)
+    second = doc.reply(True, first["version"] - 1)
+    doc.reply_graph(second, first["version"] - 1)
+    assert second["plot"] == first["plot"]
+    assert second["graph"] == first["graph"]
+    third = doc.reply(True, second["version"])
+    doc.reply_graph(third, second["version"])
+    assert third["delta"] == {}
+    assert third["graphDelta"]["nodes"] == {"added": [], "removed": [], "changed": []}
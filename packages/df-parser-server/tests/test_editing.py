@@ -0,0 +1,73 @@
+import random
+
+import pytest
+
+from editing import TextEdit, TextEdits, position
+
+from conftest import apply_ranges
+
+# Characters the edits are made of, with some outside of the BMP (two UTF-16 units)
+ALPHABET = "ab\n é😀𝄞"
+
+
+def _text(rng: random.Random, size: int) -> str:
+    return "".join(rng.choice(ALPHABET) for _ in range(size))
+
+
+def test_position_counts_utf16_units():
+    source = "a😀b\n𝄞é\n"
+    assert position(source, 0) == {"line": 0, "character": 0}
+    assert position(source, 2) == {"line": 0, "character": 3}
+    assert position(source, 3) == {"line": 0, "character": 4}
+    assert position(source, 4) == {"line": 1, "character": 0}
+    assert position(source, 6) == {"line": 1, "character": 3}
+    assert position(source, 8) == {"line": 2, "character": 0}
+
+
+@pytest.mark.parametrize(
+    "edits, expected",
+    [
+        # Disjoint, kept apart and in order
+        ([(4, 5, "X"), (0, 1, "Y")], [(0, 1, "Y"), (4, 5, "X")]),
+        # Adjacent: right after, and right before the previous one
+        ([(1, 2, "XY"), (3, 4, "Z")], [(1, 3, "XYZ")]),
+        ([(2, 3, "X"), (2, 2, "Y")], [(2, 3, "YX")]),
+        # Overlapping the previous edit, and covering it
+        ([(1, 3, "XYZ"), (2, 5, "W")], [(1, 4, "XW")]),
+        ([(2, 3, "X"), (0, 5, "")], [(0, 5, "")]),
+        # Inside the text of the previous edit
+        ([(1, 1, "XYZ"), (2, 3, "")], [(1, 1, "XZ")]),
+        # Bridging two edits
+        ([(1, 2, "X"), (4, 5, "Y"), (1, 5, "Z")], [(1, 5, "Z")]),
+    ],
+)
+def test_edits_are_merged(edits, expected):
+    source = "012345"
+    merged = TextEdits()
+    edited = source
+    for edit in edits:
+        edit = TextEdit(*edit)
+        merged.add(edit)
+        edited = edit.apply(edited)
+    assert merged.edits == [TextEdit(*edit) for edit in expected]
+    assert merged.apply(source) == edited
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_edits_round_trip(seed):
+    rng = random.Random(seed)
+    source = original = _text(rng, 40)
+    edits = TextEdits()
+    for _ in range(rng.randrange(1, 8)):
+        start = rng.randrange(len(source) + 1)
+        end = min(len(source), start + rng.choice([0, 0, 1, 2, 5]))
+        edit = TextEdit(start, end, _text(rng, rng.choice([0, 1, 3])))
+        edits.add(edit)
+        source = edit.apply(source)
+    # Non-overlapping edits of the original source, in order
+    assert all(a.end < b.start for a, b in zip(edits.edits, edits.edits[1:]))
+    assert edits.apply(original) == source
+    assert apply_ranges(original, edits.ranges(original)) == source
+    inverse = edits.inverse(original)
+    assert inverse.apply(source) == original
+    assert apply_ranges(source, inverse.ranges(source)) == original
@@ -0,0 +1,87 @@
+import random
+
+import pytest
+
+from graph import BOT, USER, GraphIndex, build_graph
+from plot_parser import ParseError, PlotParser
+from plot_store import PlotStore
+
+from conftest import random_edit
+
+EDITS = 100
+# Indexes of a GraphIndex which only depend on the plot
+STATE = (
+    *("gnodes", "kids", "blocks", "deps", "dependents", "flow_of", "members"),
+    *("labels", "label_sources", "label_users"),
+)
+
+
+def _plot_to_graph(plot: dict) -> dict:
+    """What ``plotToGraph`` in ``editor/src/utils/plot.ts`` does"""
+    edge_ids = set()
+    edges = []
+
+    def add_edge(src: str, trg: str) -> None:
+        if (src, trg) not in edge_ids:
+            edge_ids.add((src, trg))
+            edges.append({"fromId": src, "toId": trg})
+
+    nodes = []
+    regular = {n for n, node in plot["nodes"].items() if node["type"] == "regular"}
+    for objid, node in plot["nodes"].items():
+        if node["type"] != "regular":
+            continue
+        flow = next(
+            (f["name"] for f in plot["flows"].values() if objid in f["nodes"]),
+            "noflow",
+        )
+        label = node.get("name") or "noname"
+        nodes.append(_gnode(objid, label, BOT, flow))
+        for trans_id in node.get("transitions", ()):
+            trans = plot["transitions"][trans_id]
+            if not trans["label"].startswith("id#nd") or trans["label"] not in regular:
+                continue
+            add_edge(objid, trans_id)
+            cond = "unknown"
+            if trans["condition"].startswith("id#ln"):
+                obj = plot["linking"][trans["condition"]]["object"]
+                if obj.startswith("id#df"):
+                    cond = plot["py_defs"][obj]["name"]
+            nodes.append(_gnode(trans_id, cond, USER, flow))
+            add_edge(trans_id, trans["label"])
+    return {"nodes": nodes, "edges": edges}
+
+
+def _gnode(objid: str, label: str, turn: int, flow: str) -> dict:
+    return {"id": objid, "label": label, "turn": turn, "flow": flow, "properties": []}
+
+
+@pytest.mark.parametrize("name", ["book_skill", "covid_skill", "funfact_skill"])
+def test_graph_is_the_editor_graph(scripts, name):
+    plot = PlotParser().parse(scripts[name]).plot
+    assert build_graph(plot) == _plot_to_graph(plot)
+
+
+@pytest.mark.parametrize("name", ["book_skill", "covid_skill", "funfact_skill"])
+def test_updated_graph_is_a_fresh_graph(scripts, name):
+    rng = random.Random(1)
+    parser = PlotParser()
+    source = scripts[name]
+    parsed = parser.parse(source, assemble=False)
+    store = PlotStore()
+    store.apply(parsed)
+    store.delta()
+    graph = GraphIndex(store.plot)
+    for step in range(EDITS):
+        edited = random_edit(rng, source)
+        try:
+            parsed = parser.parse(edited, parsed, assemble=False)
+        except ParseError:
+            continue
+        source = edited
+        store.apply(parsed)
+        graph.update(store.delta())
+        fresh = GraphIndex(store.plot)
+        assert graph.graph() == fresh.graph() == _plot_to_graph(store.plot)
+        for attr in STATE:
+            assert getattr(graph, attr) == getattr(fresh, attr), (step, attr)
@@ -0,0 +1,85 @@
+import pytest
+
+from editing import EditError, TextEdit, TextEdits
+from history import History
+
+
+def _edits(*edits) -> TextEdits:
+    result = TextEdits()
+    for edit in edits:
+        result.add(TextEdit(*edit))
+    return result
+
+
+def _record(history: History, source: str, state, *edits) -> str:
+    edits = _edits(*edits)
+    new_source = edits.apply(source)
+    history.record(source, edits, new_source, (None, state))
+    return new_source
+
+
+def test_undo_redo_round_trip():
+    history = History()
+    sources = ["hello world"]
+    sources.append(_record(history, sources[-1], 1, (0, 5, "bye")))
+    sources.append(_record(history, sources[-1], 2, (3, 3, ","), (4, 9, "planet")))
+    sources.append(_record(history, sources[-1], 3, (0, 0, "😀 ")))
+    source = sources[-1]
+    for i in (2, 1, 0):
+        source, edits, state = history.undo(source)
+        assert source == sources[i]
+        assert state == (i or None)
+    with pytest.raises(EditError, match="Nothing to undo"):
+        history.undo(source)
+    for i in (1, 2, 3):
+        previous = source
+        source, edits, state = history.redo(source)
+        assert source == sources[i] == edits.apply(previous)
+        assert state == i
+    with pytest.raises(EditError, match="Nothing to redo"):
+        history.redo(source)
+
+
+def test_new_step_drops_the_undone_ones():
+    history = History()
+    first = _record(history, "abc", 1, (0, 1, "x"))
+    second = _record(history, first, 2, (1, 2, "y"))
+    source, _, _ = history.undo(second)
+    other = _record(history, source, 3, (2, 3, "z"))
+    assert history.size == sum(step.size for step in history.done)
+    with pytest.raises(EditError, match="Nothing to redo"):
+        history.redo(other)
+    assert history.undo(other)[0] == "xbc"
+
+
+def test_budget_drops_the_oldest_steps():
+    history = History(budget=3000)
+    source = "a" * 100
+    states = []
+    for i in range(50):
+        states.append(i)
+        source = _record(history, source, i, (i, i + 1, "b"))
+        assert history.size <= history.budget
+        assert history.size == sum(step.size for step in history.done)
+    kept = len(history.done)
+    assert 0 < kept < 50
+    for _ in range(kept):
+        source, _, state = history.undo(source)
+    # The state before the oldest step kept, from the last step dropped
+    assert state == states[-kept - 1]
+    assert source == "b" * (50 - kept) + "a" * kept + "a" * 50
+    with pytest.raises(EditError, match="Nothing to undo"):
+        history.undo(source)
+
+
+def test_changed_source_clears_the_history():
+    history = History()
+    source = _record(history, "abc", 1, (0, 1, "x"))
+    with pytest.raises(EditError, match="can not be undone"):
+        history.undo(source + " ")
+    assert not history.done and history.size == 0
+    source = _record(history, "abc", 1, (0, 1, "x"))
+    source, _, _ = history.undo(source)
+    with pytest.raises(EditError, match="can not be redone"):
+        history.redo(source + " ")
+    assert not history.undone
@@ -0,0 +1,104 @@
+from typing import Dict
+
+import pytest
+
+from editing import Editor
+from graph import Graph, GraphIndex, build_graph
+from layout import F, K, MAX_ITER, NODE_HEIGHT, ROW_GAP, Layout, _children
+from plot_parser import PlotParser
+from plot_store import PlotStore
+
+# How far the vertical indices may be from the editor's, see ``layout``
+INDEX_BOUND = 0.5
+ROW = NODE_HEIGHT + ROW_GAP
+
+
+def _editor_indices(graph: Graph) -> Dict[str, float]:
+    """The vertical indices ``getLayout`` of the editor computes"""
+    children = _children(graph)
+    parents: Dict[str, list] = {gid: [] for gid in children}
+    for gid, kids in children.items():
+        for kid in kids:
+            parents[kid].append(gid)
+    flows: Dict[str, list] = {}
+    for node in graph["nodes"]:
+        flows.setdefault(node["flow"], []).append(node["id"])
+    flow_of = {node["id"]: node["flow"] for node in graph["nodes"]}
+    roots = [gid for gid in children if not parents[gid]]
+    index: Dict[str, float] = {}
+
+    def add(gid: str, i: int) -> None:
+        if gid not in index:
+            index[gid] = i
+            for j, kid in enumerate(children[gid]):
+                add(kid, j)
+
+    def update(gids: list, visited: set) -> None:
+        for gid in gids:
+            if gid in visited:
+                continue
+            visited.add(gid)
+            own = index[gid]
+            tension = K * sum(index[n] - own for n in children[gid] + parents[gid])
+            tension += F * sum(index[n] - own for n in flows[flow_of[gid]])
+            index[gid] = own + tension
+            update(children[gid], visited)
+
+    for i, root in enumerate(roots):
+        add(root, i)
+    for _ in range(MAX_ITER):
+        update(roots, set())
+    return index
+
+
+@pytest.mark.parametrize("name", ["book_skill", "covid_skill", "funfact_skill"])
+def test_indices_are_close_to_the_editor(scripts, name):
+    graph = build_graph(PlotParser().parse(scripts[name]).plot)
+    expected = _editor_indices(graph)
+    layout = Layout(graph)
+    assert set(layout.positions()) == set(expected)
+    for gid, index in expected.items():
+        assert abs(layout.index[layout.slot[gid]] - index) < INDEX_BOUND, gid
+
+
+def _post(parser, parsed, store, obj_type: str, props: dict):
+    edit, created = Editor(parser, parsed, store).post(obj_type, props)
+    parsed = parser.parse(edit.apply(parsed.source), parsed, assemble=False)
+    store.apply(parsed)
+    return parsed, created(store.plot)
+
+
+@pytest.mark.parametrize("node", [0, 5, 10, 20])
+@pytest.mark.parametrize("name", ["book_skill", "covid_skill"])
+def test_update_after_a_new_node(scripts, name, node):
+    parser = PlotParser()
+    parsed = parser.parse(scripts[name], assemble=False)
+    store = PlotStore()
+    store.apply(parsed)
+    store.delta()
+    graph = GraphIndex(store.plot)
+    layout = Layout(graph.graph())
+    graph.layout_changes()
+    before = layout.positions()
+    indices = {gid: layout.index[layout.slot[gid]] for gid in before}
+    # A new node, and a transition to it from an existing one
+    parsed, new = _post(parser, parsed, store, "node", {"name": "new"})
+    regular = [n for n, r in store.plot["nodes"].items() if r["type"] == "regular"]
+    props = {"node": regular[node], "label": new}
+    parsed, transition = _post(parser, parsed, store, "transition", props)
+    graph.update(store.delta())
+    layout.update(graph.layout_changes())
+    after = layout.positions()
+    assert set(after) == set(before) | {new, transition}
+
+    # The other nodes keep their index and column, and only move down to make room
+    for gid, position in before.items():
+        assert layout.index[layout.slot[gid]] == indices[gid]
+        assert after[gid]["x"] == position["x"]
+        assert 0 <= after[gid]["y"] - position["y"] <= 2 * ROW
+
+    # Siblings with close indices may be ordered differently than in a full layout
+    full = Layout(graph.graph()).positions()
+    assert all(after[gid]["x"] == full[gid]["x"] for gid in full)
+    distance = [abs(after[gid]["y"] - full[gid]["y"]) for gid in full]
+    assert sum(distance) / len(distance) <= 2 * ROW
@@ -0,0 +1,110 @@
+import random
+
+import pytest
+
+from persistent import PMap, _Collision, _Node
+
+
+class Key:
+    """A key with a given hash, to make collisions"""
+
+    def __init__(self, name: str, hash_: int):
+        self.name = name
+        self.hash = hash_
+
+    def __hash__(self) -> int:
+        return self.hash
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Key) and self.name == other.name
+
+    def __repr__(self) -> str:
+        return f"Key({self.name!r}, {self.hash:#x})"
+
+
+def _keys(rng: random.Random, count: int) -> list:
+    """Keys whose hashes share prefixes of every length, or are the same"""
+    keys = []
+    for i in range(count):
+        kind = rng.randrange(4)
+        if kind == 0:
+            keys.append(f"k{i}")
+        elif kind == 1:
+            # Same low bits, so they collide on the first levels
+            keys.append(Key(f"low{i}", rng.randrange(64) << 40 | 0x3FF))
+        elif kind == 2:
+            # Only 4 different hashes, they collide on every level
+            keys.append(Key(f"same{i}", rng.randrange(4)))
+        else:
+            keys.append(i)
+    return keys
+
+
+def _nodes(pmap: PMap) -> set:
+    nodes, stack = set(), [pmap._root]
+    while stack:
+        node = stack.pop()
+        nodes.add(id(node))
+        if isinstance(node, _Node):
+            stack.extend(e for e in node.entries if type(e) is not tuple)
+    return nodes
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_pmap_is_a_dict(seed):
+    rng = random.Random(seed)
+    keys = _keys(rng, 300)
+    expected = {key: rng.random() for key in keys[:100]}
+    pmap = PMap(expected)
+    versions = [(pmap, dict(expected))]
+    for _ in range(2000):
+        key = rng.choice(keys)
+        if rng.random() < 0.6:
+            value = rng.choice([rng.random(), expected.get(key)])
+            pmap = pmap.set(key, value)
+            expected[key] = value
+        else:
+            pmap = pmap.delete(key)
+            expected.pop(key, None)
+        assert len(pmap) == len(expected)
+        if rng.random() < 0.05:
+            versions.append((pmap, dict(expected)))
+    assert pmap.to_dict() == expected
+    assert dict(pmap.items()) == expected
+    assert all(pmap[key] == value for key, value in expected.items())
+    for key in keys:
+        assert (key in pmap) == (key in expected)
+    # The older versions are left as they were
+    for version, items in versions:
+        assert version.to_dict() == items
+
+
+def test_full_collisions():
+    # hash(-1) == hash(-2) in CPython
+    pmap = PMap().set(-1, "a").set(-2, "b").set(Key("x", -2), "c")
+    assert isinstance(pmap._root.entries[0], (_Node, _Collision))
+    assert (pmap[-1], pmap[-2], pmap[Key("x", -2)]) == ("a", "b", "c")
+    assert len(pmap) == 3
+    pmap = pmap.delete(-1).delete(Key("x", -2))
+    assert pmap.to_dict() == {-2: "b"}
+    # Collapsed back into a single pair
+    assert pmap._root.entries == ((-2, "b"),)
+    assert len(pmap.delete(-2)) == 0
+
+
+def test_unchanged_maps_are_the_same():
+    pmap = PMap({i: str(i) for i in range(100)})
+    assert pmap.set(5, pmap[5]) is pmap
+    assert pmap.delete(1000) is pmap
+    assert pmap.delete(Key("x", hash(5))) is pmap
+
+
+def test_changes_share_the_other_nodes():
+    pmap = PMap({f"k{i}": i for i in range(20000)})
+    before = _nodes(pmap)
+    changed = pmap.set("k7", -1).delete("k8").set("new", 1)
+    after = _nodes(changed)
+    # Only the paths to the three keys are copied
+    assert len(after - before) <= 3 * pmap.depth()
+    assert len(after & before) >= len(before) - 3 * pmap.depth()
+    assert pmap["k7"] == 7 and "k8" in pmap and "new" not in pmap
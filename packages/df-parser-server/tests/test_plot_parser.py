@@ -0,0 +1,123 @@
+import random
+
+import pytest
+
+from plot_parser import ParseError, PlotParser
+from plot_store import PlotStore
+
+from conftest import random_edit
+
+EDITS = 100
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("name", ["book_skill", "covid_skill", "funfact_skill"])
+def test_incremental_parse_is_a_full_parse(scripts, name, seed):
+    rng = random.Random(seed)
+    source = scripts[name]
+    parser = PlotParser()
+    # Only parses scripts in full, with a cache of its own
+    reference = PlotParser()
+    parsed = parser.parse(source)
+    store = PlotStore()
+    store.apply(parsed)
+    for step in range(EDITS):
+        edited = random_edit(rng, source)
+        try:
+            expected = reference.parse(edited).plot
+        except ParseError:
+            with pytest.raises(ParseError):
+                parser.parse(edited, parsed)
+            continue
+        result = parser.parse(edited, parsed)
+        assert result.plot == expected, f"edit {step} of {name} with seed {seed}"
+        store.apply(result)
+        assert store.plot == expected, f"edit {step} of {name} with seed {seed}"
+        source, parsed = edited, result
+
+
+def test_renamed_global_node_is_a_flow(scripts):
+    source = scripts["book_skill"]
+    parser = PlotParser()
+    parsed = parser.parse(source)
+    edited = source.replace("GLOBAL:", "GLOBA_:", 1)
+    assert parser.parse(edited, parsed).plot == PlotParser().parse(edited).plot
+
+
+def test_indented_statement_joins_the_previous_one(scripts):
+    source = scripts["funfact_skill"]
+    parser = PlotParser()
+    parsed = parser.parse(source)
+    line = source.index("\nactor = ") + 1
+    edited = source[:line] + " " + source[line:]
+    assert parser.parse(edited, parsed).plot == PlotParser().parse(edited).plot
+
+
+def test_imports_of_the_same_name_are_kept_apart():
+    parsed = PlotParser().parse("import re\nx = 1\nimport re\n")
+    store = PlotStore()
+    store.apply(parsed)
+    assert len(parsed.plot["imports"]) == len(store.plot["imports"]) == 2
+
+
+def test_imports_keep_their_ids(scripts):
+    source = scripts["book_skill"]
+    parser = PlotParser()
+    parsed = parser.parse(source)
+    plan = parser.plan("import os\n" + source, parsed)
+    # Only the first statement changed
+    assert len(plan.missing) == 1
+    edited = parser.parse(plan.source, parsed)
+    assert set(parsed.plot["imports"]) < set(edited.plot["imports"])
+
+
+def test_imports_of_a_name_are_numbered():
+    source = "import re\nx = 1\nimport re\nfrom y import re, z\n"
+    parser = PlotParser()
+    parsed = parser.parse(source)
+    store = PlotStore()
+    store.apply(parsed)
+    edited = parser.parse(source.replace("re\nx", "q\nx"), parsed)
+    store.apply(edited)
+    assert store.plot == edited.plot
+    imports = list(edited.plot["imports"].values())
+    assert [(i["name"], i["code"]) for i in imports] == [
+        ("q", "import q"),
+        ("re", "import re"),
+        ("re", "from y import re"),
+        ("z", "from y import z"),
+    ]
+    # The first import of a name keeps the id of the name
+    assert list(edited.plot["imports"])[1] == list(parsed.plot["imports"])[0]
+
+
+def test_node_edit_only_touches_its_chunk(scripts, monkeypatch):
+    source = scripts["book_skill"]
+    parser = PlotParser()
+    parsed = parser.parse(source)
+    store = PlotStore()
+    store.apply(parsed)
+    store.delta()
+    response = 'RESPONSE: "'
+    pos = source.index(response, source.index("TRANSITIONS")) + len(response)
+    edited = parser.parse(source[:pos] + "Hi! " + source[pos:], parsed)
+    old, new = edited.replaced
+    # Every other chunk is kept as it was
+    kept = [chunk for chunk in edited.chunks() if chunk is not new]
+    assert kept == [chunk for chunk in parsed.chunks() if chunk is not old]
+    added, removed = [], []
+    monkeypatch.setattr(store, "_add", added.append)
+    monkeypatch.setattr(store, "_remove", removed.append)
+    monkeypatch.setattr(store, "_structure", lambda parsed: pytest.fail("walked"))
+    store.apply(edited)
+    assert (added, removed) == ([new], [old])
+    monkeypatch.undo()
+    # Only the response of the node changed
+    store = PlotStore()
+    store.apply(parsed)
+    store.delta()
+    store.apply(edited)
+    delta = store.delta()
+    assert list(delta) == ["responses"]
+    assert len(delta["responses"]["changed"]) == 1
+    assert store.plot == PlotParser().parse(edited.source).plot
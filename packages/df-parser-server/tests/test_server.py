@@ -0,0 +1,132 @@
+import asyncio
+import copy
+import json
+import os
+
+import pytest
+
+import server
+from documents import Document
+from editing import EditError
+from plot_parser import PlotParser
+
+from conftest import apply_delta
+
+
+def _open(uri: str, source: str) -> Document:
+    """A document parsed from a source, as ``parse_src`` leaves it"""
+    doc = server.documents.get(uri)
+    doc.parsed = server.parser.parse(source, assemble=False)
+    doc.store.apply(doc.parsed)
+    doc.reply(False, None)
+    return doc
+
+
+def _first_regular(doc: Document) -> str:
+    plot = doc.store.plot
+    return next(n for n in plot["nodes"] if plot["nodes"][n]["type"] == "regular")
+
+
+def test_batch_resolves_references(scripts):
+    doc = _open("batch-references", scripts["funfact_skill"])
+    node = _first_regular(doc)
+    operations = [
+        {"name": "post_obj", "payload": {"type": "node", "props": {"name": "new"}}},
+        {"name": "put_obj", "payload": {"objid": "$0", "update": {"name": "newer"}}},
+        # A transition to the renamed node, from an existing one
+        {
+            "name": "post_obj",
+            "payload": {"type": "transition", "props": {"node": node, "label": "$1"}},
+        },
+    ]
+    reply = asyncio.run(server.batch({"uri": doc.uri, "operations": operations}))
+    plot = doc.store.plot
+    new, renamed, transition = reply["objids"]
+    assert new not in plot["nodes"]
+    assert plot["nodes"][renamed]["name"] == "newer"
+    assert transition in plot["nodes"][node]["transitions"]
+    assert plot["transitions"][transition]["label"] == renamed
+    assert plot == server.parser.parse(doc.parsed.source).plot
+
+
+@pytest.mark.parametrize(
+    "failing",
+    [
+        {"name": "put_obj", "payload": {"objid": "id#missing", "update": {}}},
+        {"name": "put_obj", "payload": {"objid": "$5", "update": {"name": "x"}}},
+        {"name": "undo", "payload": {}},
+    ],
+)
+def test_failed_batch_changes_nothing(scripts, failing):
+    doc = _open("batch-failure", scripts["funfact_skill"])
+    parsed, version = doc.parsed, doc.version
+    plot = copy.deepcopy(doc.store.plot)
+    operations = [
+        {"name": "post_obj", "payload": {"type": "node", "props": {"name": "new"}}},
+        {"name": "put_obj", "payload": {"objid": "$0", "update": {"name": "newer"}}},
+        failing,
+    ]
+    with pytest.raises(EditError):
+        asyncio.run(server.batch({"uri": doc.uri, "operations": operations}))
+    assert doc.parsed is parsed
+    assert doc.source == parsed.source
+    assert doc.version == version
+    assert doc.store.plot == plot
+    with pytest.raises(EditError):
+        doc.history.undo(doc.source)
+    # Nothing is sent as changed either
+    assert doc.reply(True, version) == {"version": version + 1, "delta": {}}
+
+
+def test_two_clients_of_a_socket(scripts, tmp_path):
+    source = scripts["funfact_skill"]
+    sources = [source]
+    for i in range(4):
+        sources.append(sources[-1].replace('RESPONSE: "', f'RESPONSE: "{i}', 1))
+
+    async def run():
+        path = str(tmp_path / "server.sock")
+        listener = asyncio.create_task(server.dispatcher.listen(path))
+        while not os.path.exists(path):
+            await asyncio.sleep(0.01)
+        clients = [await asyncio.open_unix_connection(path) for _ in range(2)]
+        plots = [None, None]
+        versions = [None, None]
+        kinds = []
+
+        async def parse(client: int, i: int) -> None:
+            reader, writer = clients[client]
+            payload = {
+                "uri": "shared",
+                "source": sources[i],
+                "delta": True,
+                "baseVersion": versions[client],
+                # Each client numbers the versions of its documents
+                "documentVersion": i,
+            }
+            msg = {"id": i, "name": "parse_src", "payload": payload}
+            writer.write(json.dumps(msg).encode() + b"\n")
+            reply = json.loads(await reader.readline())["payload"]
+            if "delta" in reply:
+                apply_delta(plots[client], reply["delta"])
+                kinds.append("delta")
+            else:
+                plots[client] = reply["plot"]
+                kinds.append("plot")
+            versions[client] = reply["version"]
+            assert plots[client] == PlotParser().parse(sources[i]).plot
+
+        await parse(0, 0)
+        await parse(0, 1)
+        await parse(1, 1)
+        # The last reply went to the other client
+        await parse(0, 2)
+        await parse(1, 3)
+        await parse(1, 4)
+        for _, writer in clients:
+            writer.close()
+        listener.cancel()
+        return kinds
+
+    kinds = asyncio.run(run())
+    assert kinds == ["plot", "delta", "plot", "plot", "plot", "delta"]
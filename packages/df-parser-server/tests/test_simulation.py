@@ -0,0 +1,49 @@
+from plot_parser import PlotParser
+from simulation import simulate
+
+
+def test_simulate_from_the_first_node(scripts):
+    plot = PlotParser().parse(scripts["book_skill"]).plot
+    first = next(
+        objid for objid, node in plot["nodes"].items() if node["type"] == "regular"
+    )
+    result = simulate(plot, 100, 10, seed=0)
+    assert result["turns"] == 1000
+    assert result["nodes"][first] >= 100
+    # The fallback node is the start node unless given
+    assert result == simulate(plot, 100, 10, seed=0, start=first, fallback=first)
+
+
+SCRIPT = """
+from df_engine.core.keywords import TRANSITIONS, RESPONSE, GLOBAL
+import df_engine.conditions as cnd
+import df_engine.labels as lbl
+
+plot = {
+    GLOBAL: {TRANSITIONS: {lbl.forward(): cnd.true()}},
+    "flow": {
+        "a": {RESPONSE: "", TRANSITIONS: {("flow", "b", 2): cnd.false()}},
+        "b": {RESPONSE: ""},
+    },
+}
+"""
+
+
+def test_simulate_nodes_outside_of_flows():
+    plot = PlotParser().parse(SCRIPT).plot
+    [flow] = plot["flows"].values()
+    a, b = flow["nodes"]
+    # A node no flow lists, eg. of a plot which isn't built by the parser
+    flow["nodes"] = [b]
+    result = simulate(plot, 10, 4, seed=0, start=a, fallback=b)
+    # lbl.forward() of the GLOBAL node leads to the fallback node from it
+    assert result["nodes"][a] == 10
+    assert result["nodes"][b] == 40
+
+
+def test_simulate_priorities_which_are_not_numbers():
+    plot = PlotParser().parse(SCRIPT).plot
+    for trans in plot["transitions"].values():
+        if "priority" in trans:
+            trans["priority"] = "HIGH"
+    assert simulate(plot, 10, 4, seed=0)["turns"] == 40
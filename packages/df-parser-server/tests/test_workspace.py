@@ -0,0 +1,118 @@
+import asyncio
+import os
+
+from plot_parser import PlotParser
+from workspace import Workspace
+
+SCRIPT = """
+import df_engine.conditions as cnd
+import utils
+from scenario import condition as loc_cnd
+from df_engine.core.keywords import TRANSITIONS
+
+plot = {
+    "flow": {
+        "start": {TRANSITIONS: {"a": utils.about_book(), "b": loc_cnd.check}},
+        "a": {TRANSITIONS: {"start": cnd.true()}},
+        "b": {TRANSITIONS: {"start": cnd.true()}},
+    },
+}
+"""
+
+CHECKS = """
+def about_book(ctx, actor):
+    return True
+"""
+
+FILES = {
+    "utils/__init__.py": "from .checks import about_book\n",
+    "utils/checks.py": CHECKS,
+    "skill/main.py": SCRIPT,
+    "skill/scenario/__init__.py": "",
+    "skill/scenario/condition.py": "import re\n\n\n@cache\ndef check(ctx, actor):\n"
+    "    return re.match('book', ctx.last_request)\n",
+}
+
+
+async def _run(fn, *args):
+    return fn(*args)
+
+
+def _write(root, files):
+    for name, source in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(source)
+
+
+def _refresh(workspace: Workspace) -> dict:
+    return asyncio.run(workspace.refresh(_run))
+
+
+def _lines(workspace: Workspace, script: str) -> dict:
+    return {
+        name: (os.path.basename(d["file"]), d["range"]["start"]["line"])
+        for name, d in workspace.resolved[script].items()
+    }
+
+
+def test_py_defs_are_resolved_through_imports_and_reexports(tmp_path):
+    _write(tmp_path, FILES)
+    workspace = Workspace(str(tmp_path))
+    stats = _refresh(workspace)
+    assert (stats["files"], stats["scripts"], stats["indexed"]) == (5, 1, 5)
+    script = str(tmp_path / "skill" / "main.py")
+    # Names from outside of the workspace (cnd.true) are left out
+    assert _lines(workspace, script) == {
+        "utils.about_book": ("checks.py", 1),
+        # Decorators are part of the definition
+        "loc_cnd.check": ("condition.py", 3),
+    }
+    check = workspace.resolved[script]["loc_cnd.check"]
+    assert check["code"].startswith("@cache\ndef check(ctx, actor):")
+    # An open document is resolved with its own imports
+    edited = SCRIPT.replace("import utils", "from utils import checks as utils")
+    plot = PlotParser().parse(edited).plot
+    definitions = workspace.definitions(script, plot)
+    names = {plot["py_defs"][objid]["name"]: d for objid, d in definitions.items()}
+    assert sorted(names) == ["loc_cnd.check", "utils.about_book"]
+    assert names["utils.about_book"]["file"] == str(tmp_path / "utils" / "checks.py")
+
+
+def test_refresh_indexes_the_changed_files_again(tmp_path):
+    _write(tmp_path, FILES)
+    workspace = Workspace(str(tmp_path))
+    _refresh(workspace)
+    script = str(tmp_path / "skill" / "main.py")
+    checks = tmp_path / "utils" / "checks.py"
+
+    # Touched but not changed: hashed, not parsed nor resolved again
+    stat = os.stat(checks)
+    os.utime(checks, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    stats = _refresh(workspace)
+    assert (stats["indexed"], stats["unchanged"], stats["resolved"]) == (0, 5, 0)
+
+    # Moved down: only the scripts depending on the file are resolved again
+    _write(tmp_path, {"utils/checks.py": "\n\n" + CHECKS, "other.py": "x = 1\n"})
+    stats = _refresh(workspace)
+    assert (stats["indexed"], stats["resolved"]) == (2, 1)
+    assert _lines(workspace, script)["utils.about_book"] == ("checks.py", 3)
+    assert _lines(workspace, script)["loc_cnd.check"] == ("condition.py", 3)
+
+    # Removed, then added again
+    checks.unlink()
+    stats = _refresh(workspace)
+    assert stats["resolved"] == 1
+    assert "utils.about_book" not in workspace.resolved[script]
+    _write(tmp_path, {"utils/checks.py": CHECKS})
+    _refresh(workspace)
+    assert _lines(workspace, script)["utils.about_book"] == ("checks.py", 1)
+
+    # Changed after the last refresh, while looking up an open document
+    _write(tmp_path, {"utils/checks.py": "\n" + CHECKS})
+    plot = PlotParser().parse(SCRIPT).plot
+    definitions = workspace.definitions(script, plot)
+    lines = {d["range"]["start"]["line"] for d in definitions.values()}
+    assert lines == {2, 3}
+    assert _refresh(workspace)["resolved"] == 1
+    assert _lines(workspace, script)["utils.about_book"] == ("checks.py", 2)
@@ -0,0 +1,76 @@
+import os
+
+import yaml
+
+from conftest import SCRIPTS, apply_ranges
+from server import _resolve
+from yaml_plots import YamlPlot, dump_table
+
+
+def _fixture() -> str:
+    with open(os.path.join(SCRIPTS, "funfact_skill_parsed.yaml")) as f:
+        source = f.read()
+    # Comments around and between the objects, which the dump can't give back
+    source = "# Plot of funfact_skill.py\n" + source
+    source = source.replace("\nnodes:\n", "\n# The nodes\nnodes:\n  # First node\n")
+    return source.replace("\nresponses:\n", "\nresponses:  # kept\n")
+
+
+def _block(source: str, objid: str) -> str:
+    """The lines of an object in a table"""
+    start = source.index(f"\n  {objid}:\n") + 1
+    end = source.index("\n", start) + 1
+    while source[end:].startswith("   ") or source[end:].startswith("  -"):
+        end = source.index("\n", end) + 1
+    return source[start:end]
+
+
+def _object_lines(table: str, objid: str, record: dict) -> str:
+    return dump_table({table: {objid: record}}, table).partition("\n")[2]
+
+
+def test_edits_keep_the_rest_of_the_source():
+    source = _fixture()
+    doc = YamlPlot()
+    plot = doc.load(source)
+    assert plot == yaml.safe_load(source)
+    node, record = next(iter(plot["nodes"].items()))
+    response = next(iter(plot["responses"]))
+    operations = [
+        {"name": "put_obj", "payload": {"objid": node, "update": {"name": "renamed"}}},
+        {
+            "name": "post_obj",
+            "payload": {
+                "type": "response",
+                "objid": "id#rs_00000000",
+                "props": {"response_object": "Hi # not a comment"},
+            },
+        },
+        {
+            "name": "put_obj",
+            "payload": {"objid": response, "update": {"response_object": "$1"}},
+        },
+    ]
+    ranges, objids = doc.edit(operations, _resolve)
+    edited = apply_ranges(source, ranges)
+    assert edited == doc.source
+    assert yaml.safe_load(edited) == doc.plot
+    assert doc.plot["nodes"][node] == {**record, "name": "renamed"}
+    assert doc.plot["responses"][response] == {"response_object": "id#rs_00000000"}
+
+    # Only the lines of the changed objects are replaced, and the new one inserted
+    expected = source
+    for table, objid in (("nodes", node), ("responses", response)):
+        old = _block(expected, objid)
+        new = _object_lines(table, objid, doc.plot[table][objid])
+        expected = expected.replace(old, new, 1)
+    first = _block(expected, response)
+    new = _object_lines("responses", "id#rs_00000000", doc.plot["responses"][objids[1]])
+    expected = expected.replace(first, new + first, 1)
+    assert edited == expected
+    assert all(c in edited for c in ("# Plot of", "# The nodes", "# First", "# kept"))
+
+    # And given back by undo
+    assert apply_ranges(edited, doc.undo()) == doc.source == source
+    assert doc.plot == plot
+    assert apply_ranges(source, doc.redo()) == doc.source == edited
@@ -0,0 +1,447 @@
+"""
+Index of the python modules of a workspace, to find where the functions used by the
+plots (their ``py_defs``, eg. ``loc_cnd.check_unused``) are defined.
+
+Every python file of the workspace is indexed: its top-level definitions (functions,
+classes and assignments, with their range and code) and the names its imports bind.
+Scripts (files with a plot) are also parsed, and their ``py_defs`` resolved: the
+import binding the start of the name is found, its module is looked up relative to
+the directories of the script (as when a skill is run from its own directory) or as a
+relative import, and the rest of the name is looked up in the module, following
+re-exports (``from .utils import check``) to the actual definition. Names from
+modules outside of the workspace (eg. ``df_engine``) are not resolved.
+
+Files are indexed in batches by the worker processes, with a bounded number of
+batches in flight. The index is kept up to date by comparing the modification time
+and size of the files, then the hash of their content, so that touching a file does
+not index it again. The modules every script depends on are recorded, so that only
+the scripts depending on a changed module are resolved again.
+"""
+
+import ast
+import asyncio
+import hashlib
+import os
+import time
+from dataclasses import dataclass, field, replace
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from plot_parser import ParseError, Plot, PlotParser
+
+# Files indexed by a single task of the workers
+BATCH_FILES = 32
+# Directories which never hold modules of the workspace
+SKIP_DIRS = {"node_modules", "__pycache__", "site-packages", "venv", "env"}
+# Re-exports followed from a name to its definition
+MAX_DEPTH = 8
+
+Definition = Dict[str, Any]
+# Bound name -> (module, attribute), the attribute is empty for ``import module``
+Imports = Dict[str, Tuple[str, str]]
+
+
+@dataclass
+class ModuleIndex:
+    """Definitions and imports of a python file"""
+
+    path: str
+    # Modification time (ns) and size, the file is not read again while they match
+    stat: Tuple[int, int]
+    digest: bytes
+    # Top-level definitions by name: their range (as in vscode) and code
+    defs: Dict[str, Definition] = field(default_factory=dict)
+    imports: Imports = field(default_factory=dict)
+    # Names of the ``py_defs`` of the plot, for scripts
+    py_defs: Optional[List[str]] = None
+    error: Optional[str] = None
+    # False if the content was the same as the given digest, only the stat is set then
+    parsed: bool = True
+
+
+def _stat(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _character(line: str, col: int) -> int:
+    """Character (in UTF-16 code units) of a column of ``ast`` (in UTF-8 bytes)"""
+    if line.isascii():
+        return col
+    prefix = line.encode()[:col].decode(errors="ignore")
+    return len(prefix.encode("utf-16-le")) // 2
+
+
+def _imports(node: ast.stmt) -> Imports:
+    imports: Imports = {}
+    if isinstance(node, ast.Import):
+        for alias in node.names:
+            # Without an alias, ``import a.b`` binds ``a``, but plots use ``a.b.f``
+            imports[alias.asname or alias.name] = (alias.name, "")
+    elif isinstance(node, ast.ImportFrom):
+        module = "." * node.level + (node.module or "")
+        for alias in node.names:
+            if alias.name != "*":
+                imports[alias.asname or alias.name] = (module, alias.name)
+    return imports
+
+
+def index_source(path: str, source: str) -> ModuleIndex:
+    """Index the top-level definitions and imports of a module"""
+    data = source.encode()
+    index = ModuleIndex(path, (0, len(data)), hashlib.blake2b(data).digest())
+    try:
+        module = ast.parse(source, path)
+    except (SyntaxError, ValueError) as e:
+        index.error = f"{type(e).__name__}: {e}"
+        return index
+    # Lines as numbered by ``ast``
+    lines = source.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    for node in module.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            index.imports.update(_imports(node))
+            continue
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names = [node.name]
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            names = [t.id for t in targets if isinstance(t, ast.Name)]
+        else:
+            continue
+        # Decorators are part of the definition
+        first = min([node, *getattr(node, "decorator_list", ())], key=_start)
+        definition = {
+            "range": {
+                "start": {
+                    "line": first.lineno - 1,
+                    # Decorators start after their ``@``
+                    "character": _character(lines[first.lineno - 1], node.col_offset),
+                },
+                "end": {
+                    "line": node.end_lineno - 1,
+                    "character": _character(
+                        lines[node.end_lineno - 1], node.end_col_offset
+                    ),
+                },
+            },
+            "code": "\n".join(lines[first.lineno - 1 : node.end_lineno]),
+        }
+        for name in names:
+            # Like python, the last definition wins
+            index.defs[name] = definition
+    return index
+
+
+def _join(module: str, *names: str) -> str:
+    """Name of a submodule, keeping the dots of a relative module"""
+    name = module.lstrip(".")
+    return module[: len(module) - len(name)] + ".".join(filter(None, (name, *names)))
+
+
+def _start(node: ast.AST) -> Tuple[int, int]:
+    return node.lineno, node.col_offset
+
+
+# Fragments of other files are of no use, so the cache is kept small
+_parser = PlotParser(cache_size=64, grow=False)
+
+
+def index_file(path: str, digest: Optional[bytes] = None) -> Optional[ModuleIndex]:
+    """
+    Index a file, ``None`` if it can not be read. If its content hashes to ``digest``,
+    it is not parsed again.
+    """
+    stat = _stat(path)
+    if stat is None:
+        return None
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    if digest is not None and hashlib.blake2b(data).digest() == digest:
+        return ModuleIndex(path, stat, digest, parsed=False)
+    source = data.decode(errors="replace")
+    index = index_source(path, source)
+    index.stat = stat
+    if b"TRANSITIONS" in data:
+        try:
+            plot = _parser.parse(source).plot
+        except ParseError as e:
+            index.error = str(e)
+        else:
+            if plot["nodes"]:
+                index.py_defs = [obj["name"] for obj in plot["py_defs"].values()]
+    return index
+
+
+def index_files(
+    files: List[Tuple[str, Optional[bytes]]],
+) -> List[Optional[ModuleIndex]]:
+    """Index a batch of (path, known digest), in a worker process"""
+    return [index_file(path, digest) for path, digest in files]
+
+
+# Import statements of the plots are parsed once
+_import_codes: Dict[str, Imports] = {}
+
+
+def plot_imports(plot: Plot) -> Imports:
+    """Names bound by the imports of a plot"""
+    imports: Imports = {}
+    for obj in plot["imports"].values():
+        code = obj["code"]
+        parsed = _import_codes.get(code)
+        if parsed is None:
+            try:
+                parsed = _imports(ast.parse(code).body[0])
+            except (SyntaxError, IndexError):
+                parsed = {}
+            _import_codes[code] = parsed
+        imports.update(parsed)
+    return imports
+
+
+Run = Callable[..., Awaitable[Any]]
+
+
+class Workspace:
+    """Index of the python files under a directory"""
+
+    def __init__(self, root: str, workers: int = 1):
+        self.root = os.path.abspath(root)
+        # Batches sent to the workers at once
+        self.limit = 2 * workers
+        self.files: Dict[str, ModuleIndex] = {}
+        # Resolved py_defs of each script, and the files they were resolved from
+        self.resolved: Dict[str, Dict[str, Definition]] = {}
+        self.depends: Dict[str, Set[str]] = {}
+        self.dependents: Dict[str, Set[str]] = {}
+        # (directory, module) -> file of the module, see ``_module_file``
+        self._modules: Dict[Tuple[str, str], Optional[str]] = {}
+        # Scripts depending on files indexed again outside of ``refresh``
+        self._stale: Set[str] = set()
+        self._lock = asyncio.Lock()
+
+    def contains(self, path: str) -> bool:
+        return path.startswith(self.root + os.sep)
+
+    async def refresh(self, run: Run) -> dict:
+        """
+        Index the files which changed since the last time, using ``run`` to run a
+        function in the workers, and resolve the py_defs of the scripts affected
+        """
+        async with self._lock:
+            started = time.perf_counter()
+            paths = self._scan()
+            stale = [
+                (path, entry.digest if entry is not None else None)
+                for path, entry in ((p, self.files.get(p)) for p in paths)
+                if entry is None or entry.stat != paths[path]
+            ]
+            created = [path for path in paths if path not in self.files]
+            removed = [path for path in self.files if path not in paths]
+            semaphore = asyncio.Semaphore(self.limit)
+
+            async def index(batch):
+                async with semaphore:
+                    return await run(index_files, batch)
+
+            batches = [
+                stale[i : i + BATCH_FILES] for i in range(0, len(stale), BATCH_FILES)
+            ]
+            results = await asyncio.gather(*(index(batch) for batch in batches))
+            changed = set(removed)
+            for path in removed:
+                del self.files[path]
+            for entry in (entry for result in results for entry in result):
+                if entry is None:
+                    continue
+                if not entry.parsed:
+                    self.files[entry.path] = replace(
+                        self.files[entry.path], stat=entry.stat
+                    )
+                    continue
+                self.files[entry.path] = entry
+                changed.add(entry.path)
+            self._forget(removed)
+            if created or removed:
+                self._modules.clear()
+            # Scripts which changed, depend on a changed file, or may now resolve
+            # names to an added one
+            scripts = {path for path in changed if self._script(path)}
+            for path in changed:
+                scripts.update(self.dependents.get(path, ()))
+            scripts.update(self._stale)
+            self._stale.clear()
+            if created:
+                scripts.update(
+                    path
+                    for path, resolved in self.resolved.items()
+                    if len(resolved) < len(self.files[path].py_defs or ())
+                )
+            for path in scripts:
+                if self._script(path):
+                    self._resolve_script(path)
+                else:
+                    self._forget([path])
+            return {
+                "files": len(self.files),
+                "scripts": len(self.resolved),
+                "indexed": sum(entry.parsed for r in results for entry in r if entry),
+                "unchanged": len(paths) - len(changed - set(removed)),
+                "resolved": len(scripts),
+                "definitions": sum(len(r) for r in self.resolved.values()),
+                "errors": {
+                    path: entry.error
+                    for path, entry in self.files.items()
+                    if entry.error is not None
+                },
+                "time": round((time.perf_counter() - started) * 1000, 3),
+            }
+
+    def definitions(self, path: str, plot: Plot) -> Dict[str, Definition]:
+        """
+        Definitions of the py_defs of the plot of an open document, by py_def id. The
+        document may differ from the file, so its imports are taken from the plot.
+        """
+        imports = plot_imports(plot)
+        resolved = {}
+        for objid, obj in plot["py_defs"].items():
+            if "code" in obj:
+                # Defined in the script itself
+                continue
+            definition = self._lookup_imported(path, imports, obj["name"], 0, set())
+            if definition is not None:
+                resolved[objid] = definition
+        return resolved
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        """Python files of the workspace, with their stat"""
+        paths = {}
+        for directory, dirs, files in os.walk(self.root):
+            dirs[:] = [d for d in dirs if d not in SKIP_DIRS and not d.startswith(".")]
+            for name in files:
+                if name.endswith(".py"):
+                    path = os.path.join(directory, name)
+                    stat = _stat(path)
+                    if stat is not None:
+                        paths[path] = stat
+        return paths
+
+    def _script(self, path: str) -> bool:
+        entry = self.files.get(path)
+        return entry is not None and entry.py_defs is not None
+
+    def _forget(self, paths: List[str]) -> None:
+        for path in paths:
+            self.resolved.pop(path, None)
+            for dependency in self.depends.pop(path, ()):
+                dependents = self.dependents[dependency]
+                dependents.discard(path)
+                if not dependents:
+                    del self.dependents[dependency]
+
+    def _resolve_script(self, path: str) -> None:
+        self._forget([path])
+        entry = self.files[path]
+        depends = {path}
+        resolved = {}
+        for name in entry.py_defs:
+            definition = self._lookup_imported(path, entry.imports, name, 0, depends)
+            if definition is not None:
+                resolved[name] = definition
+        self.resolved[path] = resolved
+        self.depends[path] = depends
+        for dependency in depends:
+            self.dependents.setdefault(dependency, set()).add(path)
+
+    def _entry(self, path: str) -> Optional[ModuleIndex]:
+        """Index of a file, indexed again here if it changed since"""
+        entry = self.files.get(path)
+        if entry is not None and _stat(path) != entry.stat:
+            fresh = index_file(path, entry.digest)
+            if fresh is None:
+                return None
+            entry = replace(entry, stat=fresh.stat) if not fresh.parsed else fresh
+            self.files[path] = entry
+            # Resolved again by the next refresh
+            self._stale.update(self.dependents.get(path, ()))
+        return entry
+
+    def _module_file(self, path: str, module: str) -> Optional[str]:
+        """File of a module imported by a file, if in the workspace"""
+        directory = os.path.dirname(path)
+        key = (directory, module)
+        if key in self._modules:
+            return self._modules[key]
+        name = module.lstrip(".")
+        level = len(module) - len(name)
+        parts = name.split(".") if name else []
+        if level:
+            base = directory
+            for _ in range(level - 1):
+                base = os.path.dirname(base)
+            bases = [base]
+        else:
+            # Skills are run from their own directory, and import the modules of the
+            # repository from its root
+            bases = []
+            base = directory
+            while self.contains(base) or base == self.root:
+                bases.append(base)
+                base = os.path.dirname(base)
+        found = None
+        for base in bases:
+            candidate = os.path.join(base, *parts)
+            for file in (candidate + ".py", os.path.join(candidate, "__init__.py")):
+                if file in self.files:
+                    found = file
+                    break
+            if found is not None:
+                break
+        self._modules[key] = found
+        return found
+
+    def _lookup(
+        self, path: str, name: str, depth: int, depends: Set[str]
+    ) -> Optional[Definition]:
+        """Definition of a dotted name in a module"""
+        entry = self._entry(path)
+        if entry is None or depth > MAX_DEPTH:
+            return None
+        depends.add(path)
+        definition = entry.defs.get(name)
+        if definition is not None:
+            return {"file": path, **definition}
+        return self._lookup_imported(path, entry.imports, name, depth, depends)
+
+    def _lookup_imported(
+        self, path: str, imports: Imports, name: str, depth: int, depends: Set[str]
+    ) -> Optional[Definition]:
+        """Definition of a dotted name through the imports of a module"""
+        parts = name.split(".")
+        # The longest bound name which starts the name, eg. ``a.b`` for ``a.b.f``
+        for i in range(len(parts), 0, -1):
+            target = imports.get(".".join(parts[:i]))
+            if target is not None:
+                break
+        else:
+            return None
+        module, attribute = target
+        rest = parts[i:]
+        if attribute:
+            # Either a submodule or a name defined in the module
+            submodule = self._module_file(path, _join(module, attribute))
+            if submodule is not None and rest:
+                return self._lookup(submodule, ".".join(rest), depth + 1, depends)
+            rest = [attribute, *rest]
+        # Longest submodule first, eg. ``a.b`` with ``f`` left for ``import a`` and
+        # ``a.b.f``
+        for i in range(len(rest) - 1, -1, -1):
+            file = self._module_file(path, _join(module, *rest[:i]))
+            if file is not None:
+                return self._lookup(file, ".".join(rest[i:]), depth + 1, depends)
+        return None
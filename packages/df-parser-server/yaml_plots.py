@@ -0,0 +1,261 @@
+"""
+Plots stored as YAML, the ``*_parsed.yaml`` fixtures of the test mode of the extension.
+
+The plot of each document is kept along with the hash of its source, so it is only
+loaded again when the document changed otherwise than by the edits sent for it. Edits
+only dump the top-level tables they changed, and replace the part of those tables
+which changed in the document. Loading and dumping use libyaml if PyYAML was built
+with it.
+
+The tables are persistent maps (see ``persistent``), so the plots kept by the undo
+history of a document share all the objects which did not change.
+"""
+
+import re
+import secrets
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+
+import yaml
+
+from editing import EditError, TextEdit, TextEdits
+from history import History, size_of
+from persistent import NODE_BYTES, PMap
+from plot_parser import (
+    TABLES,
+    TYPE_PREFIXES,
+    ParseError,
+    Plot,
+    common_prefix,
+    common_suffix,
+    content_hash,
+)
+
+_Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+_Dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+# Top-level keys (after a newline, which is much faster to look for than line starts)
+# and the keys of the objects of a table
+_TOP_KEY = re.compile(r"\n([A-Za-z_]\w*):(?=\s)")
+_OBJECT_KEY = re.compile(r"^  (\S[^\n]*?):(?=\s)", re.MULTILINE)
+_PREFIX_TABLES = {prefix: table for table, prefix in TYPE_PREFIXES.items()}
+
+# Replaces ``"$<i>"`` by the id of the object of the i-th operation of a batch
+Resolve = Callable[[dict, List[str]], dict]
+Tables = Dict[str, PMap]
+
+
+def dump_table(plot: Mapping[str, Mapping], table: str) -> str:
+    # Sorted like the dumps of the parser, the order of a persistent map is arbitrary
+    return yaml.dump(
+        {table: dict(plot[table].items())},
+        Dumper=_Dumper,
+        default_flow_style=False,
+        allow_unicode=True,
+    )
+
+
+def _dump_object(tables: Tables, table: str, objid: str) -> Optional[str]:
+    """The lines of an object in the dump of its table, if its key is plain"""
+    text = dump_table({table: {objid: tables[table][objid]}}, table)
+    lines = text.partition("\n")[2]
+    return lines if lines.startswith(f"  {objid}:") else None
+
+
+def _table_of(tables: Tables, objid: str) -> str:
+    table = _PREFIX_TABLES.get(objid[3 : objid.find("_")])
+    if table is None or objid not in tables[table]:
+        raise EditError(f"Unknown object {objid}")
+    return table
+
+
+class YamlPlot:
+    """Plot of a YAML document, and where each of its tables is in the source"""
+
+    def __init__(self):
+        self.source = ""
+        self.digest = b""
+        self.tables: Tables = {}
+        # The tables as a plot, built again when asked for after a change
+        self._plot: Optional[Plot] = None
+        # Table -> (start, end) offsets of its lines in the source
+        self.spans: Dict[str, Tuple[int, int]] = {}
+        self.history = History()
+
+    @property
+    def plot(self) -> Plot:
+        if self._plot is None:
+            self._plot = {
+                table: objects.to_dict() for table, objects in self.tables.items()
+            }
+        return self._plot
+
+    def load(self, source: str) -> Plot:
+        """The plot of a source, only loaded if it is not the last one"""
+        digest = content_hash(source)
+        if digest == self.digest:
+            return self.plot
+        try:
+            plot = yaml.load(source, Loader=_Loader)
+        except yaml.YAMLError as e:
+            raise ParseError(f"Invalid YAML: {e}") from e
+        if not isinstance(plot, dict):
+            raise ParseError("The YAML document is not a plot")
+        for table in TABLES:
+            plot.setdefault(table, {})
+        for table, objects in plot.items():
+            if not isinstance(objects, dict):
+                raise ParseError(f"{table} is not a table of objects")
+        self.tables = {table: PMap(objects) for table, objects in plot.items()}
+        self._plot = plot
+        self._set_source(source, digest)
+        return plot
+
+    def edit(self, operations: List[dict], resolve: Resolve) -> Tuple[List[dict], list]:
+        """
+        Apply ``put_obj`` and ``post_obj`` operations, either all of them or none.
+        Return the text edits to apply to the document, and the id of the object of
+        each operation.
+        """
+        # The plot stays as it was if an operation fails
+        tables = dict(self.tables)
+        # Objects changed, by table
+        changed: Dict[str, Dict[str, None]] = {}
+        objids: List[str] = []
+        # Estimated memory used by the changed objects and the nodes of the tables
+        # copied, which are only shared with the history
+        size = 0
+        for op in operations:
+            payload = resolve(op["payload"], objids)
+            if op["name"] == "put_obj":
+                objid = payload["objid"]
+                table = _table_of(tables, objid)
+                obj = {**tables[table][objid], **payload["update"]}
+            elif op["name"] == "post_obj":
+                kind = payload["type"]
+                table = kind if kind == "linking" else kind + "s"
+                if table not in TYPE_PREFIXES:
+                    raise EditError(f"Unknown object type {kind}")
+                objid = payload.get("objid") or (
+                    f"id#{TYPE_PREFIXES[table]}_{secrets.token_hex(4)}"
+                )
+                if objid in tables[table]:
+                    raise EditError(f"{objid} already exists")
+                obj = payload["props"]
+            else:
+                raise EditError(f"Unknown operation {op['name']}")
+            tables[table] = tables[table].set(objid, obj)
+            size += NODE_BYTES * tables[table].depth() + size_of(obj)
+            changed.setdefault(table, {})[objid] = None
+            objids.append(objid)
+        edits = self._dump(tables, changed)
+        source = edits.apply(self.source)
+        digest = content_hash(source)
+        self.history.record(
+            self.source,
+            edits,
+            source,
+            (self.tables, tables),
+            size,
+            (self.digest, digest),
+        )
+        ranges = edits.ranges(self.source)
+        self._set_state(source, tables, digest)
+        return ranges, objids
+
+    def undo(self) -> List[dict]:
+        """Undo the last edit, return the text edits to apply to the document"""
+        return self._travel(*self.history.undo(self.source))
+
+    def redo(self) -> List[dict]:
+        """Redo the last edit undone, return the text edits to apply to the document"""
+        return self._travel(*self.history.redo(self.source))
+
+    def _travel(self, source: str, edits: TextEdits, tables: Tables) -> List[dict]:
+        ranges = edits.ranges(self.source)
+        self._set_state(source, tables, content_hash(source))
+        return ranges
+
+    def _dump(self, tables: Tables, changed: Dict[str, Dict[str, None]]) -> TextEdits:
+        """
+        Edits of the source giving the dump of the changed tables. The changed objects
+        are dumped alone, in place of their old dump or where they go in the (sorted)
+        table, unless the table was empty.
+        """
+        splices: List[TextEdit] = []
+        for table, objids in changed.items():
+            span = self.spans.get(table)
+            blocks: List[Optional[str]] = [None]
+            if span is not None and len(self.tables[table]):
+                blocks = [_dump_object(tables, table, objid) for objid in objids]
+            if span is None or None in blocks:
+                splices.append(self._splice(span, dump_table(tables, table)))
+                continue
+            # New objects going between the same two objects, by offset
+            inserts: Dict[int, List[Tuple[str, str]]] = {}
+            for objid, text in zip(objids, blocks):
+                start, end = self._find(span, objid)
+                if start == end:
+                    inserts.setdefault(start, []).append((objid, text))
+                else:
+                    splices.append(self._splice((start, end), text))
+            for offset, texts in inserts.items():
+                text = "".join(text for _, text in sorted(texts))
+                splices.append(TextEdit(offset, offset, text))
+        edits = TextEdits()
+        # From the end of the source, so that the offsets of the others stay the same
+        for splice in sorted(splices, reverse=True):
+            edits.add(splice)
+        return edits
+
+    def _splice(self, span: Optional[Tuple[int, int]], text: str) -> TextEdit:
+        """Replacement of a part of the source, trimmed to what changed"""
+        source = self.source
+        start, end = span or (len(source), len(source))
+        if start == len(source) and source and not source.endswith("\n"):
+            text = "\n" + text
+        old = source[start:end]
+        prefix = common_prefix(old, text)
+        suffix = common_suffix(old, text, min(len(old), len(text)) - prefix)
+        return TextEdit(start + prefix, end - suffix, text[prefix : len(text) - suffix])
+
+    def _find(self, span: Tuple[int, int], objid: str) -> Tuple[int, int]:
+        """
+        Where the dump of an object is in a table, or an empty range where it goes if
+        it is not there, found by bisecting the lines of the keys of the table
+        """
+        source = self.source
+        lo = source.find("\n", span[0], span[1]) + 1 or span[1]
+        hi = found = span[1]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            # The line of a key starting before ``hi`` may end after it
+            match = _OBJECT_KEY.search(source, mid, span[1])
+            if match is not None and match.start() >= hi:
+                match = None
+            if match is not None and match.group(1) < objid:
+                lo = match.end()
+            else:
+                if match is not None:
+                    found = match.start()
+                hi = mid
+        if source.startswith(f"  {objid}:", found):
+            following = _OBJECT_KEY.search(source, found + 1, span[1])
+            return found, following.start() if following is not None else span[1]
+        return found, found
+
+    def _set_state(self, source: str, tables: Tables, digest: bytes) -> None:
+        self.tables = tables
+        self._plot = None
+        self._set_source(source, digest)
+
+    def _set_source(self, source: str, digest: bytes) -> None:
+        self.source = source
+        self.digest = digest
+        # The newline before each key is at the offset of the key in the source
+        keys = list(_TOP_KEY.finditer("\n" + source))
+        self.spans = {
+            match.group(1): (
+                match.start(),
+                keys[i + 1].start() if i + 1 < len(keys) else len(source),
+            )
+            for i, match in enumerate(keys)
+        }
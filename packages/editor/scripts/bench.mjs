@@ -0,0 +1,74 @@
+// Times plotToGraph and getLayout on the given plots (JSON files), for the benchmark
+// of the server (df-parser-server/benchmark.py). Prints a JSON list of results.
+//
+//   node --expose-gc scripts/bench.mjs [--repeat N] plot.json...
+import { build } from "esbuild";
+import { readFileSync } from "fs";
+
+const args = process.argv.slice(2);
+let repeat = 3;
+if (args[0] === "--repeat") {
+  repeat = Number(args[1]);
+  args.splice(0, 2);
+}
+
+/**
+ * Icons are generated by a vite plugin, they are not needed outside the browser
+ * @type { import("esbuild").Plugin }
+ */
+const noIcons = {
+  name: "no-icons",
+  setup(build) {
+    build.onResolve({ filter: /^~icons\// }, (args) => ({ path: args.path, namespace: "icon" }));
+    build.onLoad({ filter: /.*/, namespace: "icon" }, () => ({
+      contents: "export default () => null;",
+    }));
+  },
+};
+
+const { outputFiles } = await build({
+  stdin: {
+    contents: `
+      export { plotToGraph } from "./src/utils/plot";
+      export { getLayout } from "./src/utils/layout";
+    `,
+    resolveDir: process.cwd(),
+    loader: "ts",
+  },
+  bundle: true,
+  write: false,
+  platform: "node",
+  format: "esm",
+  plugins: [noIcons],
+});
+const { plotToGraph, getLayout } = await import(
+  "data:text/javascript;base64," + Buffer.from(outputFiles[0].contents).toString("base64")
+);
+
+/**
+ * Best time (in seconds) of `repeat` runs, and the heap growth during the first one
+ */
+const measure = (fn) => {
+  let seconds = Infinity;
+  let peak = 0;
+  let result;
+  for (let i = 0; i < repeat; i++) {
+    global.gc?.();
+    const heap = process.memoryUsage().heapUsed;
+    const start = process.hrtime.bigint();
+    result = fn();
+    seconds = Math.min(seconds, Number(process.hrtime.bigint() - start) / 1e9);
+    peak = Math.max(peak, process.memoryUsage().heapUsed - heap);
+  }
+  return [result, { seconds, peak_bytes: peak }];
+};
+
+const results = [];
+for (const file of args) {
+  const plot = JSON.parse(readFileSync(file, "utf8"));
+  const [graph, graphStats] = measure(() => plotToGraph(plot));
+  results.push({ file, stage: "plotToGraph", ...graphStats });
+  const [, layoutStats] = measure(() => getLayout(graph));
+  results.push({ file, stage: "getLayout", ...layoutStats });
+}
+console.log(JSON.stringify(results));
@@ -9,6 +9,7 @@ import pick from "../utils/pick";
 import { columnGap, rowGap, useLayout } from "../utils/layout";
 import useResizeObserver from "use-resize-observer";
 import { nodeHeight, nodeWidth } from "./Node";
+import { sendMessage } from "../messaging";
 
 const scrollSpeedModifier = 0.5;
 const maxZoom = 1;
@@ -26,12 +27,12 @@ const colorFlow = (flowName: string) => {
 };
 
 const Canvas: FC<{ zoomWithControl?: boolean }> = ({ zoomWithControl = true }) => {
-  const { viewTransform, viewportJumping } = useStore(
-    pick("viewTransform", "viewportJumping"),
+  const { viewTransform, viewportJumping, positions } = useStore(
+    pick("viewTransform", "viewportJumping", "positions"),
     shallow
   );
   const graph = useGraph();
-  const nodeLayoutPositions = useLayout(graph);
+  const nodeLayoutPositions = useLayout(graph, positions);
   const canvasRef = useRef<HTMLDivElement>(null);
   const viewportRef = useRef<HTMLDivElement>(null);
 
@@ -44,11 +45,21 @@ const Canvas: FC<{ zoomWithControl?: boolean }> = ({ zoomWithControl = true }) =
     },
   });
 
-  // Handle control key (used for panning with mouse when held), and prevent ctrl+scroll
-  // causing page level zoom
+  // Handle control key (used for panning with mouse when held) and the undo/redo
+  // shortcuts, and prevent ctrl+scroll causing page level zoom
   const [ctrlHeld, setCtrlHeld] = useState(false);
   useEffect(() => {
-    const handleKeyDown = (ev: KeyboardEvent) => ev.key === "Control" && setCtrlHeld(true);
+    const handleKeyDown = (ev: KeyboardEvent) => {
+      if (ev.key === "Control") setCtrlHeld(true);
+      // Undo and redo the changes made from the editor, the backend edits the source
+      else if ((ev.ctrlKey || ev.metaKey) && ev.key.toLowerCase() === "z") {
+        ev.preventDefault();
+        sendMessage({ name: ev.shiftKey ? "redo" : "undo" });
+      } else if (ev.ctrlKey && ev.key === "y") {
+        ev.preventDefault();
+        sendMessage({ name: "redo" });
+      }
+    };
     const handleKeyUp = (ev: KeyboardEvent) => ev.key === "Control" && setCtrlHeld(false);
     const preventZoom = (ev: MouseEvent) => ev.preventDefault();
     window.addEventListener("keydown", handleKeyDown);
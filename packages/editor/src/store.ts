@@ -1,6 +1,6 @@
 import produce from "immer";
 import create from "zustand";
-import { Plot } from "@dialog-flow-designer/shared-types/df-parser-server";
+import { Plot, Positions } from "@dialog-flow-designer/shared-types/df-parser-server";
 import { GEdge, GNode, Graph, Mode, Size, Turn, XY } from "./types";
 import { plotToGraph } from "./utils/plot";
 import { MsgSub, sendMessage, useMessages } from "./messaging";
@@ -26,6 +26,10 @@ export interface State {
    * Use {@link useGraph} to get all visible nodes and edges.
    */
   graph: Graph;
+  /**
+   * Positions of the nodes of `graph` computed by the backend, if any
+   */
+  positions: Positions | null;
   /**
    * Nodes which need to be displayed but are not part of the plot. Includes:
    *  - Staging transitions - transitions not yet connected to anything
@@ -80,6 +84,7 @@ const getVisibleGraph = (graph: Graph, virtualGraph: Graph) => ({
 
 const createDefaultState = (): State => ({
   graph: emptyGraph(),
+  positions: null,
   virtualGraph: emptyGraph(),
   viewTransform: Rematrix.identity(),
   canvasSize: { width: 0, height: 0 },
@@ -105,16 +110,19 @@ const get = useStore.getState;
 /**
  * Set (replace) the visible nodes on the canvas. Completely resets virtual nodes.
  */
-export const setGraph = (newGraph: Graph) =>
+export const setGraph = (newGraph: Graph, positions: Positions | null = null) =>
   set({
     graph: newGraph,
+    positions,
     virtualGraph: emptyGraph(),
   });
 
 /**
- * Convert plot to graph and replace it on canvas.
+ * Convert plot to graph and replace it on canvas. The positions of the nodes are used
+ * instead of computing the layout, if given.
  */
-export const setPlot = (plot: Plot) => setGraph(plotToGraph(plot));
+export const setPlot = (plot: Plot, positions?: Positions) =>
+  setGraph(plotToGraph(plot), positions ?? null);
 
 /**
  * Add a new transition to staging connected to the selected node
@@ -296,7 +304,8 @@ export const useZoom = () => useStore((s) => s.viewTransform[0]);
 export const useEditorMessages = () => {
   const handler = useCallback<MsgSub>(({ data }) => {
     console.log("Got message:\n" + JSON.stringify(data, undefined, 4));
-    if (data.plot) setPlot(data.plot);
+    if (data.graph) setGraph(data.graph, data.positions ?? null);
+    else if (data.plot) setPlot(data.plot, data.positions);
     // TODO: Handle new types of state here
   }, []);
   useMessages(handler);
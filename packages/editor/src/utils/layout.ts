@@ -1,6 +1,7 @@
 import { useMemo } from "react";
 import { nodeHeight, nodeWidth } from "../canvas/Node";
 import { GNode, Graph, XY } from "../types";
+import { Positions } from "@dialog-flow-designer/shared-types/df-parser-server";
 
 // This is a basic (kinda hacky, but functional) layout algo. Might need serious rework.
 // The idea is to use a osrt of constrained force-based layout: we make N iterations,
@@ -174,4 +175,13 @@ export const getLayout = (graph: Graph) => {
   return positions;
 };
 
-export const useLayout = (graph: Graph) => useMemo(() => getLayout(graph), [graph]);
+/**
+ * Layout of the graph, unless all its nodes have precomputed positions (eg. from the
+ * Python server)
+ */
+export const useLayout = (graph: Graph, positions?: Positions | null) =>
+  useMemo(
+    () =>
+      positions && graph.nodes.every(({ id }) => id in positions) ? positions : getLayout(graph),
+    [graph, positions]
+  );
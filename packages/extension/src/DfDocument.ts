@@ -2,7 +2,14 @@ import * as vscode from "vscode";
 import { Disposable } from "@hediet/std/disposable";
 import type DfView from "./DfView";
 import type PyServer from "./services/PyServer";
-import type { Plot } from "@dialog-flow-designer/shared-types/df-parser-server";
+import { SupersededError } from "./services/PyServer";
+import type {
+  Diagnostic,
+  Plot,
+  PlotGraph,
+  Positions,
+  TextEdit,
+} from "@dialog-flow-designer/shared-types/df-parser-server";
 import type { DocumentAction } from "./DfView";
 
 /**
@@ -15,6 +22,8 @@ export default class DfDocument implements vscode.Disposable {
   dispose = Disposable.fn();
 
   private views: DfView[] = [];
+  // Problems found in the plot by the server, shown in the editor of the source
+  private diagnostics = vscode.languages.createDiagnosticCollection("dff");
 
   constructor(
     readonly context: vscode.ExtensionContext,
@@ -27,6 +36,7 @@ export default class DfDocument implements vscode.Disposable {
       }
     });
     this.dispose.track(changeDocumentSubscription);
+    this.dispose.track(this.diagnostics);
   }
 
   public get numViews(): number {
@@ -50,8 +60,9 @@ export default class DfDocument implements vscode.Disposable {
        */
       case "ready": {
         // Because opening second/third views is quite rare, we do not cache this value
-        const { plot } = await this.getPlot();
-        view.pushEditorState({ plot });
+        const { plot, graph, positions, diagnostics } = await this.getPlot();
+        view.pushEditorState({ plot, graph, positions });
+        this.publishDiagnostics(diagnostics);
         break;
       }
 
@@ -60,21 +71,108 @@ export default class DfDocument implements vscode.Disposable {
        */
       case "add_node": {
         const { sourceNodeId, newNodeId, newTransId } = action.payload;
-        // First add the node
-        this.pyServer.postPlotObj(uri, "node", {}, newNodeId);
-        // Then add the transition
-        this.pyServer.postPlotObj(uri, "transition", {}, newTransId);
+        // The node and the transition pointing to it, in a single round trip
+        const { edits } = await this.pyServer.batchPlotObjs(
+          uri,
+          [
+            { name: "post_obj", payload: { type: "node", props: {} } },
+            {
+              name: "post_obj",
+              payload: { type: "transition", props: { node: sourceNodeId, label: "$0" } },
+            },
+          ],
+          [newNodeId, newTransId]
+        );
+        await this.applyEdits(edits);
+        break;
+      }
+
+      /**
+       * Undo or redo the last change made from the editor, the source is parsed again
+       * once the edits are applied
+       */
+      case "undo":
+      case "redo": {
+        const { edits } = await this.pyServer[action.name](uri);
+        await this.applyEdits(edits);
         break;
       }
     }
   };
 
-  private getPlot = () =>
-    this.pyServer.parseSrc(this.document.uri.toString(), this.document.getText());
+  /**
+   * Apply the edits sent by the server. Only the changed ranges are replaced, so the
+   * rest of the document (and the undo history) is left alone.
+   */
+  private applyEdits = async (edits: TextEdit[]) => {
+    const workspaceEdit = new vscode.WorkspaceEdit();
+    for (const { range, newText } of edits) {
+      workspaceEdit.replace(
+        this.document.uri,
+        new vscode.Range(
+          range.start.line,
+          range.start.character,
+          range.end.line,
+          range.end.character
+        ),
+        newText
+      );
+    }
+    await vscode.workspace.applyEdit(workspaceEdit);
+  };
+
+  // The graph, positions and problems are only sent for Python scripts, not in the YAML
+  // test mode
+  private getPlot = (): Promise<{
+    plot: Plot;
+    graph?: PlotGraph;
+    positions?: Positions;
+    diagnostics?: Diagnostic[];
+  }> =>
+    this.pyServer.parseSrc(
+      this.document.uri.toString(),
+      this.document.getText(),
+      this.document.version
+    );
+
+  /**
+   * Show the problems found in the plot on the lines of their nodes, the ones without a
+   * range on the first line
+   */
+  private publishDiagnostics = (diagnostics?: Diagnostic[]) => {
+    // Only sent if the analysis was requested
+    if (!diagnostics) return;
+    this.diagnostics.set(
+      this.document.uri,
+      diagnostics.map(({ range, message, code }) => {
+        const diagnostic = new vscode.Diagnostic(
+          range
+            ? new vscode.Range(
+                range.start.line,
+                range.start.character,
+                range.end.line,
+                range.end.character
+              )
+            : new vscode.Range(0, 0, 0, 0),
+          message,
+          vscode.DiagnosticSeverity.Warning
+        );
+        diagnostic.code = code;
+        diagnostic.source = "dff";
+        return diagnostic;
+      })
+    );
+  };
 
   private handleSourceChange = async () => {
-    const { plot } = await this.getPlot();
-    this.views.forEach((view) => view.pushEditorState({ plot }));
+    try {
+      const { plot, graph, positions, diagnostics } = await this.getPlot();
+      this.views.forEach((view) => view.pushEditorState({ plot, graph, positions }));
+      this.publishDiagnostics(diagnostics);
+    } catch (e) {
+      // A later change is being parsed, its plot will be pushed instead
+      if (!(e instanceof SupersededError)) throw e;
+    }
   };
 
   disposeView = (view: DfView) => {
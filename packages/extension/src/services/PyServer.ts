@@ -1,17 +1,47 @@
 import path = require("path");
+import * as net from "net";
+import * as os from "os";
+import { spawn } from "child_process";
 import * as vscode from "vscode";
 import { PythonShell } from "python-shell";
 import type {
+  BatchOperation,
+  BatchReply,
+  Complete,
+  CompleteReply,
+  DumpYaml,
+  Framing,
+  GraphDelta,
+  Handshake,
+  IndexWorkspaceReply,
+  LayoutDelta,
   MessageAndReply,
+  ParseYamlReply,
   Plot,
+  PlotDelta,
+  PlotGraph,
   PlotReply,
+  Positions,
+  PostReply,
+  Simulate,
+  SimulateReply,
   SrcReply,
+  StatsReply,
+  TableDelta,
 } from "@dialog-flow-designer/shared-types/df-parser-server";
 import { findVenv } from "@dialog-flow-designer/utils";
 import { nanoid } from "nanoid";
-import * as yaml from "js-yaml";
 
-type ReplyCb = (reply: MessageAndReply[1]["payload"]) => void;
+type ReplyCb = {
+  resolve: (reply: MessageAndReply[1]["payload"]) => void;
+  reject: (error: Error) => void;
+};
+
+// Unix socket of the server shared by the windows (and Dream Builder), see `connect`
+const SOCKET_PATH = path.join(os.tmpdir(), `df-parser-server-${os.userInfo().uid}.sock`);
+// Attempts to connect to the shared server while it starts, CONNECT_DELAY ms apart
+const CONNECT_ATTEMPTS = 50;
+const CONNECT_DELAY = 100;
 
 const typePrefixes = {
   flow: "fl",
@@ -25,62 +55,98 @@ const typePrefixes = {
   transition: "tr",
   node: "nd",
 };
-const fakeDb: Record<string, Plot> = {};
+
 /**
- * Find a DfObj in given plot.
- *
- * **For testing only, not efficient!**
+ * Rejection of messages the server dropped because a newer message replaced them
  */
-const findObj = (objid: string, plot: Plot): [string, any] | undefined => {
-  for (const typ in plot) {
-    if (Object.prototype.hasOwnProperty.call(plot, typ)) {
-      const dfObjects = plot[typ as keyof Plot];
-      if (objid in dfObjects) return [typ, dfObjects[objid]];
-    }
+export class SupersededError extends Error {
+  constructor() {
+    super("Superseded by a newer message");
+    this.name = "SupersededError";
+  }
+}
+
+/**
+ * Apply a delta received from the server to the previous version of the plot
+ */
+export const applyPlotDelta = (plot: Plot, delta: PlotDelta): Plot => {
+  const newPlot = { ...plot };
+  for (const [table, changes] of Object.entries(delta) as [keyof Plot, TableDelta<any>][]) {
+    const objects: Record<string, any> = { ...plot[table], ...changes.added, ...changes.changed };
+    for (const objid of changes.removed) delete objects[objid];
+    newPlot[table] = objects;
   }
+  return newPlot;
+};
+
+/**
+ * Apply a graph delta received from the server to the previous version of the graph
+ */
+export const applyGraphDelta = (graph: PlotGraph, delta: GraphDelta): PlotGraph => {
+  const removed = new Set(delta.nodes.removed);
+  const changed = new Map(delta.nodes.changed.map((node) => [node.id, node]));
+  const removedEdges = new Set(delta.edges.removed.map(({ fromId, toId }) => `${fromId}-${toId}`));
+  return {
+    nodes: graph.nodes
+      .filter((node) => !removed.has(node.id))
+      .map((node) => changed.get(node.id) ?? node)
+      .concat(delta.nodes.added),
+    edges: graph.edges
+      .filter(({ fromId, toId }) => !removedEdges.has(`${fromId}-${toId}`))
+      .concat(delta.edges.added),
+  };
+};
+
+/**
+ * Apply a layout delta received from the server to the previous positions
+ */
+export const applyLayoutDelta = (positions: Positions, delta: LayoutDelta): Positions => {
+  const newPositions = { ...positions, ...delta.changed };
+  for (const id of delta.removed) delete newPositions[id];
+  return newPositions;
 };
+
 export default class PyServer {
   name = "pyserver";
 
-  // Definetely gets intialized in constructor
-  pyProc!: PythonShell;
+  // The private Python process, or the connection to the shared one
+  pyProc?: PythonShell;
+  private socket?: net.Socket;
+  private output?: { write: (data: Buffer) => unknown };
   private replyCallbacks: Record<string, ReplyCb> = {};
+  // Last plot (with its graph and layout) received for each document, replies to
+  // parseSrc are deltas against it
+  private plots: Record<
+    string,
+    { version: number; plot: Plot; graph?: PlotGraph; positions?: Positions }
+  > = {};
+  // Transport used with the Python process, switched by the handshake
+  private framing: Framing = "lines";
+  private handshakeId?: string;
+  // Resolves once connected to the Python process and the handshake is done, messages
+  // must not be sent before. Unset until then, and once the connection is lost.
+  private ready?: Promise<unknown>;
+  // Bytes received from Python which do not form a complete message yet
+  private received = Buffer.alloc(0);
   private disposed = false;
 
   constructor() {
-    // COMMENTED FOR YAML TEST MODE ONLY
-    // this.ensureServerRunning();
+    this.ensureServerRunning();
 
     // In practice, dispose does not always get called, so it's best to make sure
     // in this case, so we don't leave any zombie processes behind.
     process.on("exit", () => this.dispose());
   }
 
-  public parseSrc = async (uri: string, yamlSrc: string) => {
-    const plot = yaml.load(yamlSrc) as Plot;
-    fakeDb[uri] = plot;
-    return <PlotReply["payload"]>{
-      plot,
-    };
-  };
+  public parseSrc = async (uri: string, yamlSrc: string, documentVersion?: number) =>
+    (await this.sendMessage({
+      name: "parse_yaml",
+      payload: { uri, source: yamlSrc, documentVersion },
+    })) as ParseYamlReply["payload"];
 
   public putPlotObj = async (uri: string, objid: string, update: Record<string, string>) => {
-    const oldPlot = fakeDb[uri];
-    const [objType, obj] = findObj(objid, oldPlot)!;
-    const newPlot: Plot = {
-      ...oldPlot,
-      [objType as keyof Plot]: {
-        ...oldPlot[objType as keyof Plot],
-        [objid]: {
-          ...obj,
-          ...update,
-        },
-      },
-    };
-    fakeDb[uri] = newPlot;
-    return <SrcReply["payload"]>{
-      source: yaml.dump(newPlot),
-    };
+    const { edits } = await this.dumpYaml(uri, [{ name: "put_obj", payload: { objid, update } }]);
+    return <SrcReply["payload"]>{ edits };
   };
 
   public postPlotObj = async (
@@ -89,94 +155,326 @@ export default class PyServer {
     props: Record<string, string>,
     determinedId?: string
   ) => {
-    const oldPlot = fakeDb[uri];
-    const typePlural = type === "linking" ? type : type + "s";
-    const newId = determinedId ?? `id#${typePrefixes[type]}_${nanoid(8)}`;
-    const newPlot: Plot = {
-      ...oldPlot,
-      [typePlural as keyof Plot]: {
-        ...oldPlot[typePlural as keyof Plot],
-        [newId]: props,
-      },
-    };
-    fakeDb[uri] = newPlot;
-    return <SrcReply["payload"]>{
-      source: yaml.dump(newPlot),
-    };
+    const { edits, objids } = await this.dumpYaml(uri, [
+      { name: "post_obj", payload: { type, props, objid: determinedId } },
+    ]);
+    return <PostReply["payload"]>{ edits, objid: objids[0] };
   };
 
+  /**
+   * Apply several put/post operations, with a single source update.
+   * `determinedIds` are the ids of the created objects, by operation index.
+   */
+  public batchPlotObjs = async (
+    uri: string,
+    operations: BatchOperation[],
+    determinedIds: (string | undefined)[] = []
+  ) =>
+    this.dumpYaml(
+      uri,
+      operations.map((op, i) =>
+        op.name === "post_obj" ? { ...op, payload: { ...op.payload, objid: determinedIds[i] } } : op
+      )
+    );
+
+  /**
+   * Edit the plot of a YAML document, the server dumps the tables which changed
+   */
+  private dumpYaml = async (uri: string, operations: DumpYaml["payload"]["operations"]) =>
+    (await this.sendMessage({
+      name: "dump_yaml",
+      payload: { uri, operations },
+    })) as BatchReply["payload"];
+
   // COMMENTED FOR YAML TEST MODE ONLY
-  // public parseSrc = async (pythonSrc: string) =>
-  //   (await this.sendMessage({
-  //     name: "parse_src",
-  //     payload: { source: pythonSrc },
-  //   })) as PlotReply["payload"];
+  // public parseSrc = async (uri: string, pythonSrc: string, documentVersion?: number) => {
+  //   const { version, plot, delta, graph, graphDelta, positions, layoutDelta, diagnostics } =
+  //     (await this.sendMessage({
+  //       name: "parse_src",
+  //       payload: {
+  //         uri,
+  //         source: pythonSrc,
+  //         documentVersion,
+  //         delta: true,
+  //         baseVersion: this.plots[uri]?.version,
+  //         graph: true,
+  //         layout: true,
+  //         analysis: true,
+  //       },
+  //     })) as PlotReply["payload"];
+  //   const base = this.plots[uri];
+  //   const newPlot = plot ?? applyPlotDelta(base.plot, delta!);
+  //   const newGraph = graph ?? applyGraphDelta(base.graph!, graphDelta!);
+  //   const newPositions = positions ?? applyLayoutDelta(base.positions!, layoutDelta!);
+  //   this.plots[uri] = { version, plot: newPlot, graph: newGraph, positions: newPositions };
+  //   return { plot: newPlot, graph: newGraph, positions: newPositions, diagnostics };
+  // };
 
   // COMMENTED FOR YAML TEST MODE ONLY
-  // public putPlotObj = async (objid: string, update: Record<string, string>) =>
+  // public putPlotObj = async (uri: string, objid: string, update: Record<string, string>) =>
   //   (await this.sendMessage({
   //     name: "put_obj",
-  //     payload: { objid, update },
+  //     payload: { uri, objid, update },
   //   })) as SrcReply["payload"];
 
   // COMMENTED FOR YAML TEST MODE ONLY
-  // public postPlotObj = async (type: string, props: Record<string, string>) =>
+  // public postPlotObj = async (uri: string, type: string, props: Record<string, string>) =>
   //   (await this.sendMessage({
   //     name: "post_obj",
-  //     payload: { type, props },
-  //   })) as SrcReply["payload"];
+  //     payload: { uri, type, props },
+  //   })) as PostReply["payload"];
+
+  // COMMENTED FOR YAML TEST MODE ONLY
+  // public batchPlotObjs = async (uri: string, operations: BatchOperation[]) =>
+  //   (await this.sendMessage({
+  //     name: "batch",
+  //     payload: { uri, operations },
+  //   })) as BatchReply["payload"];
+
+  /**
+   * Run synthetic conversations over the plot of a document, see {@link Simulate}
+   */
+  public simulate = async (uri: string, options: Omit<Simulate["payload"], "uri"> = {}) =>
+    (await this.sendMessage({
+      name: "simulate",
+      payload: { uri, ...options },
+    })) as SimulateReply["payload"];
+
+  /**
+   * Suggestions for the autocompletion of an input in the editor of a document
+   */
+  public complete = async (
+    uri: string,
+    input: string,
+    options: Omit<Complete["payload"], "uri" | "input"> = {}
+  ) =>
+    (await this.sendMessage({
+      name: "complete",
+      payload: { uri, input, ...options },
+    })) as CompleteReply["payload"];
 
+  /**
+   * Index the python files of a workspace folder, so that parses can resolve the
+   * definitions of the py_defs, see `IndexWorkspace`
+   */
+  public indexWorkspace = async (uri: string) =>
+    (await this.sendMessage({
+      name: "index_workspace",
+      payload: { uri },
+    })) as IndexWorkspaceReply["payload"];
+
+  /**
+   * Undo the last edit the server made to a document, see `Undo`
+   */
+  public undo = async (uri: string) =>
+    (await this.sendMessage({ name: "undo", payload: { uri } })) as SrcReply["payload"];
+
+  /**
+   * Redo the last edit undone, see `Redo`
+   */
+  public redo = async (uri: string) =>
+    (await this.sendMessage({ name: "redo", payload: { uri } })) as SrcReply["payload"];
+
+  /**
+   * Percentiles of the time spent on each kind of message by the server
+   */
+  public stats = async () =>
+    (await this.sendMessage({ name: "stats", payload: {} })) as StatsReply["payload"];
+
+  /**
+   * Start or connect to the Python process, unless already done or being done. The
+   * messages sent until then all wait for the same connection.
+   */
   private ensureServerRunning = () => {
-    if (this.pyProc && this.pyProc.exitCode === null) return;
+    if (this.disposed) return Promise.reject(new Error("The Python process was disposed"));
+    if (this.ready) return this.ready;
+    this.framing = "lines";
+    this.received = Buffer.alloc(0);
+    // The versions of the plots are numbered by the server
+    this.plots = {};
+    const shared =
+      process.platform !== "win32" &&
+      vscode.workspace.getConfiguration("dfDesigner").get("sharedServer", true);
+    const ready = (shared ? this.connect() : Promise.resolve().then(this.startPrivate)).then(
+      this.handshake
+    );
+    // Try again with the next message
+    ready.catch((e) => {
+      console.error("Could not connect to the Python process", e);
+      if (this.ready === ready) this.ready = undefined;
+    });
+    this.ready = ready;
+    return ready;
+  };
+
+  /**
+   * Reject the messages waiting for a reply, the next message connects again
+   */
+  private disconnected = (reason: string) => {
+    console.error(reason);
+    this.ready = undefined;
+    this.socket = undefined;
+    this.pyProc = undefined;
+    this.output = undefined;
+    for (const { reject } of Object.values(this.replyCallbacks)) reject(new Error(reason));
+    this.replyCallbacks = {};
+  };
+
+  /**
+   * Where the server is and the python it runs with
+   */
+  private serverLocation = (): { cwd?: string; pythonPath?: string } => {
     if (process.env.NODE_ENV === "development") {
-      console.info("Starting Python process in development mode");
       // For some reason cwd is messed up when running in development
       const venvPath = findVenv();
-      const serverPkgPath = path.resolve(venvPath, "..", "packages", "df-parser-server");
-      this.pyProc = new PythonShell("server.py", {
-        cwd: serverPkgPath,
-        pythonPath: path.join(venvPath, "bin", "python"),
-        // Yes, there's a json mode, but it does not seem to work
-        // Just stick to text mode
-      });
-    } else {
-      console.info("Starting Python process");
-      this.pyProc = new PythonShell("server.py", {
-        pythonPath: path.join("venv", "bin", "python"),
-        // Yes, there's a json mode, but it does not seem to work
-        // Just stick to text mode
-      });
+      return { cwd: path.resolve(venvPath, "..", "packages", "df-parser-server") };
     }
-    this.pyProc.on("message", this.receiveReply);
-    this.pyProc.on("close", (code: number) => {
-      console.error(`Python process exited with code ${code}`);
+    return { pythonPath: path.join("venv", "bin", "python") };
+  };
+
+  /**
+   * Start a server for this window only, talking over stdin and stdout
+   */
+  private startPrivate = () => {
+    console.info(`Starting Python process in ${process.env.NODE_ENV ?? "production"} mode`);
+    const pyProc = new PythonShell("server.py", {
+      ...this.serverLocation(),
+      // Messages are split by receiveData, as the framing changes after the handshake
+      mode: "binary",
+    });
+    pyProc.stdout.on("data", this.receiveData);
+    pyProc.on("close", (code: number) => {
+      if (this.pyProc === pyProc) this.disconnected(`Python process exited with code ${code}`);
     });
+    this.pyProc = pyProc;
+    this.output = pyProc.stdin;
   };
 
+  /**
+   * Connect to the server shared by the windows, starting it if none is running. The
+   * documents and caches are shared, and the server stops by itself once no window was
+   * connected to it for a while.
+   */
+  private connect = async () => {
+    let socket: net.Socket | undefined;
+    for (let attempt = 0; !socket; attempt++) {
+      try {
+        socket = await new Promise<net.Socket>((resolve, reject) => {
+          const connection = net.createConnection(SOCKET_PATH, () => resolve(connection));
+          connection.once("error", reject);
+        });
+      } catch (e) {
+        if (attempt === CONNECT_ATTEMPTS) throw e;
+        if (attempt === 0) this.startShared();
+        await new Promise((resolve) => setTimeout(resolve, CONNECT_DELAY));
+      }
+    }
+    socket.on("data", this.receiveData);
+    socket.on("error", (e) => console.error("Connection to the Python process failed", e));
+    socket.on("close", () => {
+      if (this.socket === socket) this.disconnected("Connection to the Python process closed");
+    });
+    this.socket = socket;
+    this.output = socket;
+  };
+
+  private startShared = () => {
+    console.info("Starting shared Python process");
+    const { cwd, pythonPath } = this.serverLocation();
+    // Outlives this window, other windows may be using it
+    spawn(pythonPath ?? PythonShell.defaultPythonPath, ["server.py", "--socket", SOCKET_PATH], {
+      cwd,
+      detached: true,
+      stdio: "ignore",
+    }).unref();
+  };
+
+  /**
+   * Switch to length-prefixed frames, so that large plots don't have to be scanned
+   * for newlines
+   */
+  private handshake = () =>
+    new Promise((resolve, reject) => {
+      const id = nanoid();
+      this.handshakeId = id;
+      this.replyCallbacks[id] = { resolve, reject };
+      this.writeMessage(<Handshake>{
+        id,
+        name: "handshake",
+        payload: { framing: "length", encoding: "json" },
+      });
+    });
+
   private sendMessage = <T extends MessageAndReply>(
     message: Omit<T[0], "id">
   ): Promise<T[1]["payload"]> =>
-    new Promise((resolve) => {
-      const id = nanoid();
-      this.replyCallbacks[id] = resolve;
+    new Promise((resolve, reject) => {
       console.log("Send message to py\n", message);
-      this.pyProc.send(JSON.stringify(<T[0]>{ ...message, id }));
+      this.ensureServerRunning().then(() => {
+        if (!this.output) {
+          reject(new Error("Connection to the Python process closed"));
+          return;
+        }
+        const id = nanoid();
+        this.replyCallbacks[id] = { resolve, reject };
+        this.writeMessage(<T[0]>{ ...message, id });
+      }, reject);
     });
 
-  private receiveReply = (replyStr: string) => {
-    console.log("Data from Python\n", replyStr);
-    const { msgId, payload } = JSON.parse(replyStr) as MessageAndReply[1];
+  private writeMessage = (message: MessageAndReply[0]) => {
+    const body = Buffer.from(JSON.stringify(message));
+    if (this.framing === "length") {
+      const header = Buffer.alloc(4);
+      header.writeUInt32BE(body.length);
+      this.output!.write(Buffer.concat([header, body]));
+    } else this.output!.write(Buffer.concat([body, Buffer.from("\n")]));
+  };
+
+  private receiveData = (data: Buffer) => {
+    this.received = Buffer.concat([this.received, data]);
+    for (;;) {
+      let message: Buffer;
+      if (this.framing === "length") {
+        if (this.received.length < 4) break;
+        const length = this.received.readUInt32BE(0);
+        if (this.received.length < 4 + length) break;
+        message = this.received.subarray(4, 4 + length);
+        this.received = this.received.subarray(4 + length);
+      } else {
+        const end = this.received.indexOf("\n");
+        if (end === -1) break;
+        message = this.received.subarray(0, end);
+        this.received = this.received.subarray(end + 1);
+      }
+      const reply = JSON.parse(message.toString("utf8")) as MessageAndReply[1];
+      // Everything after the handshake reply uses the new framing
+      if (reply.msgId === this.handshakeId)
+        this.framing = (<Handshake["payload"]>reply.payload).framing;
+      this.receiveReply(reply);
+    }
+  };
+
+  private receiveReply = (reply: MessageAndReply[1]) => {
+    console.log("Data from Python\n", reply);
+    const { msgId, payload, error, superseded } = reply;
     if (msgId in this.replyCallbacks) {
-      this.replyCallbacks[msgId](payload);
+      const { resolve, reject } = this.replyCallbacks[msgId];
+      if (superseded) reject(new SupersededError());
+      else if (error !== undefined) reject(new Error(error));
+      else resolve(payload);
       delete this.replyCallbacks[msgId];
     } else console.error(`Reply callback for ${msgId} was not found!`);
   };
 
   dispose() {
-    if (this.disposed || this.pyProc.exitCode !== null) return;
-    console.info("killing python process");
-    this.pyProc.end(() => {});
-    this.pyProc.kill();
+    if (this.disposed) return;
+    // The shared process stops by itself once no window is connected
+    this.socket?.end();
+    if (this.pyProc && this.pyProc.exitCode === null) {
+      console.info("killing python process");
+      this.pyProc.end(() => {});
+      this.pyProc.kill();
+    }
     this.disposed = true;
   }
 }
@@ -1,5 +1,6 @@
 // This module contains the types shared by the python server and the typescript
-// process talking to it (either the extension or Dream Builder)
+// process talking to it (either the extension or Dream Builder), over stdio or a socket
+// shared by several of them (see `server.py --socket`), where each has its own session
 
 export type NodeType = "global" | "local" | "regular";
 
@@ -105,13 +106,79 @@ interface MessageBase {
   payload?: object;
 }
 
+/**
+ * Messages about the same document are handled in the order they were sent, others
+ * concurrently, so replies may arrive out of order.
+ */
+interface DocumentPayload {
+  /**
+   * Uri of the document the message is about
+   */
+  uri: string;
+
+  /**
+   * Milliseconds after which the server gives up on the message and replies with an
+   * error instead
+   */
+  deadline?: number;
+}
+
 /**
  * Parse a new or changed python module and return the parsed plot ({@link Plot})
  */
 export interface ParseSrc extends MessageBase {
   name: "parse_src";
-  payload: {
+  payload: DocumentPayload & {
     source: string;
+    /**
+     * Version of the document text (`TextDocument.version`). Consecutive parses of a
+     * document supersede each other, as do parses of an older version than the last.
+     */
+    documentVersion?: number;
+    /**
+     * Reply with a {@link PlotDelta} against the plot of `baseVersion` if possible
+     */
+    delta?: boolean;
+    /**
+     * Version of the last plot received for the document
+     */
+    baseVersion?: number;
+    /**
+     * Also reply with the positions of the nodes of the graph, see {@link Layout}. With
+     * `delta`, as a {@link LayoutDelta} against the positions of `baseVersion` if the
+     * server has them.
+     */
+    layout?: boolean;
+    /**
+     * Also reply with the graph of the plot, the nodes and edges the editor draws (as
+     * `plotToGraph` converts them). With `delta`, as a {@link GraphDelta} against the
+     * graph of `baseVersion` if the server has it.
+     */
+    graph?: boolean;
+    /**
+     * Reply with the canonical plot: identical linking objects (calls of the same
+     * object with the same arguments, eg. every `cnd.true()`) are merged into a single
+     * entry, whose id is derived from its content, and have no `parent`. With `delta`,
+     * as a {@link PlotDelta} against the canonical plot of `baseVersion`. The server
+     * knows where each entry is in the source: a `put_obj` of an entry used in a
+     * single place edits it there.
+     */
+    canonical?: boolean;
+    /**
+     * Also reply with the problems found in the plot, see {@link Diagnostic}. They are
+     * checked again only where the plot changed.
+     */
+    analysis?: boolean;
+    /**
+     * Ids of the nodes the conversation starts from, for the reachability check. By
+     * default, the regular nodes named `start` or `fallback`, or else the first one.
+     */
+    start?: string[];
+    /**
+     * Also reply with where the `py_defs` imported by the script are defined, if the
+     * document is in a workspace folder indexed with {@link IndexWorkspace}
+     */
+    definitions?: boolean;
   };
 }
 
@@ -120,7 +187,7 @@ export interface ParseSrc extends MessageBase {
  */
 export interface PutObj extends MessageBase {
   name: "put_obj";
-  payload: {
+  payload: DocumentPayload & {
     objid: string;
     update: Record<string, string>;
   };
@@ -131,12 +198,310 @@ export interface PutObj extends MessageBase {
  */
 export interface PostObject extends MessageBase {
   name: "post_obj";
-  payload: {
+  payload: DocumentPayload & {
     type: string;
     props: Record<string, string>;
   };
 }
 
+/**
+ * Operation of a {@link Batch}, a put_obj or post_obj message without id and uri
+ */
+export type BatchOperation =
+  | { name: "put_obj"; payload: Omit<PutObj["payload"], "uri"> }
+  | { name: "post_obj"; payload: Omit<PostObject["payload"], "uri"> };
+
+/**
+ * Apply several put_obj/post_obj operations at once and return the updated source
+ * code. Either all operations are applied or none. String values of the form "$<i>"
+ * are replaced by the id of the object created (or updated) by the i-th operation,
+ * eg. to add a transition to a node created in the same batch.
+ */
+export interface Batch extends MessageBase {
+  name: "batch";
+  payload: DocumentPayload & {
+    operations: BatchOperation[];
+  };
+}
+
+/**
+ * Lay out the graph of the last plot sent (the nodes and transitions the editor draws,
+ * see `plotToGraph`), the same way the editor does with `getLayout`. The layout is
+ * updated from the previous one: only the nodes around the changes are laid out again,
+ * the others stay where they were or are moved as a block.
+ */
+export interface Layout extends MessageBase {
+  name: "layout";
+  payload: DocumentPayload & {
+    /**
+     * Version of the plot of the last positions received for the document, reply with
+     * a {@link LayoutDelta} against them if possible
+     */
+    baseVersion?: number;
+  };
+}
+
+/**
+ * Run synthetic conversations over the plot of a document, following the transitions
+ * as dff does: at each turn the transitions of the node, of the `LOCAL` node of its flow
+ * and of the `GLOBAL` node are tried by decreasing priority, and the first one whose
+ * condition holds is taken. `cnd.all`, `cnd.any`, `cnd.neg`, `cnd.true` and `cnd.false`
+ * are evaluated, any other condition is a leaf stubbed with `leaves`.
+ */
+export interface Simulate extends MessageBase {
+  name: "simulate";
+  payload: DocumentPayload & {
+    /**
+     * Conversations run at once, 1000 by default
+     */
+    conversations?: number;
+    /**
+     * Turns of each conversation, 100 by default
+     */
+    turns?: number;
+    /**
+     * Value of the leaf conditions, a constant or the probability that they hold. Keys
+     * are the name of a condition with its arguments as in the plot (eg.
+     * `loc_cnd.check_flag(book_skill_active)`), or its name alone.
+     */
+    leaves?: Record<string, boolean | number>;
+    /**
+     * Probability that the other leaves hold, 0.5 by default
+     */
+    default?: number;
+    /**
+     * Ids of the start and fallback nodes, the first node and the start node by default
+     */
+    start?: string;
+    fallback?: string;
+    seed?: number;
+  };
+}
+
+/**
+ * Visits of the nodes (including the start of each conversation) and the transitions
+ * taken, by id. Nodes and transitions never visited are left out.
+ */
+export interface SimulateReply extends ReplyBase {
+  payload: {
+    turns: number;
+    nodes: Record<string, number>;
+    transitions: Record<string, number>;
+    /**
+     * Turns which went to the fallback node because no condition held
+     */
+    fallbacks: number;
+    /**
+     * Value used for each leaf condition met
+     */
+    leaves: Record<string, boolean | number>;
+  };
+}
+
+export type CompletionKind = "condition" | "processing" | "response" | "flow" | "node";
+
+/**
+ * Suggestions for the autocompletion of an input, from the terms of the plot of a
+ * document: the functions called by conditions, processings and responses, the names
+ * of flows and regular nodes, and the response strings. Terms starting with the input
+ * come first, then the ones with a word starting with it, then the ones close to it.
+ */
+export interface Complete extends MessageBase {
+  name: "complete";
+  payload: DocumentPayload & {
+    input: string;
+    /**
+     * Kinds of terms to suggest, all of them by default
+     */
+    kinds?: CompletionKind[];
+    /**
+     * 10 by default
+     */
+    limit?: number;
+  };
+}
+
+/**
+ * Suggestions by decreasing score, as `SuggestionData` of the editor (scores go from
+ * `-Infinity` to `0`)
+ */
+export interface CompleteReply extends ReplyBase {
+  payload: {
+    suggestions: { type: CompletionKind; value: string; score: number }[];
+  };
+}
+
+/**
+ * Index the python files of a workspace folder, or the ones changed since the last time
+ * (by modification time, then by content). The modules imported by the scripts are
+ * resolved from the directory of the script and its parents, up to the folder.
+ */
+export interface IndexWorkspace extends MessageBase {
+  name: "index_workspace";
+  payload: {
+    /**
+     * Uri of the workspace folder
+     */
+    uri: string;
+  };
+}
+
+/**
+ * Top-level definition (function, class or assignment) of a module of the workspace
+ */
+export interface Definition {
+  /**
+   * Path of the module
+   */
+  file: string;
+  range: {
+    start: Position;
+    end: Position;
+  };
+  code: string;
+}
+
+/**
+ * Counts of the files of the workspace, and of the work done by the last indexing
+ */
+export interface IndexWorkspaceReply extends ReplyBase {
+  payload: {
+    files: number;
+    /**
+     * Files with a plot
+     */
+    scripts: number;
+    /**
+     * Files parsed again, the other ones did not change
+     */
+    indexed: number;
+    unchanged: number;
+    /**
+     * Scripts whose py_defs were resolved again
+     */
+    resolved: number;
+    /**
+     * py_defs resolved in all the scripts
+     */
+    definitions: number;
+    /**
+     * Files which could not be parsed, with the error
+     */
+    errors: Record<string, string>;
+    /**
+     * Milliseconds
+     */
+    time: number;
+  };
+}
+
+/**
+ * Load the plot of a YAML document (the `*_parsed.yaml` files of the test mode). The
+ * plot is kept until the document changes otherwise than by {@link DumpYaml} edits.
+ */
+export interface ParseYaml extends MessageBase {
+  name: "parse_yaml";
+  payload: DocumentPayload & {
+    source: string;
+    /**
+     * Version of the document text, parses of a YAML document supersede each other
+     * like those of {@link ParseSrc}
+     */
+    documentVersion?: number;
+  };
+}
+
+export interface ParseYamlReply extends ReplyBase {
+  payload: {
+    plot: Plot;
+  };
+}
+
+/**
+ * Apply put_obj/post_obj operations to the plot of a YAML document loaded with
+ * {@link ParseYaml}, like a {@link Batch}. Only the top-level tables which changed are
+ * dumped again, and the edits only replace what changed in them.
+ */
+export interface DumpYaml extends MessageBase {
+  name: "dump_yaml";
+  payload: DocumentPayload & {
+    /**
+     * The payload of a post_obj operation can give the id of the new object
+     */
+    operations: (BatchOperation & { payload: { objid?: string } })[];
+  };
+}
+
+/**
+ * Undo the last edit the server made to a document (a put_obj, post_obj, batch or
+ * dump_yaml), and reply with the edits of the source giving it back. Changes made to
+ * the document in the editor since then can not be undone by the server, and clear its
+ * history of the document. The oldest edits are forgotten once the history takes too
+ * much memory.
+ */
+export interface Undo extends MessageBase {
+  name: "undo";
+  payload: DocumentPayload;
+}
+
+/**
+ * Redo the last edit undone by {@link Undo}, unless an edit was made since then
+ */
+export interface Redo extends MessageBase {
+  name: "redo";
+  payload: DocumentPayload;
+}
+
+/**
+ * Time spent on the messages handled recently, see {@link StatsReply}
+ */
+export interface Stats extends MessageBase {
+  name: "stats";
+  payload: Record<string, never>;
+}
+
+/**
+ * Switch the transport. Until this message, messages and replies are newline-delimited
+ * JSON. After its reply (still newline-delimited), each message is a 4 byte big-endian
+ * length followed by the encoded message. Nothing else may be sent before the reply
+ * arrives.
+ */
+export interface Handshake extends MessageBase {
+  name: "handshake";
+  payload: {
+    framing: Framing;
+    encoding: Encoding;
+    /**
+     * Profile the messages handled from now on, as the `DF_PARSER_PROFILE*`
+     * environment variables of the server do
+     */
+    profile?: ProfileOptions;
+  };
+}
+
+export interface ProfileOptions {
+  /**
+   * Directory the `.pstats` files and tracemalloc snapshots are written to, profiling
+   * is off if empty
+   */
+  directory: string;
+  /**
+   * Comma separated names of the messages to profile, `*` for all of them
+   */
+  messages?: string;
+  /**
+   * Only keep the profiles of messages which took at least this many milliseconds
+   */
+  threshold?: number;
+  /**
+   * `cpu` (cProfile), `memory` (tracemalloc) or `cpu,memory`
+   */
+  mode?: string;
+}
+
+export type Framing = "lines" | "length";
+export type Encoding = "json" | "msgpack";
+
 // Messages (replies) passed from Python -> parent process
 
 interface ReplyBase {
@@ -149,23 +514,269 @@ interface ReplyBase {
    * Optional payload
    */
   payload?: object;
+
+  /**
+   * Set instead of the payload if the message could not be handled (eg. the source
+   * has a syntax error)
+   */
+  error?: string;
+
+  /**
+   * Set instead of the payload if the message was dropped because a newer message
+   * made it pointless (eg. a parse of a newer version of the document)
+   */
+  superseded?: boolean;
 }
 
 /**
- * Result of parsing a dff plot (script)
+ * Changes of a single table of the plot
+ */
+export interface TableDelta<T> {
+  added: Record<string, T>;
+  removed: string[];
+  changed: Record<string, T>;
+}
+
+/**
+ * Difference between two versions of a plot, only tables with changes are present
+ */
+export type PlotDelta = {
+  [table in keyof Plot]?: TableDelta<Plot[table][string]>;
+};
+
+/**
+ * Result of parsing a dff plot (script). Either the whole plot, or if a delta was
+ * requested and the server has the base version, the changes since then.
  */
 export interface PlotReply extends ReplyBase {
   payload: {
-    plot: Plot;
+    version: number;
+    plot?: Plot;
+    delta?: PlotDelta;
+    /**
+     * Set if the layout was requested
+     */
+    positions?: Positions;
+    layoutDelta?: LayoutDelta;
+    /**
+     * Set if the graph was requested
+     */
+    graph?: PlotGraph;
+    graphDelta?: GraphDelta;
+    /**
+     * Set if the analysis was requested, always in full
+     */
+    diagnostics?: Diagnostic[];
+    /**
+     * Set if the definitions were requested: the definition of each resolved py_def, by
+     * id. The ones defined in the script itself have a `code` and are left out.
+     */
+    definitions?: Record<string, Definition>;
+  };
+}
+
+/**
+ * Problem found in a plot: a transition whose label is not a node of the plot
+ * (`dangling-label`), a node which can not be reached (`unreachable`), or nodes the
+ * conversation can not leave (`closed-cycle`)
+ */
+export interface Diagnostic {
+  /**
+   * Transition or node the problem is about
+   */
+  objid: string;
+  /**
+   * Node of the transition, or the node itself
+   */
+  node: string;
+  severity: "warning";
+  code: "dangling-label" | "unreachable" | "closed-cycle";
+  message: string;
+  /**
+   * First line of the node in the source, unless the document is not parsed (the
+   * server restarted with the plot in its cache)
+   */
+  range?: {
+    start: Position;
+    end: Position;
+  };
+}
+
+/**
+ * Node of the graph of a plot: a regular node of the plot (bot turn, 1) or a
+ * transition between two of them (user turn, 0)
+ */
+export interface GraphNode {
+  id: string;
+  label: string;
+  turn: 0 | 1;
+  flow: string;
+  properties: { type: string; value: string }[];
+}
+
+export interface GraphEdge {
+  fromId: string;
+  toId: string;
+}
+
+/**
+ * Graph of a plot, the nodes and edges the editor draws
+ */
+export interface PlotGraph {
+  nodes: GraphNode[];
+  edges: GraphEdge[];
+}
+
+/**
+ * Changes of the graph since a previous version
+ */
+export interface GraphDelta {
+  nodes: {
+    added: GraphNode[];
+    removed: string[];
+    changed: GraphNode[];
+  };
+  edges: {
+    added: GraphEdge[];
+    removed: GraphEdge[];
+  };
+}
+
+/**
+ * Top left corner of each node of the graph, by id
+ */
+export type Positions = Record<string, { x: number; y: number }>;
+
+/**
+ * Changes of the positions since a previous layout: the nodes which moved or were
+ * added, and the ids of the removed ones
+ */
+export interface LayoutDelta {
+  changed: Positions;
+  removed: string[];
+}
+
+/**
+ * Positions of the nodes of the graph of the plot with the given version, either all
+ * of them or if a base version was given and the server has it, the changes since then
+ */
+export interface LayoutReply extends ReplyBase {
+  payload: {
+    version: number;
+    positions?: Positions;
+    layoutDelta?: LayoutDelta;
   };
 }
 
 /**
- * Resulting python source code after updating a dff plot
+ * Position in a document, as in vscode (zero-based, characters in UTF-16 code units)
+ */
+export interface Position {
+  line: number;
+  character: number;
+}
+
+/**
+ * Replacement of a range of the document
+ */
+export interface TextEdit {
+  range: {
+    start: Position;
+    end: Position;
+  };
+  newText: string;
+}
+
+/**
+ * Edits of the python source code updating a dff plot. The ranges refer to the
+ * source before the edits and do not overlap, so they can be applied at once.
  */
 export interface SrcReply extends ReplyBase {
   payload: {
-    source: string;
+    edits: TextEdit[];
+  };
+}
+
+/**
+ * Edits of the python source code creating a new object, along with the object's id
+ */
+export interface PostReply extends ReplyBase {
+  payload: {
+    edits: TextEdit[];
+    objid: string;
+  };
+}
+
+/**
+ * Edits of the python source code after a batch, and the ids of the objects of each
+ * operation
+ */
+export interface BatchReply extends ReplyBase {
+  payload: {
+    edits: TextEdit[];
+    objids: string[];
+  };
+}
+
+/**
+ * Distribution of a value over the messages of the window
+ */
+export interface Summary {
+  count: number;
+  mean: number;
+  p50: number;
+  p99: number;
+  max: number;
+}
+
+/**
+ * Stages a message goes through: waiting for the previous messages about the same
+ * document, decoding, parsing, updating the plot and what is derived from it,
+ * generating code, building and encoding the reply
+ */
+export type Stage = "queued" | "decode" | "parse" | "mutate" | "codegen" | "reply" | "encode";
+
+/**
+ * Latency and time spent in each stage (in milliseconds), and sizes (in bytes) of the
+ * messages of one kind. The counts of errors and superseded messages are since the
+ * server started, superseded messages are not part of the summaries.
+ */
+export type MessageStats = { latency: Summary } & { [stage in Stage]?: Summary } & {
+  message_bytes: Summary;
+  reply_bytes: Summary;
+  errors: number;
+  superseded: number;
+};
+
+/**
+ * Stats of the last one to two minutes, by message name
+ */
+export interface StatsReply extends ReplyBase {
+  payload: {
+    /**
+     * Seconds covered by the stats
+     */
+    window: number;
+    /**
+     * Number of messages being handled or waiting
+     */
+    depth: number;
+    /**
+     * Number of messages being handled or waiting when each message arrived
+     */
+    queue_depth: Summary | null;
+    messages: Record<string, MessageStats>;
+  };
+}
+
+/**
+ * The transport actually used from now on, the server falls back to line-delimited JSON
+ * for anything it does not support (eg. msgpack not being installed)
+ */
+export interface HandshakeReply extends ReplyBase {
+  payload: {
+    framing: Framing;
+    encoding: Encoding;
   };
 }
 
@@ -173,4 +784,18 @@ export interface SrcReply extends ReplyBase {
  * Discriminated union of message-reply tuples passed between Python and the
  * parent process. Rememeber to add new message and reply types here.
  */
-export type MessageAndReply = [ParseSrc, PlotReply] | [PutObj, SrcReply] | [PostObject, SrcReply];
+export type MessageAndReply =
+  | [ParseSrc, PlotReply]
+  | [PutObj, SrcReply]
+  | [PostObject, PostReply]
+  | [Batch, BatchReply]
+  | [Layout, LayoutReply]
+  | [Simulate, SimulateReply]
+  | [Complete, CompleteReply]
+  | [IndexWorkspace, IndexWorkspaceReply]
+  | [ParseYaml, ParseYamlReply]
+  | [DumpYaml, BatchReply]
+  | [Undo, SrcReply]
+  | [Redo, SrcReply]
+  | [Stats, StatsReply]
+  | [Handshake, HandshakeReply];
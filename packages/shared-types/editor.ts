@@ -1,4 +1,4 @@
-import type { Plot } from "./df-parser-server";
+import type { Plot, PlotGraph, Positions } from "./df-parser-server";
 
 // Types shared between the editor UI and the backend (either the extension
 // or Dream Builder)
@@ -8,6 +8,14 @@ import type { Plot } from "./df-parser-server";
  */
 export interface EditorState {
   plot: Plot;
+  /**
+   * Graph of the plot, if the backend computed it, so that the editor does not have to
+   */
+  graph?: PlotGraph;
+  /**
+   * Layout of the graph of the plot, if the backend computed it
+   */
+  positions?: Positions;
 }
 
 // Actions are sent from the UI to the backend
@@ -100,10 +108,26 @@ interface ConnectNodeToNodeAction {
   };
 }
 
+/**
+ * Undo the last change made from the editor
+ */
+interface UndoAction {
+  name: "undo";
+}
+
+/**
+ * Redo the last change undone from the editor
+ */
+interface RedoAction {
+  name: "redo";
+}
+
 export type EditorAction =
   | ReadyAction
   | DropNodeAction
   | AddTransAction
   | AddNodeAction
   | ConnectTransToNodeAction
-  | ConnectNodeToNodeAction;
+  | ConnectNodeToNodeAction
+  | UndoAction
+  | RedoAction;